@@ -14,13 +14,37 @@ set -euo pipefail
 #   2. Clean stale files from previous runs
 #   3. Block Dropbox telemetry (prevents a known Rust panic crash)
 #   4. Download/update the Dropbox daemon binary
-#   5. Launch dropboxd as the dropbox user
-#   6. Wait for readiness, then enter supervision loop
+#   5. Launch dropboxd as the dropbox user, plus the ownership fixer
+#   6. Wait for readiness, then enter supervision loop (or hand both steps
+#      to monitoring.py --supervise when DROPBOX_SUPERVISOR=python)
 #   7. On SIGTERM/SIGINT: forward signal to daemon, wait, exit cleanly
 #
 # Environment variables: see README.md for full documentation.
 # ============================================================================
 
+# --- Healthcheck Probe ---
+# `docker-entrypoint.sh healthcheck` is the image's HEALTHCHECK. With
+# monitoring enabled it asks the monitor's /health, which is answered from
+# the cached status snapshot, using bash builtins only: no dropbox.py, no
+# Python at all. Otherwise it falls back to `dropbox status`.
+if [[ "${1:-}" == "healthcheck" ]]; then
+  MONITORING_ENABLED="${ENABLE_MONITORING:-false}"
+  if [[ "${MONITORING_ENABLED,,}" == "true" ]]; then
+    exec 3<>/dev/tcp/127.0.0.1/8001 || exit 1
+    printf 'GET /health HTTP/1.0\r\nHost: localhost\r\n\r\n' >&3
+    read -r -t 5 _ HEALTH_CODE _ <&3 || exit 1
+    # Skip the headers and show the body in `docker inspect`
+    while IFS= read -r -t 5 HEALTH_LINE <&3 && [[ "${HEALTH_LINE}" != $'\r' ]]; do :; done
+    # The body has no trailing newline, so this read "fails" at EOF
+    IFS= read -r -t 5 HEALTH_LINE <&3 || true
+    echo "${HEALTH_LINE}"
+    [[ "${HEALTH_CODE}" == "200" ]] || exit 1
+    exit 0
+  fi
+  gosu dropbox dropbox status | head -1 || exit 1
+  exit 0
+fi
+
 # --- Timezone Configuration ---
 if [ -z "${TZ:-}" ]; then
   TZ="$(cat /etc/timezone 2>/dev/null || echo 'UTC')"
@@ -75,25 +99,63 @@ if [[ ! "${POLLING_INTERVAL}" =~ ^[0-9]+$ ]]; then
   echo "POLLING_INTERVAL not set to a valid number, defaulting to 5"
   export POLLING_INTERVAL=5
 fi
+if [[ ! "${MAX_POLLING_INTERVAL:-60}" =~ ^[0-9]+$ ]]; then
+  echo "MAX_POLLING_INTERVAL not set to a valid number, defaulting to 60"
+  export MAX_POLLING_INTERVAL=60
+fi
+if [[ ! "${FOLDER_SCAN_INTERVAL:-900}" =~ ^[0-9]+$ ]]; then
+  echo "FOLDER_SCAN_INTERVAL not set to a valid number, defaulting to 900"
+  export FOLDER_SCAN_INTERVAL=900
+fi
+if [[ ! "${ANALYTICS_CACHE_LIMIT_MB:-1024}" =~ ^[0-9]+$ ]]; then
+  echo "ANALYTICS_CACHE_LIMIT_MB not set to a valid number, defaulting to 1024"
+  export ANALYTICS_CACHE_LIMIT_MB=1024
+fi
+if [[ ! "${SYNC_PROBE_INTERVAL:-300}" =~ ^[0-9]+$ ]] || [[ "${SYNC_PROBE_INTERVAL:-300}" -eq 0 ]]; then
+  echo "SYNC_PROBE_INTERVAL not set to a valid number, defaulting to 300"
+  export SYNC_PROBE_INTERVAL=300
+fi
+if [[ ! "${HEALTH_UNSYNCED_AFTER:-86400}" =~ ^[0-9]+$ ]]; then
+  echo "HEALTH_UNSYNCED_AFTER not set to a valid number, defaulting to 86400"
+  export HEALTH_UNSYNCED_AFTER=86400
+fi
 
 # Set dropbox account's UID/GID
 usermod -u "${DROPBOX_UID}" -g "${DROPBOX_GID}" --non-unique dropbox > /dev/null 2>&1
 
 # --- Permissions ---
 SKIP_PERMS=$(echo "${SKIP_SET_PERMISSIONS:-true}" | tr '[:upper:]' '[:lower:]' | tr -d " ")
-if [[ "$SKIP_PERMS" == "true" ]]; then
-  echo "Skipping recursive permission check (SKIP_SET_PERMISSIONS=true)"
+PERMS_IN_BACKGROUND=$(echo "${SET_PERMISSIONS_IN_BACKGROUND:-false}" | tr '[:upper:]' '[:lower:]' | tr -d " ")
+if [[ "$SKIP_PERMS" == "true" ]] || [[ "$PERMS_IN_BACKGROUND" == "true" ]]; then
+  # The daemon's own state must be usable before it starts
   chown "${DROPBOX_UID}:${DROPBOX_GID}" /opt/dropbox
   [[ -d /opt/dropbox/.dropbox ]] && chown -R "${DROPBOX_UID}:${DROPBOX_GID}" /opt/dropbox/.dropbox
   [[ -d /opt/dropbox/bin ]]      && chown -R "${DROPBOX_UID}:${DROPBOX_GID}" /opt/dropbox/bin
+fi
+# Parallel pass that only chowns entries that need it. It checkpoints its
+# progress, so a restarted container resumes instead of starting over.
+PERMISSION_ARGS=(initial --uid "${DROPBOX_UID}" --gid "${DROPBOX_GID}" --root /opt/dropbox)
+if [[ "$SKIP_PERMS" == "true" ]]; then
+  echo "Skipping recursive permission check (SKIP_SET_PERMISSIONS=true)"
+elif [[ "$PERMS_IN_BACKGROUND" == "true" ]]; then
+  echo "Setting permissions on all files in the background (SET_PERMISSIONS_IN_BACKGROUND=true)..."
+  python3 /ownership.py "${PERMISSION_ARGS[@]}" &
 else
-  echo "Setting permissions on all files (this may take a long time for large folders)..."
-  echo "Set SKIP_SET_PERMISSIONS=true to skip this step."
-  chown -R "${DROPBOX_UID}:${DROPBOX_GID}" /opt/dropbox
+  echo "Setting permissions on all files (progress is logged, an interrupted pass resumes on restart)..."
+  echo "Set SKIP_SET_PERMISSIONS=true to skip this step, or SET_PERMISSIONS_IN_BACKGROUND=true to not wait for it."
+  python3 /ownership.py "${PERMISSION_ARGS[@]}" || echo "WARNING: Permission pass did not complete"
 fi
 
 [[ -d /opt/dropbox/Dropbox ]] && chmod 755 /opt/dropbox/Dropbox
 
+# Checkpoints, the monitor's state journal and folder index; the monitor runs
+# as the dropbox user (as root with DROPBOX_SUPERVISOR=python)
+mkdir -p /opt/dropbox/.dropbox-docker
+chown "${DROPBOX_UID}:${DROPBOX_GID}" /opt/dropbox/.dropbox-docker
+for state_file in /opt/dropbox/.dropbox-docker/monitor.journal /opt/dropbox/.dropbox-docker/folders.sqlite*; do
+  [[ -f "${state_file}" ]] && chown "${DROPBOX_UID}:${DROPBOX_GID}" "${state_file}"
+done
+
 # --- Clean Stale Files ---
 rm -f /opt/dropbox/.dropbox/command_socket \
       /opt/dropbox/.dropbox/iface_socket \
@@ -213,7 +275,11 @@ umask 002
 
 # --- Signal Handler ---
 DROPBOX_PID=""
+OWNERSHIP_PID=""
 cleanup() {
+  if [[ -n "${OWNERSHIP_PID}" ]]; then
+    kill -SIGTERM "${OWNERSHIP_PID}" 2>/dev/null
+  fi
   echo "Received shutdown signal. Stopping Dropbox daemon (PID: ${DROPBOX_PID})..."
   kill -SIGTERM "${DROPBOX_PID}" 2>/dev/null
   wait "${DROPBOX_PID}" 2>/dev/null
@@ -222,40 +288,79 @@ cleanup() {
 }
 trap cleanup SIGTERM SIGINT SIGHUP SIGQUIT
 
-# --- Start Dropbox ---
+MONITORING_ENABLED=$(echo "${ENABLE_MONITORING:-false}" | tr '[:upper:]' '[:lower:]' | tr -d " ")
+
+# --- Start Ownership Fixer ---
+# Files created by other users (e.g. root via SSH) won't sync until owned by
+# the dropbox user. The fixer runs as root, repairs new entries as inotify
+# reports them and only rescans the whole tree every few hours.
+OWNERSHIP_ARGS=(watch --uid "${DROPBOX_UID}" --gid "${DROPBOX_GID}")
+if [[ "${MONITORING_ENABLED}" == "true" ]]; then
+  OWNERSHIP_ARGS+=(--metrics-port 8002)
+fi
+python3 /ownership.py "${OWNERSHIP_ARGS[@]}" & OWNERSHIP_PID="$!"
+echo "Ownership fixer started (PID: ${OWNERSHIP_PID})"
+
 echo "Starting dropboxd ($(cat /opt/dropbox/bin/VERSION 2>/dev/null || echo 'unknown'))..."
+
+# Settings shared by the monitor in both supervisor modes
+MONITOR_ARGS=(-i "${POLLING_INTERVAL}" --max_poll_interval_sec "${MAX_POLLING_INTERVAL:-60}"
+  --folder-scan-interval "${FOLDER_SCAN_INTERVAL:-900}" --cache-limit-mb "${ANALYTICS_CACHE_LIMIT_MB:-1024}"
+  --health-unsynced-after "${HEALTH_UNSYNCED_AFTER:-86400}")
+if [[ -n "${SYNC_PROBE_DIR:-}" ]]; then
+  MONITOR_ARGS+=(--sync-probe-dir "${SYNC_PROBE_DIR}" --sync-probe-interval "${SYNC_PROBE_INTERVAL:-300}")
+fi
+
+# --- Python Supervisor (Optional) ---
+# One process launches and restarts dropboxd, and serves monitoring from the
+# same status snapshot it logs. It runs as root (for lock_analytics); the
+# daemon itself still runs as the dropbox user via gosu, and so do the
+# monitor's dropbox CLI calls (--uid/--gid).
+if [[ $(echo "${DROPBOX_SUPERVISOR:-bash}" | tr '[:upper:]' '[:lower:]' | tr -d " ") == "python" ]]; then
+  SUPERVISOR_ARGS=(--supervise "${MONITOR_ARGS[@]}" --max-restarts "${DROPBOX_MAX_RESTARTS}" --restart-delay "${DROPBOX_RESTART_DELAY}"
+    --uid "${DROPBOX_UID}" --gid "${DROPBOX_GID}")
+  if [[ "${MONITORING_ENABLED}" == "true" ]]; then
+    echo "Starting Prometheus metrics on port 8000 and status API on port 8001..."
+    SUPERVISOR_ARGS+=(--status-port 8001)
+  else
+    SUPERVISOR_ARGS+=(--no-servers)
+  fi
+  python3 /monitoring.py "${SUPERVISOR_ARGS[@]}" -- gosu dropbox "$@" & DROPBOX_PID="$!"
+  SUPERVISOR_EXIT=0
+  wait "${DROPBOX_PID}" || SUPERVISOR_EXIT=$?
+  kill -SIGTERM "${OWNERSHIP_PID}" 2>/dev/null || true
+  exit "${SUPERVISOR_EXIT}"
+fi
+
+# --- Start Dropbox ---
 gosu dropbox "$@" & DROPBOX_PID="$!"
 
 # --- Start Monitoring (Optional) ---
-if [[ $(echo "${ENABLE_MONITORING:-false}" | tr '[:upper:]' '[:lower:]' | tr -d " ") == "true" ]]; then
+if [[ "${MONITORING_ENABLED}" == "true" ]]; then
   echo "Starting Prometheus metrics on port 8000 and status API on port 8001..."
-  gosu dropbox python3 /monitoring.py -i "${POLLING_INTERVAL}" --status-port 8001 &
+  gosu dropbox python3 /monitoring.py "${MONITOR_ARGS[@]}" --status-port 8001 &
   echo "Monitoring started (PID: $!)"
 fi
 
 # --- Wait for Daemon Startup ---
+# Wakes up as soon as info.json or command_socket appears (inotify), rather
+# than polling for them. Run in the background so signals are still handled.
 echo "Waiting for Dropbox daemon to initialize (timeout: ${DROPBOX_STARTUP_TIMEOUT}s)..."
-STARTUP_ELAPSED=0
-while [[ $STARTUP_ELAPSED -lt ${DROPBOX_STARTUP_TIMEOUT} ]]; do
-  if [[ -f "/opt/dropbox/.dropbox/info.json" ]] || \
-     [[ -S "/opt/dropbox/.dropbox/command_socket" ]]; then
-    echo "Dropbox daemon is ready (took ${STARTUP_ELAPSED}s)"
-    break
-  fi
-  if ! kill -0 "${DROPBOX_PID}" 2>/dev/null; then
-    echo "WARNING: Dropbox daemon exited during startup"
-    break
-  fi
-  sleep 2
-  STARTUP_ELAPSED=$((STARTUP_ELAPSED + 2))
-done
-if [[ $STARTUP_ELAPSED -ge ${DROPBOX_STARTUP_TIMEOUT} ]]; then
+STARTUP_STARTED=${SECONDS}
+READY_EXIT=0
+python3 /monitoring.py --wait-ready --ready-timeout "${DROPBOX_STARTUP_TIMEOUT}" --pid "${DROPBOX_PID}" &
+wait "$!" || READY_EXIT=$?
+STARTUP_ELAPSED=$((SECONDS - STARTUP_STARTED))
+if [[ ${READY_EXIT} -eq 0 ]]; then
+  echo "Dropbox daemon is ready (took ${STARTUP_ELAPSED}s)"
+elif [[ ${READY_EXIT} -eq 2 ]]; then
+  echo "WARNING: Dropbox daemon exited during startup"
+else
   echo "WARNING: Startup timeout reached (${DROPBOX_STARTUP_TIMEOUT}s). Continuing anyway..."
 fi
 
 # --- Main Supervision Loop ---
 RESTART_COUNT=0
-OWNERSHIP_CHECK_COUNTER=0
 while true; do
   if kill -0 "${DROPBOX_PID}" 2>/dev/null; then
     # Daemon is running
@@ -263,14 +368,6 @@ while true; do
       gosu dropbox dropbox status 2>/dev/null || true
     fi
 
-    # Fix ownership on Dropbox folder periodically (every 12 cycles ~= every 6 min at default 30s interval)
-    # Files created by other users (e.g. root via SSH) won't sync until owned by the dropbox user
-    OWNERSHIP_CHECK_COUNTER=$((OWNERSHIP_CHECK_COUNTER + 1))
-    if [[ $OWNERSHIP_CHECK_COUNTER -ge 12 ]]; then
-      find /opt/dropbox/Dropbox -not -user "${DROPBOX_UID}" -exec chown "${DROPBOX_UID}:${DROPBOX_GID}" {} + 2>/dev/null || true
-      OWNERSHIP_CHECK_COUNTER=0
-    fi
-
     # Clean old temp files (scoped to dropbox temp dirs only)
     /usr/bin/find /tmp/ -maxdepth 1 -type d -name 'dropbox*' -mtime +1 -exec rm -rf {} \; 2>/dev/null || true
 
@@ -1,18 +1,92 @@
 from argparse import ArgumentParser
+from array import array
+from collections import OrderedDict, deque
 from enum import Enum
 from functools import partial
-from http.server import HTTPServer, BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from contextlib import nullcontext
+import ctypes
+import ctypes.util
+import gzip
+import hmac
 import json
 import logging
 import os
+import platform
 import re
+import select
+import shutil
 import signal
+import socket
+import sqlite3
+import struct
 import subprocess
-from threading import Thread, Event
-from time import time
-from typing import Optional
+import sys
+import zlib
+from threading import Condition, Thread, Event, Lock, get_ident, get_native_id
+from threading import enumerate as enumerate_threads
+from time import monotonic, sleep, time
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Sequence, Tuple
+from urllib.parse import parse_qs, urlsplit
 
-from prometheus_client import start_http_server, Enum as EnumMetric, Gauge  # type: ignore
+from prometheus_client import (  # type: ignore
+    start_http_server,
+    CollectorRegistry,
+    Counter,
+    Enum as EnumMetric,
+    Gauge,
+    Histogram,
+    REGISTRY,
+)
+from prometheus_client.core import (  # type: ignore
+    CounterMetricFamily,
+    GaugeMetricFamily,
+    Metric as MetricFamily,
+)
+
+
+DROPBOX_HOME = "/opt/dropbox"
+COMMAND_SOCKET = os.path.join(DROPBOX_HOME, ".dropbox", "command_socket")
+INFO_JSON = os.path.join(DROPBOX_HOME, ".dropbox", "info.json")
+VERSION_FILE = os.path.join(DROPBOX_HOME, "bin", "VERSION")
+PID_FILE = os.path.join(DROPBOX_HOME, ".dropbox", "dropbox.pid")
+# State this container keeps on the volume (checkpoints, journals, indexes)
+STATE_DIR = os.path.join(DROPBOX_HOME, ".dropbox-docker")
+SYNC_ROOT = os.path.join(DROPBOX_HOME, "Dropbox")
+JOURNAL_FILE = os.path.join(STATE_DIR, "monitor.journal")
+FOLDER_INDEX_FILE = os.path.join(STATE_DIR, "folders.sqlite")
+# How often "still up to date" is written to the journal
+JOURNAL_SYNC_INTERVAL_SEC = 60
+
+# Left behind by a daemon that didn't exit cleanly; they block the next start
+STALE_FILES = ("command_socket", "iface_socket", "unlink.db", "dropbox.pid")
+# Analytics caches that can grow to several GB and crash the daemon
+ANALYTICS_DIRS = ("events", "ssa_events", "sentry_exceptions")
+# What the cache watchdog counts against its limit; metrics/ holds store.bin
+ANALYTICS_CACHE_DIRS = ANALYTICS_DIRS + ("metrics",)
+
+# Multipliers for the rate and ETA units used in `dropbox status` output
+RATE_UNITS = {"B": 1, "KB": 1024, "MB": 1024 ** 2, "GB": 1024 ** 3}
+DURATION_UNITS = {"sec": 1, "min": 60, "hr": 3600, "hour": 3600, "day": 86400}
+
+# A `dropbox` CLI call that takes longer than this is killed
+CLI_TIMEOUT_SEC = 30
+# Paths per `dropbox filestatus` call or pipelined command_socket batch
+FILE_STATUS_BATCH = 100
+
+# Smaller API responses aren't worth gzipping
+GZIP_MIN_BYTES = 1024
+
+# Largest request body and number of paths the /exclude API accepts
+MAX_REQUEST_BYTES = 4 * 1024 * 1024
+MAX_EXCLUDE_PATHS = 10000
+
+# Longest capture /debug/profile will run, and how often it samples
+PROFILE_MAX_SECONDS = 60
+PROFILE_INTERVAL_SEC = 0.01
+
+# /status/<name> paths that aren't instances, so no instance may use them
+STATUS_SUBPATHS = ("history", "errors", "tree", "stream")
 
 
 class Metric(Enum):
@@ -21,6 +95,12 @@ class Metric(Enum):
     NUM_UPLOADING = "num_uploading"
 
 
+class Direction(Enum):
+    SYNC = "sync"
+    DOWNLOAD = "download"
+    UPLOAD = "upload"
+
+
 class State(Enum):
     STARTING = "starting"
     SYNCING = "syncing"
@@ -31,19 +111,1007 @@ class State(Enum):
     UNKNOWN = "unknown"
 
 
+class StatusSnapshot(NamedTuple):
+    """
+    Immutable view of the latest Dropbox status.
+
+    The sampler thread builds a new snapshot on every refresh and swaps it in
+    with a single attribute assignment, so readers (Prometheus collectors and
+    the status API) never block on the daemon and never see a half-update.
+    """
+
+    state: State
+    raw_status: str
+    num_syncing: Optional[int]
+    num_downloading: Optional[int]
+    num_uploading: Optional[int]
+    last_error: Optional[str]
+    last_sync_time: Optional[float]
+    taken_at: float
+    refresh_duration: float
+    sync_rate: Optional[float] = None
+    download_rate: Optional[float] = None
+    upload_rate: Optional[float] = None
+    eta_seconds: Optional[int] = None
+
+    daemon: Optional["DaemonProcessStats"] = None
+
+    def transfer_rate(self, direction: Direction) -> Optional[float]:
+        """Bytes/sec reported for ``direction``, or None if not reported."""
+        return getattr(self, direction.value + "_rate")
+
+
+class StatusCache:
+    """
+    Bounded cache for the slow, rarely-changing fields of /status.
+
+    File-backed entries are keyed on the file's (mtime, inode, size), so an
+    atomic replace of info.json or an in-place update of VERSION is picked
+    up on the next read without re-reading the file every time. Other
+    entries expire after a TTL or when invalidated explicitly. Least
+    recently used entries are evicted once ``max_entries`` is reached.
+    """
+
+    def __init__(self, max_entries: int = 64, default_ttl: float = 60.0) -> None:
+        self.max_entries = max_entries
+        self.default_ttl = default_ttl
+        self.hits = {}  # type: Dict[str, int]
+        self.misses = {}  # type: Dict[str, int]
+        self._entries = OrderedDict()  # type: OrderedDict
+        self._lock = Lock()
+
+    def get_file(self, key: str, path: str, loader: Callable[[], Any]) -> Any:
+        """Return ``loader()``, re-running it only when ``path`` changed."""
+        try:
+            st = os.stat(path)
+            signature = (st.st_mtime_ns, st.st_ino, st.st_size)  # type: Any
+        except OSError:
+            signature = None
+        return self._get(key, lambda entry: entry[0] == signature, loader, signature)
+
+    def get_ttl(
+        self, key: str, loader: Callable[[], Any], ttl: Optional[float] = None
+    ) -> Any:
+        """Return ``loader()``, re-running it once the entry is ``ttl`` seconds old."""
+        now = monotonic()
+        ttl = self.default_ttl if ttl is None else ttl
+        return self._get(key, lambda entry: now - entry[0] < ttl, loader, now)
+
+    def set(self, key: str, value: Any) -> None:
+        """Store a value directly, e.g. after a mutation whose result is known."""
+        with self._lock:
+            self._store(key, monotonic(), value)
+
+    def update(self, key: str, change: Callable[[Any], Any]) -> bool:
+        """
+        Replace a cached TTL entry with ``change(value)``, restarting its TTL.
+        Returns False (and loads nothing) if the key isn't cached.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return False
+            self._store(key, monotonic(), change(entry[1]))
+            return True
+
+    def invalidate(self, key: str) -> None:
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        with self._lock:
+            keys = set(self.hits) | set(self.misses)
+            return {
+                key: {"hits": self.hits.get(key, 0), "misses": self.misses.get(key, 0)}
+                for key in keys
+            }
+
+    def _get(self, key, is_fresh, loader, stamp):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and is_fresh(entry):
+                self._entries.move_to_end(key)
+                self.hits[key] = self.hits.get(key, 0) + 1
+                return entry[1]
+            self.misses[key] = self.misses.get(key, 0) + 1
+
+        # Load outside the lock so one slow loader doesn't stall other keys
+        value = loader()
+        if value is not None:
+            with self._lock:
+                self._store(key, stamp, value)
+        return value
+
+    def _store(self, key, stamp, value):
+        self._entries[key] = (stamp, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+
+# Column name and array typecode of every history sample. Counts and RSS
+# use -1 for "unknown"; rates use NaN.
+HISTORY_COLUMNS = (
+    ("time", "d"),
+    ("state", "b"),
+    ("syncing", "i"),
+    ("downloading", "i"),
+    ("uploading", "i"),
+    ("sync_rate", "f"),
+    ("download_rate", "f"),
+    ("upload_rate", "f"),
+    ("rss_bytes", "q"),
+)
+STATE_CODES = {state: code for code, state in enumerate(State)}
+STATES_BY_CODE = list(State)
+
+
+class HistoryRing:
+    """Fixed-capacity ring of samples, stored column-wise in ``array``s."""
+
+    def __init__(self, step: float, capacity: int) -> None:
+        self.step = step
+        self.capacity = capacity
+        self.columns = [array(code, [0]) * capacity for _, code in HISTORY_COLUMNS]
+        self.start = 0
+        self.size = 0
+
+    def append(self, row: Tuple) -> None:
+        if self.size < self.capacity:
+            index = (self.start + self.size) % self.capacity
+            self.size += 1
+        else:
+            index = self.start
+            self.start = (self.start + 1) % self.capacity
+        for column, value in zip(self.columns, row):
+            column[index] = value
+
+    def rows(self, since: float = 0.0):
+        times = self.columns[0]
+        for i in range(self.size):
+            index = (self.start + i) % self.capacity
+            if times[index] >= since:
+                yield tuple(column[index] for column in self.columns)
+
+    def oldest(self) -> Optional[float]:
+        return self.columns[0][self.start] if self.size else None
+
+    def covers(self, since: float) -> bool:
+        """Whether nothing newer than ``since`` has been overwritten."""
+        return self.size < self.capacity or self.columns[0][self.start] <= since
+
+    def memory_bytes(self) -> int:
+        return sum(column.itemsize * len(column) for column in self.columns)
+
+
+class _HistoryBucket:
+    """Accumulates the samples of one downsampled interval."""
+
+    def __init__(self, start: float) -> None:
+        self.start = start
+        self.count = 0
+        self.state = 0
+        self.maxima = [-1, -1, -1]
+        self.rate_sums = [0.0, 0.0, 0.0]
+        self.rate_counts = [0, 0, 0]
+        self.rss = -1
+
+    def add(self, row: Tuple) -> None:
+        self.count += 1
+        # The last state wins; counts and RSS keep their peak; rates are averaged
+        self.state = row[1]
+        for i in range(3):
+            self.maxima[i] = max(self.maxima[i], row[2 + i])
+            rate = row[5 + i]
+            if rate == rate:  # not NaN
+                self.rate_sums[i] += rate
+                self.rate_counts[i] += 1
+        self.rss = max(self.rss, row[8])
+
+    def row(self) -> Tuple:
+        rates = [
+            total / count if count else float("nan")
+            for total, count in zip(self.rate_sums, self.rate_counts)
+        ]
+        return (self.start, self.state, *self.maxima, *rates, self.rss)
+
+
+class StatusHistory:
+    """
+    Recent status samples at several resolutions, in bounded memory.
+
+    Every sample goes into the finest ring; coarser rings receive one
+    downsampled row per ``step`` seconds (last state, peak counts and RSS,
+    mean rates). With the default levels that is the last 1024 samples,
+    24 hours at one-minute resolution and 7 days at 15 minutes, in well
+    under 200 KB.
+    """
+
+    LEVELS = ((0, 1024), (60, 1440), (900, 672))
+
+    def __init__(self, levels: Sequence[Tuple[float, int]] = LEVELS) -> None:
+        self.rings = [HistoryRing(step, capacity) for step, capacity in levels]
+        self._buckets = [None] * len(self.rings)  # type: List[Optional[_HistoryBucket]]
+        self._lock = Lock()
+
+    def record(self, snapshot: "StatusSnapshot") -> None:
+        daemon = snapshot.daemon
+        row = (
+            snapshot.taken_at,
+            STATE_CODES[snapshot.state],
+            _or_unknown(snapshot.num_syncing),
+            _or_unknown(snapshot.num_downloading),
+            _or_unknown(snapshot.num_uploading),
+            _or_nan(snapshot.sync_rate),
+            _or_nan(snapshot.download_rate),
+            _or_nan(snapshot.upload_rate),
+            daemon.rss_bytes if daemon else -1,
+        )
+        with self._lock:
+            self._add(row)
+
+    def record_state(self, timestamp: float, state: State) -> None:
+        """Record a state without counts, e.g. a transition replayed from the journal."""
+        with self._lock:
+            self._add((timestamp, STATE_CODES[state], -1, -1, -1, *[float("nan")] * 3, -1))
+
+    def _add(self, row: Tuple) -> None:
+        for level, ring in enumerate(self.rings):
+            if not ring.step:
+                ring.append(row)
+                continue
+            bucket = self._buckets[level]
+            start = row[0] - row[0] % ring.step
+            if bucket is not None and bucket.start != start:
+                ring.append(bucket.row())
+                bucket = None
+            if bucket is None:
+                bucket = self._buckets[level] = _HistoryBucket(start)
+            bucket.add(row)
+
+    def query(self, since: float = 0.0, step: float = 0.0) -> dict:
+        """
+        Samples newer than ``since`` from the finest ring that still holds
+        all of them, re-aggregated to ``step`` seconds when that is coarser.
+        """
+        with self._lock:
+            level = next(
+                (i for i, ring in enumerate(self.rings) if ring.covers(since)),
+                len(self.rings) - 1,
+            )
+            ring = self.rings[level]
+            rows = list(ring.rows(since))
+            bucket = self._buckets[level]
+            if bucket is not None and bucket.start >= since:
+                rows.append(bucket.row())
+
+        resolution = ring.step
+        if step > resolution:
+            rows = self._downsample(rows, step)
+            resolution = step
+        points = {name: [] for name, _ in HISTORY_COLUMNS}  # type: Dict[str, list]
+        for row in rows:
+            points["time"].append(round(row[0], 3))
+            points["state"].append(STATES_BY_CODE[row[1]].value)
+            for i, (name, code) in enumerate(HISTORY_COLUMNS[2:], 2):
+                value = row[i]
+                if code == "f":
+                    points[name].append(None if value != value else round(value, 1))
+                else:
+                    points[name].append(None if value < 0 else value)
+        return {
+            "since": since,
+            "step": resolution,
+            "count": len(rows),
+            "points": points,
+        }
+
+    @staticmethod
+    def _downsample(rows: List[Tuple], step: float) -> List[Tuple]:
+        result = []
+        bucket = None  # type: Optional[_HistoryBucket]
+        for row in rows:
+            start = row[0] - row[0] % step
+            if bucket is not None and bucket.start != start:
+                result.append(bucket.row())
+                bucket = None
+            if bucket is None:
+                bucket = _HistoryBucket(start)
+            bucket.add(row)
+        if bucket is not None:
+            result.append(bucket.row())
+        return result
+
+    def memory_bytes(self) -> int:
+        return sum(ring.memory_bytes() for ring in self.rings)
+
+    def stats(self) -> List[dict]:
+        with self._lock:
+            return [
+                {
+                    "step": ring.step,
+                    "capacity": ring.capacity,
+                    "size": ring.size,
+                    "oldest": ring.oldest(),
+                    "memory_bytes": ring.memory_bytes(),
+                }
+                for ring in self.rings
+            ]
+
+
+def _or_unknown(value: Optional[int]) -> int:
+    return -1 if value is None else value
+
+
+def _or_nan(value: Optional[float]) -> float:
+    return float("nan") if value is None else value
+
+
+class JournalRecord(NamedTuple):
+    kind: int
+    timestamp: float
+    payload: bytes = b""
+
+
+class StateJournal:
+    """
+    Append-only binary journal of state transitions, so ``last_sync``,
+    ``last_error`` and the state timeline survive restarts.
+
+    Each record is a 11-byte header (kind, timestamp, payload length), the
+    payload and a CRC32. A record torn by a crash mid-write fails its CRC
+    and is cut off on replay. Appends are buffered and fsynced at most every
+    ``fsync_interval_sec``. When the file outgrows ``max_bytes`` it is
+    rewritten with just the latest start, sync and error records plus the
+    last ``keep_transitions`` state changes.
+    """
+
+    MAGIC = b"DBXJ\x01"
+    START = 1
+    STATE = 2
+    SYNC = 3
+    ERROR = 4
+    MAX_PAYLOAD = 1024
+
+    _HEADER = struct.Struct("<BdH")
+    _CRC = struct.Struct("<I")
+
+    def __init__(
+        self,
+        path: str,
+        max_bytes: int = 1024 * 1024,
+        fsync_interval_sec: float = 5.0,
+        keep_transitions: int = 4096,
+    ) -> None:
+        self.path = path
+        self.max_bytes = max_bytes
+        self.fsync_interval_sec = fsync_interval_sec
+        self.size = 0
+        self.compactions = 0
+        self._file = None  # type: Optional[Any]
+        self._latest = {}  # type: Dict[int, JournalRecord]
+        self._transitions = deque(maxlen=keep_transitions)  # type: deque
+        self._dirty = False
+        self._last_fsync = monotonic()
+        self._lock = Lock()
+
+    def replay(self) -> List[JournalRecord]:
+        """Read back every intact record and open the journal for appending."""
+        try:
+            with open(self.path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            data = b""
+        records, valid = self._decode(data)
+        for record in records:
+            self._remember(record)
+
+        if valid == 0:
+            self._rewrite([])
+        else:
+            if valid < len(data):
+                # Drop a torn tail so new records aren't appended after garbage
+                with open(self.path, "r+b") as f:
+                    f.truncate(valid)
+            self._file = open(self.path, "ab")
+            self.size = valid
+        return records
+
+    def append(self, kind: int, timestamp: float, payload: bytes = b"") -> None:
+        record = JournalRecord(kind, timestamp, payload[: self.MAX_PAYLOAD])
+        with self._lock:
+            if self._file is None:
+                return
+            self._remember(record)
+            encoded = self._encode(record)
+            self._file.write(encoded)
+            self.size += len(encoded)
+            self._dirty = True
+            if self.size > self.max_bytes:
+                self._compact()
+
+    def flush(self, force: bool = False) -> None:
+        """fsync pending appends if ``fsync_interval_sec`` has passed (or ``force``)."""
+        with self._lock:
+            if self._file is None or not self._dirty:
+                return
+            if not force and monotonic() - self._last_fsync < self.fsync_interval_sec:
+                return
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._dirty = False
+            self._last_fsync = monotonic()
+
+    def close(self) -> None:
+        self.flush(force=True)
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def _remember(self, record: JournalRecord) -> None:
+        if record.kind == self.STATE:
+            self._transitions.append(record)
+        else:
+            self._latest[record.kind] = record
+
+    def _compact(self) -> None:
+        records = sorted(
+            list(self._latest.values()) + list(self._transitions), key=lambda r: r.timestamp
+        )
+        self._file.close()
+        self._rewrite(records)
+        self.compactions += 1
+
+    def _rewrite(self, records: List[JournalRecord]) -> None:
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        data = self.MAGIC + b"".join(self._encode(record) for record in records)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+        self._file = open(self.path, "ab")
+        self.size = len(data)
+        self._dirty = False
+
+    def _encode(self, record: JournalRecord) -> bytes:
+        body = self._HEADER.pack(record.kind, record.timestamp, len(record.payload)) + record.payload
+        return body + self._CRC.pack(zlib.crc32(body))
+
+    def _decode(self, data: bytes) -> Tuple[List[JournalRecord], int]:
+        """Return the intact records and the length of the valid prefix."""
+        if not data.startswith(self.MAGIC):
+            return [], 0
+        records = []
+        offset = len(self.MAGIC)
+        header_size, crc_size = self._HEADER.size, self._CRC.size
+        while offset + header_size <= len(data):
+            kind, timestamp, length = self._HEADER.unpack_from(data, offset)
+            end = offset + header_size + length
+            if end + crc_size > len(data):
+                break
+            (crc,) = self._CRC.unpack_from(data, end)
+            if crc != zlib.crc32(data[offset:end]):
+                break
+            records.append(JournalRecord(kind, timestamp, data[offset + header_size:end]))
+            offset = end + crc_size
+        return records, offset
+
+
+class InotifyEvent(NamedTuple):
+    wd: int
+    mask: int
+    cookie: int
+    name: str
+
+
+class Inotify:
+    """
+    Minimal inotify(7) binding over ctypes, so watching the sync folder
+    doesn't need a third-party package in the image.
+    """
+
+    IN_MODIFY = 0x00000002
+    IN_ATTRIB = 0x00000004
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_DELETE_SELF = 0x00000400
+    IN_MOVE_SELF = 0x00000800
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    IN_ONLYDIR = 0x01000000
+    IN_DONT_FOLLOW = 0x02000000
+    IN_ISDIR = 0x40000000
+
+    _IN_NONBLOCK = os.O_NONBLOCK
+    _IN_CLOEXEC = os.O_CLOEXEC
+    _HEADER = struct.Struct("iIII")
+
+    def __init__(self) -> None:
+        self._libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        fd = self._libc.inotify_init1(self._IN_NONBLOCK | self._IN_CLOEXEC)
+        if fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        self.fd = fd
+        self._poller = select.poll()
+        self._poller.register(fd, select.POLLIN)
+
+    def fileno(self) -> int:
+        return self.fd
+
+    def add_watch(self, path: str, mask: int) -> int:
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(path), ctypes.c_uint32(mask))
+        if wd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno), path)
+        return wd
+
+    def rm_watch(self, wd: int) -> None:
+        self._libc.inotify_rm_watch(self.fd, wd)
+
+    def read(self, timeout: Optional[float] = None) -> List[InotifyEvent]:
+        """Wait up to ``timeout`` seconds for events and return them."""
+        if not self._poller.poll(None if timeout is None else int(timeout * 1000)):
+            return []
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = self._HEADER.unpack_from(data, offset)
+            offset += self._HEADER.size
+            name = data[offset:offset + length].rstrip(b"\0")
+            offset += length
+            events.append(InotifyEvent(wd, mask, cookie, os.fsdecode(name)))
+        return events
+
+    def close(self) -> None:
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+
+class PollScheduler:
+    """
+    Picks the delay before the next status poll.
+
+    While Dropbox stays up to date the interval grows by ``backoff`` on every
+    poll until it reaches ``ceiling``. Any other state (syncing, indexing,
+    errors, not running) and any change seen on disk drop it back to
+    ``floor`` so activity is picked up quickly.
+    """
+
+    def __init__(self, floor: float, ceiling: Optional[float] = None, backoff: float = 2.0) -> None:
+        self.floor = max(0.0, floor)
+        self.ceiling = self.floor if ceiling is None else max(self.floor, ceiling)
+        self.backoff = backoff
+        self.interval = self.floor
+
+    def update(self, state: State) -> float:
+        """Return the delay before polling again, given the latest state."""
+        if state == State.UP_TO_DATE:
+            self.interval = min(self.ceiling, max(self.floor, self.interval * self.backoff))
+        else:
+            self.interval = self.floor
+        return self.interval
+
+    def reset(self) -> None:
+        self.interval = self.floor
+
+
+class ChangeWatcher:
+    """
+    Calls ``on_change`` whenever inotify reports activity under ``paths``,
+    or one of the files in ``triggers`` (directory -> names) appearing.
+
+    inotify only reports changes to a directory's direct entries, so the
+    subtrees of ``paths`` are watched too, breadth first across all of them
+    and new directories as they appear, up to ``max_watches`` directories:
+    the daemon shares our user's inotify budget. Past that, changes deep in
+    a large sync folder only show up at the next scheduled poll. Trigger
+    directories are watched on their own, since the daemon rewrites its
+    databases there all the time, even when idle. Paths that don't exist
+    yet are retried every ``retry_interval`` seconds.
+    """
+
+    MASK = (
+        Inotify.IN_MODIFY
+        | Inotify.IN_CLOSE_WRITE
+        | Inotify.IN_CREATE
+        | Inotify.IN_DELETE
+        | Inotify.IN_MOVED_FROM
+        | Inotify.IN_MOVED_TO
+        | Inotify.IN_ONLYDIR
+    )
+    TRIGGER_MASK = Inotify.IN_CREATE | Inotify.IN_MOVED_TO | Inotify.IN_ONLYDIR
+
+    def __init__(
+        self,
+        paths: Sequence[str],
+        on_change: Callable[[], None],
+        logger: logging.Logger,
+        retry_interval: float = 30.0,
+        max_watches: int = 1024,
+        triggers: Optional[Dict[str, Sequence[str]]] = None,
+    ) -> None:
+        self.paths = list(paths)
+        self.on_change = on_change
+        self.logger = logger
+        self.retry_interval = retry_interval
+        self.max_watches = max_watches
+        self.triggers = {path: frozenset(names) for path, names in (triggers or {}).items()}
+        self._trigger_watches = {}  # type: Dict[int, str]
+        self.inotify = None  # type: Optional[Inotify]
+        self._watches = {}  # type: Dict[int, str]
+        self._full = False
+        self._next_retry = 0.0
+        self._stop_event = Event()
+        self._thread = None  # type: Optional[Thread]
+
+    def start(self) -> bool:
+        try:
+            self.inotify = Inotify()
+        except OSError as e:
+            self.logger.warning("inotify unavailable (%s), polling on a timer only", e)
+            return False
+        self._stop_event.clear()
+        self._thread = Thread(target=self._run, name="dropbox-watcher", daemon=True)
+        self._thread.start()
+        return True
+
+    def stop(self) -> None:
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+            self._thread = None
+        if self.inotify is not None:
+            self.inotify.close()
+            self.inotify = None
+
+    def _run(self) -> None:
+        while not self._stop_event.is_set():
+            if monotonic() >= self._next_retry:
+                self._add_watches()
+            changed = False
+            for event in self.inotify.read(1.0):
+                if event.mask & Inotify.IN_IGNORED:
+                    # Watched directory was removed; a top-level one is
+                    # re-added once it is back
+                    self._watches.pop(event.wd, None)
+                    self._trigger_watches.pop(event.wd, None)
+                    continue
+                if event.wd in self._trigger_watches:
+                    changed = changed or (
+                        event.name in self.triggers[self._trigger_watches[event.wd]]
+                    )
+                    continue
+                changed = True
+                parent = self._watches.get(event.wd)
+                if (
+                    parent is not None
+                    and event.mask & Inotify.IN_ISDIR
+                    and event.mask & (Inotify.IN_CREATE | Inotify.IN_MOVED_TO)
+                ):
+                    self._watch_trees([os.path.join(parent, event.name)])
+            if changed:
+                self.on_change()
+
+    def _add_watches(self) -> None:
+        self._next_retry = monotonic() + self.retry_interval
+        watched = set(self._watches.values())
+        missing = [path for path in self.paths if path not in watched]
+        if missing:
+            self._watch_trees(missing)
+        watched = set(self._trigger_watches.values())
+        for path in self.triggers:
+            if path in watched:
+                continue
+            try:
+                self._trigger_watches[self.inotify.add_watch(path, self.TRIGGER_MASK)] = path
+            except OSError as e:
+                self.logger.debug("Not watching %s yet: %s", path, e)
+
+    def _watch_trees(self, tops: List[str]) -> None:
+        queue = deque(tops)
+        while queue:
+            if len(self._watches) >= self.max_watches:
+                if not self._full:
+                    self._full = True
+                    self.logger.info(
+                        "Watching %d directories for changes, not all of them", self.max_watches
+                    )
+                return
+            path = queue.popleft()
+            try:
+                wd = self.inotify.add_watch(path, self.MASK | Inotify.IN_DONT_FOLLOW)
+                self._watches[wd] = path
+                with os.scandir(path) as entries:
+                    for entry in entries:
+                        if entry.is_dir(follow_symlinks=False):
+                            queue.append(entry.path)
+            except OSError as e:
+                self.logger.debug("Not watching %s yet: %s", path, e)
+
+
+class SingleFlight:
+    """
+    Collapses concurrent calls for the same key into a single execution.
+
+    The first caller runs ``fn``; everyone who asks for the same key while
+    it is running waits for that result instead of starting their own. A
+    first caller with a ``timeout`` runs ``fn`` on a worker thread so it can
+    give up without cancelling the shared call, and a later caller can
+    still pick up its result. Without one, ``fn`` runs on the caller's own
+    thread.
+    """
+
+    class _Call:
+        def __init__(self) -> None:
+            self.done = Event()
+            self.result = None  # type: Any
+            self.error = None  # type: Optional[BaseException]
+
+    def __init__(self) -> None:
+        self._lock = Lock()
+        self._calls = {}  # type: Dict[str, SingleFlight._Call]
+
+    def do(self, key: str, fn: Callable[[], Any], timeout: Optional[float] = None) -> Any:
+        """Run ``fn`` (or join the in-flight run) and return its result.
+
+        Raises TimeoutError if the result isn't ready within ``timeout``.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = SingleFlight._Call()
+
+        if leader and timeout is None:
+            self._run(key, call, fn)
+        elif leader:
+            Thread(
+                target=self._run, args=(key, call, fn), name="flight-" + key, daemon=True
+            ).start()
+        if not call.done.wait(timeout):
+            raise TimeoutError("%s did not complete within %ss" % (key, timeout))
+        if call.error is not None:
+            raise call.error
+        return call.result
+
+    def _run(self, key: str, call: "SingleFlight._Call", fn: Callable[[], Any]) -> None:
+        try:
+            call.result = fn()
+        except BaseException as e:
+            call.error = e
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+
+class QuerySlots:
+    """
+    Bounds how many monitors query their daemons at the same time.
+
+    A query that has held its slot for ``stuck_after`` seconds no longer
+    counts against ``workers``: the hung daemon keeps its thread, but the
+    other instances get the slot back.
+    """
+
+    def __init__(self, workers: int = 4, stuck_after: float = 10.0) -> None:
+        self.workers = workers
+        self.stuck_after = stuck_after
+        self._cond = Condition()
+        self._active = {}  # type: Dict[int, float]
+        self._next_token = 0
+
+    def acquire(self) -> int:
+        with self._cond:
+            while True:
+                now = monotonic()
+                running = [t for t in self._active.values() if now - t < self.stuck_after]
+                if len(running) < self.workers:
+                    break
+                # Wake up when the oldest running query turns stuck, or on release
+                self._cond.wait(min(running) + self.stuck_after - now)
+            self._next_token += 1
+            self._active[self._next_token] = now
+            return self._next_token
+
+    def release(self, token: int) -> None:
+        with self._cond:
+            del self._active[token]
+            self._cond.notify()
+
+    def stuck(self) -> int:
+        """Queries currently running for longer than ``stuck_after``."""
+        now = monotonic()
+        with self._cond:
+            return sum(1 for t in self._active.values() if now - t >= self.stuck_after)
+
+
+class StatusEvent(NamedTuple):
+    id: int
+    event: str
+    data: dict
+
+
+class StatusEventBus:
+    """
+    Fans status changes out to /status/stream subscribers.
+
+    The last ``capacity`` events are kept so a reconnecting client can resume
+    from its ``Last-Event-ID``. Ids start at the current time in milliseconds,
+    so ids handed out by an earlier monitor process are never mistaken for
+    recent ones.
+    """
+
+    def __init__(self, capacity: int = 256) -> None:
+        self._events = deque(maxlen=capacity)  # type: deque
+        self._last_id = int(time() * 1000)
+        self._changed = Condition()
+        self.subscribers = 0
+        self.closed = False
+
+    @property
+    def last_id(self) -> int:
+        return self._last_id
+
+    def publish(self, event: str, data: dict) -> StatusEvent:
+        with self._changed:
+            self._last_id += 1
+            published = StatusEvent(self._last_id, event, data)
+            self._events.append(published)
+            self._changed.notify_all()
+        return published
+
+    def since(self, last_id: int) -> Optional[List[StatusEvent]]:
+        """
+        Events after ``last_id``, or None if some of them are no longer
+        buffered (or the id is unknown) and the client needs a full snapshot.
+        """
+        with self._changed:
+            return self._since(last_id)
+
+    def wait(self, last_id: int, timeout: float) -> Optional[List[StatusEvent]]:
+        """Like ``since``, but block up to ``timeout`` for the next event."""
+        with self._changed:
+            self._changed.wait_for(lambda: self.closed or self._last_id != last_id, timeout)
+            return self._since(last_id)
+
+    def subscribe(self) -> None:
+        with self._changed:
+            self.subscribers += 1
+
+    def unsubscribe(self) -> None:
+        with self._changed:
+            self.subscribers -= 1
+
+    def close(self) -> None:
+        """Wake up every subscriber so their streams can end."""
+        with self._changed:
+            self.closed = True
+            self._changed.notify_all()
+
+    def _since(self, last_id: int) -> Optional[List[StatusEvent]]:
+        if last_id > self._last_id:
+            return None
+        first_id = self._events[0].id if self._events else self._last_id + 1
+        if last_id < first_id - 1:
+            return None
+        return [event for event in self._events if event.id > last_id]
+
+
+def compact_json(data: Any) -> bytes:
+    return json.dumps(data, separators=(",", ":")).encode()
+
+
+def status_etag(status: dict) -> str:
+    """
+    Weak ETag for a /status body. Ignores the fields that only move with the
+    clock (snapshot age, uptime), so it changes when Dropbox does.
+    """
+    stable = dict(status, snapshot=None, daemon=dict(status["daemon"], uptime_seconds=None))
+    encoded = json.dumps(stable, sort_keys=True, separators=(",", ":")).encode()
+    return 'W/"%08x"' % zlib.crc32(encoded)
+
+
+def accepts_gzip(accept_encoding: Optional[str]) -> bool:
+    for coding in (accept_encoding or "").split(","):
+        name, _, params = coding.partition(";")
+        if name.strip().lower() not in ("gzip", "*"):
+            continue
+        q = params.strip()
+        if q.startswith("q="):
+            try:
+                return float(q[2:]) > 0
+            except ValueError:
+                return False
+        return True
+    return False
+
+
+def sample_stacks(
+    seconds: float, interval: float = PROFILE_INTERVAL_SEC
+) -> Tuple[Dict[str, int], int]:
+    """
+    Sample the Python stack of every other thread for ``seconds``.
+
+    Returns collapsed stacks (``thread;file:function;...``, outermost first,
+    as read by flamegraph.pl and speedscope) with their sample counts, and
+    the number of samples taken. Unlike cProfile this sees all threads and
+    costs the profiled code nothing between samples.
+    """
+    me = get_ident()
+    stacks = {}  # type: Dict[str, int]
+    samples = 0
+    deadline = monotonic() + seconds
+    while monotonic() < deadline:
+        names = {thread.ident: thread.name for thread in enumerate_threads()}
+        for ident, frame in sys._current_frames().items():
+            if ident == me:
+                continue
+            frames = []
+            while frame is not None:
+                code = frame.f_code
+                frames.append("%s:%s" % (os.path.basename(code.co_filename), code.co_name))
+                frame = frame.f_back
+            frames.append(names.get(ident, str(ident)))
+            key = ";".join(reversed(frames))
+            stacks[key] = stacks.get(key, 0) + 1
+        samples += 1
+        sleep(interval)
+    return stacks, samples
+
+
 class DropboxInterface:
     """
     This can be mocked for testing as needed
     """
 
-    def __init__(self, logger: logging.Logger) -> None:
+    def __init__(
+        self,
+        logger: logging.Logger,
+        cache: Optional[StatusCache] = None,
+        home: Optional[str] = None,
+        owner: Optional[Tuple[int, int]] = None,
+    ) -> None:
         self.logger = logger
+        self.cache = cache or StatusCache()
+        # Another Dropbox home: dropbox.py finds the daemon through $HOME
+        self.info_json = INFO_JSON if home is None else os.path.join(home, ".dropbox", "info.json")
+        self.version_file = VERSION_FILE if home is None else os.path.join(home, "bin", "VERSION")
+        self._env = None if home is None else dict(os.environ, HOME=home)
+        # Running as root (--supervise): the CLI has to run as the daemon's
+        # user, with its home, or it looks for a daemon under /root
+        self.owner = owner
+        if owner is not None:
+            self._env = dict(os.environ, HOME=home or DROPBOX_HOME)
+
+    def _run_cli(self, *args: str) -> subprocess.CompletedProcess:
+        user = {}  # type: Dict[str, Any]
+        if self.owner is not None:
+            user = {"user": self.owner[0], "group": self.owner[1], "extra_groups": []}
+        return subprocess.run(
+            ["dropbox"] + list(args),
+            capture_output=True,
+            text=True,
+            env=self._env,
+            timeout=CLI_TIMEOUT_SEC,
+            **user,
+        )
 
     def query_status(self) -> Optional[str]:
         try:
-            result = subprocess.run(
-                ["dropbox", "status"], capture_output=True, text=True
-            )
+            result = self._run_cli("status")
             if result.stderr:
                 self.logger.warning("Dropbox status returned error: %s", result.stderr)
                 return None
@@ -57,12 +1125,43 @@ class DropboxInterface:
             self.logger.exception("Failed to invoke Dropbox")
             return None
 
+    def query_file_status(self, path: str) -> Optional[str]:
+        """Sync status of one file ("up to date", "syncing", ...), as `dropbox filestatus`."""
+        try:
+            result = self._run_cli("filestatus", path)
+        except Exception:
+            self.logger.exception("Failed to invoke Dropbox")
+            return None
+        # "<path>: up to date"
+        status = result.stdout.strip().rpartition(": ")[2]
+        return status or None
+
+    def query_file_statuses(self, paths: Sequence[str]) -> List[Optional[str]]:
+        """query_file_status for many paths, FILE_STATUS_BATCH per CLI call."""
+        statuses = []  # type: List[Optional[str]]
+        for start in range(0, len(paths), FILE_STATUS_BATCH):
+            batch = paths[start:start + FILE_STATUS_BATCH]
+            try:
+                lines = self._run_cli("filestatus", *batch).stdout.splitlines()
+            except Exception:
+                self.logger.exception("Failed to invoke Dropbox")
+                lines = []
+            # One "<path>: <status>" line per path, in order; the paths are
+            # padded to a common width
+            if len(lines) != len(batch):
+                statuses.extend([None] * len(batch))
+                continue
+            statuses.extend(line.rpartition(":")[2].strip() or None for line in lines)
+        return statuses
+
     def query_account_info(self) -> Optional[dict]:
         """Read account info from Dropbox's info.json."""
+        return self.cache.get_file("account_info", self.info_json, self._read_account_info)
+
+    def _read_account_info(self) -> Optional[dict]:
         try:
-            info_path = "/opt/dropbox/.dropbox/info.json"
-            if os.path.exists(info_path):
-                with open(info_path) as f:
+            if os.path.exists(self.info_json):
+                with open(self.info_json) as f:
                     return json.load(f)
         except Exception:
             pass
@@ -70,293 +1169,3648 @@ class DropboxInterface:
 
     def query_exclude_list(self) -> Optional[list]:
         """Get the list of excluded (selective sync) folders."""
+        return self.cache.get_ttl("exclude_list", self._load_exclude_list)
+
+    def invalidate_exclude_list(self) -> None:
+        """Forget the cached exclude list, e.g. after changing selective sync."""
+        self.cache.invalidate("exclude_list")
+
+    def exclude_add(self, paths: Sequence[str]) -> None:
+        """Exclude absolute ``paths`` from sync, as `dropbox exclude add`; OSError on failure."""
+        self._run_exclude("add", paths)
+        self._excludes_changed(paths, excluded=True)
+
+    def exclude_remove(self, paths: Sequence[str]) -> None:
+        """Sync absolute ``paths`` again, as `dropbox exclude remove`; OSError on failure."""
+        self._run_exclude("remove", paths)
+        self._excludes_changed(paths, excluded=False)
+
+    def _run_exclude(self, action: str, paths: Sequence[str]) -> None:
         try:
-            result = subprocess.run(
-                ["dropbox", "exclude", "list"], capture_output=True, text=True
-            )
+            result = self._run_cli("exclude", action, *paths)
+        except subprocess.TimeoutExpired as e:
+            raise OSError("dropbox exclude %s timed out" % action) from e
+        if result.returncode != 0 or result.stderr or "isn't running" in result.stdout:
+            raise OSError((result.stderr or result.stdout).strip() or "exit code %d" % result.returncode)
+
+    def _excludes_changed(self, paths: Sequence[str], excluded: bool) -> None:
+        """Apply a change to the cached exclude list instead of asking the CLI again."""
+        entries = [self._exclude_entry(path) for path in paths]
+        # Dropbox paths are case-insensitive
+        changed = {path.lower() for path in entries}
+
+        def apply(current: list) -> list:
+            kept = [path for path in current if path.lower() not in changed]
+            return kept + entries if excluded else kept
+
+        self.cache.update("exclude_list", apply)
+
+    def _exclude_entry(self, path: str) -> str:
+        """
+        An exclude list entry as it is cached: an absolute path. `dropbox
+        exclude list` prints them relative to its working directory, ours.
+        """
+        return os.path.abspath(path)
+
+    def _load_exclude_list(self) -> Optional[list]:
+        try:
+            result = self._run_cli("exclude", "list")
             if result.stdout:
                 lines = result.stdout.strip().splitlines()
                 # First line is header like "Excluded:"
-                return [l.strip() for l in lines[1:] if l.strip()] if len(lines) > 1 else []
+                return [
+                    self._exclude_entry(l.strip()) for l in lines[1:] if l.strip()
+                ] if len(lines) > 1 else []
+        except Exception:
+            pass
+        return None
+
+    def query_version(self) -> Optional[str]:
+        """Read the daemon version from VERSION file."""
+        return self.cache.get_file("version", self.version_file, self._read_version)
+
+    def _read_version(self) -> Optional[str]:
+        try:
+            if os.path.exists(self.version_file):
+                with open(self.version_file) as f:
+                    return f.read().strip()
         except Exception:
             pass
         return None
 
-    def query_version(self) -> Optional[str]:
-        """Read the daemon version from VERSION file."""
-        try:
-            version_path = "/opt/dropbox/bin/VERSION"
-            if os.path.exists(version_path):
-                with open(version_path) as f:
-                    return f.read().strip()
-        except Exception:
-            pass
-        return None
+
+class CommandError(Exception):
+    """The daemon answered a command_socket request with ``notok``."""
+
+
+class CommandSocketClient:
+    """
+    Client for the daemon's command_socket, speaking the same line protocol
+    as dropbox.py. A request is the command name on its own line, one
+    tab-separated ``key value...`` line per argument, then ``done``. The
+    response starts with ``ok`` or ``notok`` and uses the same framing.
+
+    The connection is kept open between requests and transparently
+    re-established (once per request) if the daemon dropped it.
+    """
+
+    MAX_RESPONSE_LINES = 1000
+
+    def __init__(
+        self, path: str = COMMAND_SOCKET, timeout: float = 5.0
+    ) -> None:
+        self.path = path
+        self.timeout = timeout
+        self._sock = None  # type: Optional[socket.socket]
+        self._file = None
+        self._lock = Lock()
+
+    def available(self) -> bool:
+        return os.path.exists(self.path)
+
+    def connect(self) -> None:
+        self.close()
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        try:
+            sock.connect(self.path)
+        except Exception:
+            sock.close()
+            raise
+        self._sock = sock
+        self._file = sock.makefile("rwb")
+
+    def close(self) -> None:
+        for closeable in (self._file, self._sock):
+            if closeable is not None:
+                try:
+                    closeable.close()
+                except OSError:
+                    pass
+        self._file = None
+        self._sock = None
+
+    def send_command(
+        self, name: str, args: Optional[Dict[str, object]] = None
+    ) -> Dict[str, List[str]]:
+        """
+        Send one command and return its ``key -> [values]`` response.
+
+        Raises CommandError if the daemon rejects the command, and OSError
+        (including socket.timeout) if it cannot be reached.
+        """
+        return self._call(partial(self._roundtrip, name, args or {}))
+
+    def send_batch(
+        self, name: str, batch: Sequence[Dict[str, object]]
+    ) -> List[Optional[Dict[str, List[str]]]]:
+        """
+        Send ``name`` once per argument dict in ``batch`` and return the
+        responses in order, None where the daemon answered ``notok``.
+
+        The requests are pipelined: all of them are written before the
+        first response is read, so a batch costs one round trip instead of
+        one per request. Keep batches small enough that the requests fit
+        in the socket buffer (a few hundred paths).
+        """
+        return self._call(partial(self._pipeline, name, batch))
+
+    def _call(self, exchange: Callable[[], Any]) -> Any:
+        with self._lock:
+            reused = self._sock is not None
+            try:
+                if not reused:
+                    self.connect()
+                return exchange()
+            except CommandError:
+                raise
+            except socket.timeout:
+                # A hung daemon won't answer a second attempt either
+                self.close()
+                raise
+            except OSError:
+                self.close()
+                if not reused:
+                    raise
+            # The daemon may have closed an idle connection; retry once
+            try:
+                self.connect()
+                return exchange()
+            except OSError:
+                self.close()
+                raise
+
+    def _roundtrip(self, name: str, args: Dict[str, object]) -> Dict[str, List[str]]:
+        self._file.write(self._encode(name, args))
+        self._file.flush()
+        return self._read_response()
+
+    def _pipeline(
+        self, name: str, batch: Sequence[Dict[str, object]]
+    ) -> List[Optional[Dict[str, List[str]]]]:
+        self._file.write(b"".join(self._encode(name, args) for args in batch))
+        self._file.flush()
+        responses = []  # type: List[Optional[Dict[str, List[str]]]]
+        for _ in batch:
+            try:
+                responses.append(self._read_response())
+            except CommandError:
+                responses.append(None)
+        return responses
+
+    @staticmethod
+    def _encode(name: str, args: Dict[str, object]) -> bytes:
+        lines = [name]
+        for key, value in args.items():
+            values = [value] if isinstance(value, str) else list(value)  # type: ignore
+            lines.append("\t".join([key] + values))
+        lines.append("done")
+        return ("\n".join(lines) + "\n").encode("utf-8")
+
+    def _read_response(self) -> Dict[str, List[str]]:
+        reply = self._readline()
+        body = []
+        for _ in range(self.MAX_RESPONSE_LINES):
+            line = self._readline()
+            if line == "done":
+                break
+            body.append(line)
+        else:
+            self.close()
+            raise OSError("Response from %s was not terminated" % self.path)
+
+        if reply != "ok":
+            raise CommandError("\n".join(body) or reply)
+        result = {}  # type: Dict[str, List[str]]
+        for line in body:
+            fields = line.split("\t")
+            result[fields[0]] = fields[1:]
+        return result
+
+    def _readline(self) -> str:
+        line = self._file.readline()
+        if not line:
+            raise ConnectionResetError("Connection closed by Dropbox daemon")
+        return line.decode("utf-8").rstrip("\n")
+
+
+class SocketDropboxInterface(DropboxInterface):
+    """
+    Talks to the daemon directly over its command_socket instead of starting
+    a Python interpreter for dropbox.py on every poll. Falls back to the CLI
+    whenever the socket is missing or unusable.
+    """
+
+    def __init__(
+        self,
+        logger: logging.Logger,
+        client: Optional[CommandSocketClient] = None,
+        sync_root: str = SYNC_ROOT,
+        cache: Optional[StatusCache] = None,
+        home: Optional[str] = None,
+        owner: Optional[Tuple[int, int]] = None,
+    ) -> None:
+        super().__init__(logger, cache, home, owner)
+        self.client = client or CommandSocketClient()
+        self.sync_root = sync_root
+
+    def _command(self, name: str) -> Optional[Dict[str, List[str]]]:
+        if not self.client.available():
+            return None
+        try:
+            return self.client.send_command(name)
+        except CommandError as e:
+            self.logger.warning("Dropbox rejected %s: %s", name, e)
+        except Exception as e:
+            self.logger.warning(
+                "command_socket request %s failed (%s), falling back to CLI", name, e
+            )
+        return None
+
+    def query_status(self) -> Optional[str]:
+        response = self._command("get_dropbox_status")
+        if response is None:
+            return super().query_status()
+        lines = response.get("status", [])
+        # dropbox.py prints "Idle" when the daemon reports no status lines
+        result = "\n".join(lines) if lines else "Idle"
+        self.logger.debug("Got result from Dropbox socket: %s", result)
+        return result + "\n"
+
+    def query_file_status(self, path: str) -> Optional[str]:
+        if not self.client.available():
+            return super().query_file_status(path)
+        try:
+            response = self.client.send_command("icon_overlay_file_status", {"path": path})
+        except CommandError as e:
+            self.logger.debug("Dropbox has no status for %s: %s", path, e)
+            return None
+        except Exception as e:
+            self.logger.warning("command_socket file status failed (%s), falling back to CLI", e)
+            return super().query_file_status(path)
+        return (response.get("status") or [None])[0]
+
+    def query_file_statuses(self, paths: Sequence[str]) -> List[Optional[str]]:
+        if not self.client.available():
+            return super().query_file_statuses(paths)
+        statuses = []  # type: List[Optional[str]]
+        try:
+            for start in range(0, len(paths), FILE_STATUS_BATCH):
+                responses = self.client.send_batch(
+                    "icon_overlay_file_status",
+                    [{"path": path} for path in paths[start:start + FILE_STATUS_BATCH]],
+                )
+                statuses.extend(
+                    (response.get("status") or [None])[0] if response is not None else None
+                    for response in responses
+                )
+        except Exception as e:
+            # A daemon that stopped answering the socket won't answer a few
+            # thousand CLI calls either
+            self.logger.warning("command_socket file statuses failed: %s", e)
+            statuses.extend([None] * (len(paths) - len(statuses)))
+        return statuses
+
+    def _run_exclude(self, action: str, paths: Sequence[str]) -> None:
+        if not self.client.available():
+            return super()._run_exclude(action, paths)
+        try:
+            self.client.send_command("ignore_set_" + action, {"paths": list(paths)})
+        except CommandError as e:
+            raise OSError("Dropbox rejected exclude %s: %s" % (action, e)) from e
+        except Exception as e:
+            self.logger.warning("command_socket exclude %s failed (%s), falling back to CLI", action, e)
+            super()._run_exclude(action, paths)
+
+    def _excludes_changed(self, paths: Sequence[str], excluded: bool) -> None:
+        # The daemon's ignore set is one socket round trip away
+        response = self._command("get_ignore_set")
+        if response is None:
+            super()._excludes_changed(paths, excluded)
+        else:
+            self.cache.set("exclude_list", self._relative_ignore_set(response))
+
+    def _exclude_entry(self, path: str) -> str:
+        # Relative to the sync folder, also when the list came from the CLI
+        return os.path.relpath(os.path.abspath(path), self.sync_root)
+
+    def _relative_ignore_set(self, response: Dict[str, List[str]]) -> list:
+        return [self._exclude_entry(path) for path in response.get("ignore_set", []) if path]
+
+    def _load_exclude_list(self) -> Optional[list]:
+        response = self._command("get_ignore_set")
+        if response is None:
+            return super()._load_exclude_list()
+        return self._relative_ignore_set(response)
+
+
+class CacheCollector:
+    """Exports StatusCache hit/miss counters for the monitored DropboxInterface."""
+
+    def __init__(self, dropbox: DropboxInterface) -> None:
+        self.dropbox = dropbox
+
+    def collect(self):
+        cache = getattr(self.dropbox, "cache", None)
+        if not isinstance(cache, StatusCache):
+            return
+        hits = CounterMetricFamily(
+            "dropbox_cache_hits", "Status cache hits", labels=["cache"]
+        )
+        misses = CounterMetricFamily(
+            "dropbox_cache_misses", "Status cache misses", labels=["cache"]
+        )
+        for key, counts in sorted(cache.stats().items()):
+            hits.add_metric([key], counts["hits"])
+            misses.add_metric([key], counts["misses"])
+        yield hits
+        yield misses
+
+
+class DaemonProcessStats(NamedTuple):
+    """Resource usage summed over the dropboxd process tree."""
+
+    pid: int
+    num_processes: int
+    rss_bytes: int
+    peak_rss_bytes: int
+    cpu_seconds: float
+    open_fds: int
+    threads: int
+    read_bytes: int
+    write_bytes: int
+    inotify_watches: Optional[int]
+    inotify_max_user_watches: Optional[int]
+    started_at: Optional[float] = None
+
+
+class DaemonProcessReader:
+    """
+    Reads resource usage of the Dropbox daemon (not this script) from /proc.
+
+    The root PID comes from dropbox.pid, or from a scan of /proc for a
+    process named ``dropbox`` when the PID file is missing or stale (unless
+    ``scan_proc`` is off). It is cached until that process goes away. Counting inotify watches means
+    reading every line of the daemon's fdinfo, which can be large on big
+    accounts, so that count is refreshed at most every
+    ``inotify_interval_sec``.
+    """
+
+    def __init__(
+        self,
+        proc_root: str = "/proc",
+        pid_file: str = PID_FILE,
+        process_name: str = "dropbox",
+        inotify_interval_sec: float = 60.0,
+        scan_proc: bool = True,
+    ) -> None:
+        self.proc_root = proc_root
+        self.pid_file = pid_file
+        self.process_name = process_name
+        self.scan_proc = scan_proc
+        self.inotify_interval_sec = inotify_interval_sec
+        self._clock_ticks = os.sysconf("SC_CLK_TCK")
+        self._page_size = os.sysconf("SC_PAGE_SIZE")
+        self._root = None  # type: Optional[Tuple[int, str]]
+        self._inotify_fds = {}  # type: Dict[int, List[str]]
+        self._inotify_watches = None  # type: Optional[int]
+        self._inotify_checked = -float("inf")
+        self._boot_time = None  # type: Optional[int]
+
+    def read(self) -> Optional[DaemonProcessStats]:
+        pid = self.find_root_pid()
+        if pid is None:
+            return None
+        pids = self.process_tree(pid)
+
+        rss = peak = fds = threads = read_bytes = write_bytes = 0
+        cpu = 0.0
+        for child in pids:
+            status = self._read_status(child)
+            rss += status.get("VmRSS", 0)
+            peak += status.get("VmHWM", 0)
+            threads += status.get("Threads", 0)
+            cpu += self._read_cpu_seconds(child)
+            fds += self._count_fds(child)
+            io = self._read_io(child)
+            read_bytes += io.get("read_bytes", 0)
+            write_bytes += io.get("write_bytes", 0)
+
+        now = monotonic()
+        if now - self._inotify_checked >= self.inotify_interval_sec:
+            self._inotify_checked = now
+            self._inotify_watches = self._count_inotify_watches(pids)
+
+        return DaemonProcessStats(
+            pid=pid,
+            num_processes=len(pids),
+            rss_bytes=rss,
+            peak_rss_bytes=peak,
+            cpu_seconds=cpu,
+            open_fds=fds,
+            threads=threads,
+            read_bytes=read_bytes,
+            write_bytes=write_bytes,
+            inotify_watches=self._inotify_watches,
+            inotify_max_user_watches=self._read_int(
+                os.path.join(self.proc_root, "sys", "fs", "inotify", "max_user_watches")
+            ),
+            started_at=self.process_start_time(pid),
+        )
+
+    def find_root_pid(self) -> Optional[int]:
+        if self._root is not None:
+            pid, start_time = self._root
+            if self._start_time(pid) == start_time:
+                return pid
+            self._root = None
+            self._inotify_checked = -float("inf")
+
+        pid = self._read_int(self.pid_file)
+        if pid is None or self._comm(pid) != self.process_name:
+            # With several daemons on the host a scan can't tell whose is whose
+            pid = self._scan_for_root() if self.scan_proc else None
+        if pid is not None:
+            start_time = self._start_time(pid)
+            if start_time is not None:
+                self._root = (pid, start_time)
+        return pid
+
+    def process_start_time(self, pid: int) -> Optional[float]:
+        """Unix time at which ``pid`` started."""
+        ticks = self._start_time(pid)
+        if self._boot_time is None:
+            try:
+                with open(os.path.join(self.proc_root, "stat")) as f:
+                    for line in f:
+                        if line.startswith("btime "):
+                            self._boot_time = int(line.split()[1])
+                            break
+            except (OSError, ValueError):
+                pass
+        if ticks is None or self._boot_time is None:
+            return None
+        return self._boot_time + int(ticks) / self._clock_ticks
+
+    def process_tree(self, root: int) -> List[int]:
+        """Return ``root`` and all of its descendants."""
+        parents = None  # type: Optional[Dict[int, List[int]]]
+        pids = [root]
+        index = 0
+        while index < len(pids):
+            pid = pids[index]
+            index += 1
+            children = self._children(pid)
+            if children is None:
+                # No /proc/<pid>/task/*/children on this kernel; walk ppids
+                if parents is None:
+                    parents = {}
+                    for other in self._all_pids():
+                        ppid = self._ppid(other)
+                        if ppid is not None:
+                            parents.setdefault(ppid, []).append(other)
+                children = parents.get(pid, [])
+            pids.extend(child for child in children if child not in pids)
+        return pids
+
+    def _scan_for_root(self) -> Optional[int]:
+        candidates = [pid for pid in self._all_pids() if self._comm(pid) == self.process_name]
+        for pid in sorted(candidates):
+            if self._ppid(pid) not in candidates:
+                return pid
+        return None
+
+    def _proc(self, pid: int, *names: str) -> str:
+        return os.path.join(self.proc_root, str(pid), *names)
+
+    def _all_pids(self) -> List[int]:
+        try:
+            return [int(name) for name in os.listdir(self.proc_root) if name.isdigit()]
+        except OSError:
+            return []
+
+    def _comm(self, pid: int) -> Optional[str]:
+        try:
+            with open(self._proc(pid, "comm")) as f:
+                return f.read().strip()
+        except OSError:
+            return None
+
+    def _stat_fields(self, pid: int) -> Optional[List[str]]:
+        try:
+            with open(self._proc(pid, "stat")) as f:
+                data = f.read()
+        except OSError:
+            return None
+        # The command name may contain spaces and parentheses; fields resume after the last ")"
+        return data[data.rfind(")") + 2:].split()
+
+    def _ppid(self, pid: int) -> Optional[int]:
+        fields = self._stat_fields(pid)
+        return int(fields[1]) if fields else None
+
+    def _start_time(self, pid: int) -> Optional[str]:
+        fields = self._stat_fields(pid)
+        return fields[19] if fields else None
+
+    def _read_cpu_seconds(self, pid: int) -> float:
+        fields = self._stat_fields(pid)
+        if not fields:
+            return 0.0
+        return (int(fields[11]) + int(fields[12])) / self._clock_ticks
+
+    def _children(self, pid: int) -> Optional[List[int]]:
+        try:
+            tids = os.listdir(self._proc(pid, "task"))
+        except OSError:
+            return []
+        children = []  # type: List[int]
+        for tid in tids:
+            try:
+                with open(self._proc(pid, "task", tid, "children")) as f:
+                    children.extend(int(child) for child in f.read().split())
+            except FileNotFoundError:
+                return None
+            except OSError:
+                pass
+        return children
+
+    def _read_status(self, pid: int) -> Dict[str, int]:
+        result = {}  # type: Dict[str, int]
+        try:
+            with open(self._proc(pid, "status")) as f:
+                for line in f:
+                    key, _, value = line.partition(":")
+                    if key in ("VmRSS", "VmHWM"):
+                        result[key] = int(value.split()[0]) * 1024
+                    elif key == "Threads":
+                        result[key] = int(value)
+        except (OSError, ValueError):
+            pass
+        return result
+
+    def _read_io(self, pid: int) -> Dict[str, int]:
+        result = {}  # type: Dict[str, int]
+        try:
+            with open(self._proc(pid, "io")) as f:
+                for line in f:
+                    key, _, value = line.partition(":")
+                    result[key] = int(value)
+        except (OSError, ValueError):
+            pass
+        return result
+
+    def _count_fds(self, pid: int) -> int:
+        try:
+            return len(os.listdir(self._proc(pid, "fd")))
+        except OSError:
+            return 0
+
+    def _count_inotify_watches(self, pids: List[int]) -> Optional[int]:
+        total = None  # type: Optional[int]
+        for pid in pids:
+            try:
+                fds = os.listdir(self._proc(pid, "fd"))
+            except OSError:
+                continue
+            for fd in fds:
+                try:
+                    if os.readlink(self._proc(pid, "fd", fd)) != "anon_inode:inotify":
+                        continue
+                    with open(self._proc(pid, "fdinfo", fd), "rb") as f:
+                        watches = sum(1 for line in f if line.startswith(b"inotify wd:"))
+                except OSError:
+                    continue
+                total = (total or 0) + watches
+        return total
+
+    @staticmethod
+    def _read_int(path: str) -> Optional[int]:
+        try:
+            with open(path) as f:
+                return int(f.read().strip())
+        except (OSError, ValueError):
+            return None
+
+
+class DaemonProcessCollector:
+    """Exports the daemon's resource usage from the latest status snapshot."""
+
+    def __init__(self, monitor: "DropboxMonitor") -> None:
+        self.monitor = monitor
+
+    def collect(self):
+        stats = self.monitor.snapshot.daemon
+        up = GaugeMetricFamily("dropbox_daemon_up", "Whether the dropboxd process was found")
+        up.add_metric([], 1 if stats else 0)
+        yield up
+        if stats is None:
+            return
+
+        gauges = [
+            ("processes", "Processes in the dropboxd process tree", stats.num_processes),
+            ("resident_memory_bytes", "Resident memory of dropboxd", stats.rss_bytes),
+            ("peak_resident_memory_bytes", "Peak resident memory of dropboxd", stats.peak_rss_bytes),
+            ("open_fds", "Open file descriptors of dropboxd", stats.open_fds),
+            ("threads", "Threads in the dropboxd process tree", stats.threads),
+            ("inotify_watches", "inotify watches held by dropboxd", stats.inotify_watches),
+        ]
+        for name, documentation, value in gauges:
+            if value is not None:
+                yield GaugeMetricFamily("dropbox_daemon_" + name, documentation, value=value)
+        if stats.inotify_max_user_watches is not None:
+            yield GaugeMetricFamily(
+                "dropbox_inotify_max_user_watches",
+                "Kernel limit on inotify watches per user",
+                value=stats.inotify_max_user_watches,
+            )
+
+        counters = [
+            ("cpu_seconds", "CPU time used by dropboxd", stats.cpu_seconds),
+            ("read_bytes", "Bytes read from storage by dropboxd", stats.read_bytes),
+            ("write_bytes", "Bytes written to storage by dropboxd", stats.write_bytes),
+        ]
+        for name, documentation, value in counters:
+            yield CounterMetricFamily("dropbox_daemon_" + name, documentation, value=value)
+
+
+class StartupPhase(Enum):
+    SPAWN = "spawn"
+    SOCKET_READY = "socket_ready"
+    FIRST_INDEXING = "first_indexing"
+    FIRST_UP_TO_DATE = "first_up_to_date"
+
+
+class StartupTracker:
+    """
+    Times the daemon's cold start.
+
+    ``spawn`` is measured from the container's start (PID 1) to the first
+    daemon's start; the other phases from each daemon's start, and are
+    reset when a new daemon shows up. The socket is timed by its ctime, so
+    it is exact however rarely the sampler polls; the first ``Indexing`` and
+    ``Up to date`` are timed when the sampler first sees them. A daemon
+    that was already up to date when first seen (e.g. the monitor itself
+    restarted) gets no phases.
+    """
+
+    def __init__(
+        self, process_reader: DaemonProcessReader, socket_path: str = COMMAND_SOCKET
+    ) -> None:
+        self.process_reader = process_reader
+        self.socket_path = socket_path
+        self.daemon_pid = None  # type: Optional[int]
+        self.daemon_started_at = None  # type: Optional[float]
+        self.phases = {}  # type: Dict[StartupPhase, float]
+        self._tracking = False
+
+    def observe(self, state: State, stats: Optional[DaemonProcessStats], taken_at: float) -> None:
+        if stats is None or stats.started_at is None:
+            return
+        if stats.pid != self.daemon_pid:
+            self._new_daemon(stats, state)
+        if not self._tracking:
+            return
+        started = stats.started_at
+
+        if StartupPhase.SOCKET_READY not in self.phases:
+            try:
+                created = os.stat(self.socket_path).st_ctime
+            except OSError:
+                created = None
+            if created is not None and created >= started:
+                self.phases[StartupPhase.SOCKET_READY] = created - started
+        if state == State.INDEXING:
+            self.phases.setdefault(StartupPhase.FIRST_INDEXING, max(0.0, taken_at - started))
+        elif state == State.UP_TO_DATE:
+            self.phases.setdefault(StartupPhase.FIRST_UP_TO_DATE, max(0.0, taken_at - started))
+            self._tracking = False
+
+    def _new_daemon(self, stats: DaemonProcessStats, state: State) -> None:
+        first = self.daemon_pid is None
+        self.daemon_pid = stats.pid
+        self.daemon_started_at = stats.started_at
+        spawn = self.phases.get(StartupPhase.SPAWN)
+        self.phases = {}
+        self._tracking = state != State.UP_TO_DATE
+        if first and self._tracking:
+            container_started = self.process_reader.process_start_time(1)
+            if container_started is not None and stats.started_at >= container_started:
+                spawn = stats.started_at - container_started
+        if spawn is not None:
+            self.phases[StartupPhase.SPAWN] = spawn
+
+    def as_dict(self) -> Dict[str, float]:
+        return {phase.value: round(seconds, 3) for phase, seconds in self.phases.items()}
+
+
+class StartupCollector:
+    """Exports the startup phase timings."""
+
+    def __init__(self, tracker: StartupTracker) -> None:
+        self.tracker = tracker
+
+    def collect(self):
+        phases = GaugeMetricFamily(
+            "dropbox_startup_phase_seconds",
+            "Time to reach each daemon startup phase (spawn: since container start)",
+            labels=["phase"],
+        )
+        for phase, seconds in list(self.tracker.phases.items()):
+            phases.add_metric([phase.value], seconds)
+        yield phases
+
+
+class Readiness(Enum):
+    READY = "ready"
+    TIMEOUT = "timeout"
+    EXITED = "exited"
+
+
+def wait_until_ready(
+    home: str = DROPBOX_HOME,
+    timeout: float = 300.0,
+    is_alive: Callable[[], bool] = lambda: True,
+) -> Readiness:
+    """
+    Wait for the daemon to create info.json or its command_socket.
+
+    Wakes up as soon as inotify reports either file; ``is_alive`` is still
+    checked every second so a daemon that died during startup is noticed.
+    """
+    dot_dropbox = os.path.join(home, ".dropbox")
+    ready_files = [os.path.join(dot_dropbox, name) for name in ("info.json", "command_socket")]
+    mask = Inotify.IN_CREATE | Inotify.IN_MOVED_TO | Inotify.IN_ONLYDIR
+    deadline = monotonic() + timeout
+    try:
+        inotify = Inotify()  # type: Optional[Inotify]
+    except OSError:
+        inotify = None
+    watching = False
+    try:
+        while True:
+            if inotify is not None and not watching:
+                try:
+                    inotify.add_watch(dot_dropbox, mask)
+                    watching = True
+                except OSError:
+                    # .dropbox doesn't exist yet: wait for it to be created
+                    try:
+                        inotify.add_watch(home, mask)
+                    except OSError:
+                        pass
+            # Checked after adding the watch so a file created in between isn't missed
+            if any(os.path.exists(path) for path in ready_files):
+                return Readiness.READY
+            if not is_alive():
+                return Readiness.EXITED
+            remaining = deadline - monotonic()
+            if remaining <= 0:
+                return Readiness.TIMEOUT
+            if inotify is not None:
+                inotify.read(min(1.0, remaining))
+            else:
+                Event().wait(min(0.5, remaining))
+    finally:
+        if inotify is not None:
+            inotify.close()
+
+
+ACTION_DIRECTIONS = {
+    "Syncing": Direction.SYNC,
+    "Downloading": Direction.DOWNLOAD,
+    "Uploading": Direction.UPLOAD,
+}
+
+# One pattern for every progress line: the action, either a file count or a
+# quoted file name, then an optional transfer rate and an optional ETA.
+PROGRESS_LINE = re.compile(
+    '(Syncing|Downloading|Uploading|Indexing) '
+    '(?:(\\d[\\d,]*) files|".+")'
+    '(?:.*?(\\d[\\d,]*(?:\\.\\d+)?) ([KMG]?B)/sec)?'
+    '(?:.*?(\\d[\\d,]*) (sec|min|hr|hour|day)s?\\b)?'
+)
+
+
+# ioprio_set(2) has no libc wrapper; syscall numbers by architecture
+IOPRIO_SET_SYSCALLS = {"x86_64": 251, "aarch64": 30, "armv7l": 314, "i686": 289}
+IOPRIO_WHO_PROCESS = 1
+IOPRIO_CLASS_IDLE = 3
+
+
+def lower_thread_priority() -> bool:
+    """
+    Make the calling thread nice 19 with the idle I/O class, so background
+    scans only use the disk when nothing else wants it. Returns False if
+    the I/O priority couldn't be changed.
+    """
+    try:
+        os.setpriority(os.PRIO_PROCESS, get_native_id(), 19)
+    except OSError:
+        pass
+    number = IOPRIO_SET_SYSCALLS.get(platform.machine())
+    if number is None:
+        return False
+    libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    # who=0: the calling thread
+    return libc.syscall(number, IOPRIO_WHO_PROCESS, 0, IOPRIO_CLASS_IDLE << 13) == 0
+
+
+class FolderTotals(NamedTuple):
+    files: int
+    bytes: int
+
+
+class FolderIndex:
+    """
+    Sizes and file counts of the sync folder, kept in SQLite on the volume.
+
+    One row per directory holds the mtime it was scanned at and the number
+    and total size of the files directly in it. A scan only lists the
+    directories whose mtime changed; for the rest the stored row (and the
+    stored list of subdirectories) is reused, so a quiet multi-million-file
+    tree costs one stat per directory. Editing a file in place doesn't touch
+    the directory's mtime, so every ``deep_scan_every``-th scan re-lists
+    everything.
+
+    Totals per top-level folder and for included versus excluded (selective
+    sync) folders are aggregated after each scan and served from memory.
+    """
+
+    ROOT_FOLDER = "/"
+    OTHER_FOLDER = "other"
+
+    def __init__(
+        self,
+        db_path: str,
+        root: str = SYNC_ROOT,
+        exclude_list: Callable[[], Optional[list]] = lambda: [],
+        max_folders: int = 100,
+        commit_every: int = 1000,
+    ) -> None:
+        self.db_path = db_path
+        self.root = root
+        self.exclude_list = exclude_list
+        self.max_folders = max_folders
+        self.commit_every = commit_every
+        self.folders = {}  # type: Dict[str, FolderTotals]
+        self.selective_sync = {}  # type: Dict[str, FolderTotals]
+        self.directories = 0
+        self.last_rescanned = 0
+        self.last_scan_duration = None  # type: Optional[float]
+        self.last_scan_time = None  # type: Optional[float]
+        self._db = None  # type: Optional[sqlite3.Connection]
+
+    def open(self) -> None:
+        """Open (or create) the database and load the last aggregates."""
+        os.makedirs(os.path.dirname(self.db_path) or ".", exist_ok=True)
+        self._db = sqlite3.connect(self.db_path)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS dirs ("
+            " path TEXT PRIMARY KEY, parent TEXT, mtime_ns INTEGER,"
+            " files INTEGER, bytes INTEGER)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS dirs_parent ON dirs (parent)")
+        self._db.commit()
+        self.aggregate()
+
+    def close(self) -> None:
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+    def scan(self, deep: bool = False, stop: Optional[Event] = None) -> int:
+        """Bring the index up to date; returns how many directories were re-listed."""
+        started = monotonic()
+        db = self._db
+        rescanned = 0
+        pending = 0
+        stack = [""]
+        while stack and not (stop is not None and stop.is_set()):
+            rel = stack.pop()
+            path = os.path.join(self.root, rel) if rel else self.root
+            try:
+                st = os.lstat(path)
+            except OSError:
+                continue
+            row = db.execute("SELECT mtime_ns FROM dirs WHERE path = ?", (rel,)).fetchone()
+            if not deep and row is not None and row[0] == st.st_mtime_ns:
+                subdirs = [r[0] for r in db.execute("SELECT path FROM dirs WHERE parent = ?", (rel,))]
+            else:
+                try:
+                    subdirs, files, size = self._list(path, rel)
+                except OSError:
+                    continue
+                self._store(rel, st.st_mtime_ns, files, size, subdirs)
+                rescanned += 1
+                pending += 1
+                if pending >= self.commit_every:
+                    db.commit()
+                    pending = 0
+            stack.extend(subdirs)
+        db.commit()
+
+        self.last_rescanned = rescanned
+        self.last_scan_duration = monotonic() - started
+        self.last_scan_time = time()
+        self.aggregate()
+        return rescanned
+
+    def aggregate(self) -> None:
+        """Recompute the per-folder and selective sync totals from the database."""
+        excluded = self._excluded_paths()
+        folders = {}  # type: Dict[str, List[int]]
+        selective_sync = {"included": [0, 0], "excluded": [0, 0]}
+        directories = 0
+        for rel, files, size in self._db.execute("SELECT path, files, bytes FROM dirs"):
+            directories += 1
+            top = rel.partition("/")[0] or self.ROOT_FOLDER
+            totals = folders.setdefault(top, [0, 0])
+            totals[0] += files
+            totals[1] += size
+            scope = "excluded" if self._is_excluded(rel, excluded) else "included"
+            selective_sync[scope][0] += files
+            selective_sync[scope][1] += size
+
+        # Label cardinality: the largest folders by name, the rest together
+        ranked = sorted(folders.items(), key=lambda item: item[1][1], reverse=True)
+        capped = dict(ranked[: self.max_folders])
+        if len(ranked) > self.max_folders:
+            rest = ranked[self.max_folders:]
+            capped[self.OTHER_FOLDER] = [sum(t[0] for _, t in rest), sum(t[1] for _, t in rest)]
+        self.folders = {name: FolderTotals(*totals) for name, totals in capped.items()}
+        self.selective_sync = {
+            scope: FolderTotals(*totals) for scope, totals in selective_sync.items()
+        }
+        self.directories = directories
+
+    def _list(self, path: str, rel: str) -> Tuple[List[str], int, int]:
+        subdirs = []
+        files = size = 0
+        with os.scandir(path) as entries:
+            for entry in entries:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        subdirs.append(rel + "/" + entry.name if rel else entry.name)
+                    else:
+                        files += 1
+                        size += entry.stat(follow_symlinks=False).st_size
+                except OSError:
+                    continue
+        return subdirs, files, size
+
+    def _store(self, rel: str, mtime_ns: int, files: int, size: int, subdirs: List[str]) -> None:
+        db = self._db
+        parent = rel.rpartition("/")[0] if rel else None
+        db.execute(
+            "INSERT OR REPLACE INTO dirs (path, parent, mtime_ns, files, bytes)"
+            " VALUES (?, ?, ?, ?, ?)",
+            (rel, parent, mtime_ns, files, size),
+        )
+        # Subdirectories that are gone, with everything below them
+        current = set(subdirs)
+        for (child,) in db.execute("SELECT path FROM dirs WHERE parent = ?", (rel,)).fetchall():
+            if child not in current:
+                # '0' sorts right after '/', so this is every path under child/
+                db.execute(
+                    "DELETE FROM dirs WHERE path = ? OR (path > ? AND path < ?)",
+                    (child, child + "/", child + "0"),
+                )
+        # New subdirectories get a placeholder row so they are listed next
+        db.executemany(
+            "INSERT OR IGNORE INTO dirs (path, parent, mtime_ns, files, bytes)"
+            " VALUES (?, ?, NULL, 0, 0)",
+            [(child, rel) for child in subdirs],
+        )
+
+    def _excluded_paths(self) -> set:
+        try:
+            excluded = self.exclude_list() or []
+        except Exception:
+            excluded = []
+        paths = set()
+        for path in excluded:
+            if os.path.isabs(path):
+                path = os.path.relpath(path, self.root)
+            # Dropbox paths are case-insensitive
+            paths.add(path.strip("/").lower())
+        return paths
+
+    @staticmethod
+    def _is_excluded(rel: str, excluded: set) -> bool:
+        if not excluded or not rel:
+            return False
+        rel = rel.lower()
+        while rel:
+            if rel in excluded:
+                return True
+            rel = rel.rpartition("/")[0]
+        return False
+
+
+class FolderIndexer:
+    """Keeps a FolderIndex up to date from a low-priority background thread."""
+
+    def __init__(
+        self,
+        index: FolderIndex,
+        logger: logging.Logger,
+        scan_interval: float = 900,
+        deep_scan_every: int = 28,
+    ) -> None:
+        self.index = index
+        self.logger = logger
+        self.scan_interval = scan_interval
+        self.deep_scan_every = deep_scan_every
+        self.scans = 0
+        self._stop = Event()
+        self._thread = None  # type: Optional[Thread]
+
+    def start(self) -> None:
+        self._stop.clear()
+        self._thread = Thread(target=self.run, name="folder-indexer", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=10)
+            self._thread = None
+
+    def run(self) -> None:
+        if not lower_thread_priority():
+            self.logger.debug("Couldn't lower I/O priority of the folder indexer")
+        try:
+            self.index.open()
+        except sqlite3.Error as e:
+            self.logger.warning("Folder index disabled, can't open %s: %s", self.index.db_path, e)
+            return
+        try:
+            while not self._stop.is_set():
+                if os.path.isdir(self.index.root):
+                    self.scan()
+                self._stop.wait(self.scan_interval)
+        finally:
+            self.index.close()
+
+    def scan(self) -> None:
+        # The first scan after a restart is incremental too: that is the point
+        deep = self.deep_scan_every > 0 and self.scans > 0 and (
+            self.scans % self.deep_scan_every == 0
+        )
+        try:
+            rescanned = self.index.scan(deep=deep, stop=self._stop)
+        except sqlite3.Error:
+            self.logger.exception("Folder index scan failed")
+            return
+        self.scans += 1
+        self.logger.info(
+            "Folder index scan (%s) re-listed %d of %d directories in %.1fs",
+            "deep" if deep else "incremental",
+            rescanned,
+            self.index.directories,
+            self.index.last_scan_duration,
+        )
+
+
+class FolderIndexCollector:
+    """Exports sync folder sizes from the last folder index scan."""
+
+    def __init__(self, index: FolderIndex) -> None:
+        self.index = index
+
+    def collect(self):
+        folder_bytes = GaugeMetricFamily(
+            "dropbox_folder_bytes",
+            "Bytes on disk per top-level folder of the sync folder",
+            labels=["folder"],
+        )
+        folder_files = GaugeMetricFamily(
+            "dropbox_folder_files",
+            "Files per top-level folder of the sync folder",
+            labels=["folder"],
+        )
+        for folder, totals in list(self.index.folders.items()):
+            folder_bytes.add_metric([folder], totals.bytes)
+            folder_files.add_metric([folder], totals.files)
+        yield folder_bytes
+        yield folder_files
+
+        scope_bytes = GaugeMetricFamily(
+            "dropbox_sync_folder_bytes",
+            "Bytes on disk in the sync folder, by selective sync",
+            labels=["selective_sync"],
+        )
+        scope_files = GaugeMetricFamily(
+            "dropbox_sync_folder_files",
+            "Files in the sync folder, by selective sync",
+            labels=["selective_sync"],
+        )
+        for scope, totals in list(self.index.selective_sync.items()):
+            scope_bytes.add_metric([scope], totals.bytes)
+            scope_files.add_metric([scope], totals.files)
+        yield scope_bytes
+        yield scope_files
+
+        yield GaugeMetricFamily(
+            "dropbox_folder_index_directories",
+            "Directories in the folder index",
+            value=self.index.directories,
+        )
+        if self.index.last_scan_time is not None:
+            yield GaugeMetricFamily(
+                "dropbox_folder_index_last_scan_duration_seconds",
+                "Duration of the last folder index scan",
+                value=self.index.last_scan_duration,
+            )
+            yield GaugeMetricFamily(
+                "dropbox_folder_index_last_scan_timestamp_seconds",
+                "When the last folder index scan finished",
+                value=self.index.last_scan_time,
+            )
+
+
+# Buckets of /status/tree, and what the daemon's per-path statuses map to
+TREE_STATUSES = ("synced", "syncing", "error", "excluded", "unknown")
+FILE_STATUS_BUCKETS = {
+    "up to date": "synced",
+    "syncing": "syncing",
+    "unsyncable": "error",
+    "selsync": "excluded",
+    "ignored": "excluded",
+}
+
+
+class TreeNode:
+    """
+    One directory of a StatusTree: its own status and its direct children.
+
+    Children are held as a sorted name list plus one byte per child (the
+    index into TREE_STATUSES, with DIR set for directories) to keep large
+    directories cheap.
+    """
+
+    __slots__ = ("path", "status", "names", "codes", "total", "built_at")
+
+    DIR = 0x80
+
+    def __init__(
+        self, path: str, status: str, names: List[str], codes: array, total: int
+    ) -> None:
+        self.path = path
+        self.status = status
+        self.names = names
+        self.codes = codes
+        # Children on disk (and excluded), of which at most max_children are kept
+        self.total = total
+        self.built_at = monotonic()
+
+    def counts(self) -> Dict[str, int]:
+        counts = dict.fromkeys(TREE_STATUSES, 0)
+        for code in self.codes:
+            counts[TREE_STATUSES[code & ~self.DIR]] += 1
+        return counts
+
+    def as_dict(self, offset: int = 0, limit: int = 100, status: Optional[str] = None) -> dict:
+        entries = [
+            {
+                "name": name,
+                "type": "dir" if code & self.DIR else "file",
+                "status": TREE_STATUSES[code & ~self.DIR],
+            }
+            for name, code in zip(self.names, self.codes)
+        ]
+        if status is not None:
+            entries = [entry for entry in entries if entry["status"] == status]
+        return {
+            "path": self.path,
+            "status": self.status,
+            "counts": self.counts(),
+            "children": self.total,
+            "truncated": self.total > len(self.names),
+            "age_seconds": round(monotonic() - self.built_at, 3),
+            "total": len(entries),
+            "offset": offset,
+            "limit": limit,
+            "entries": entries[offset:offset + limit],
+        }
+
+
+class StatusTree:
+    """
+    Per-path sync status of the sync folder, one cached TreeNode per directory.
+
+    A directory is listed and the daemon asked for its own status and every
+    child's in pipelined batches the first time it is looked at. The
+    daemon rolls a folder's status up over everything below it, so a
+    directory's counts are enough to tell which child a stall is in without
+    walking the subtree.
+
+    Cached directories are watched with inotify; any change in one drops it
+    and its ancestors. Everything is dropped on a state transition (see
+    DropboxMonitor), and while Dropbox isn't up to date (or without inotify)
+    nodes are only reused for ``ttl`` seconds. Memory and inotify watches are
+    bounded: at most ``max_dirs`` directories and ``max_entries`` children
+    are cached, least recently used first out, and only the first
+    ``max_children`` children of a directory are kept.
+    """
+
+    # Dropbox's own files at the top of the sync folder
+    SKIP_AT_ROOT = (".dropbox", ".dropbox.cache")
+    MASK = ChangeWatcher.MASK | Inotify.IN_DELETE_SELF | Inotify.IN_MOVE_SELF
+
+    def __init__(
+        self,
+        dropbox: DropboxInterface,
+        root: str = SYNC_ROOT,
+        logger: Optional[logging.Logger] = None,
+        max_dirs: int = 256,
+        max_entries: int = 100000,
+        max_children: int = 10000,
+        ttl: float = 10.0,
+    ) -> None:
+        self.dropbox = dropbox
+        self.root = root
+        self.logger = logger or logging.getLogger("dropbox_monitor")
+        self.max_dirs = max_dirs
+        self.max_entries = max_entries
+        self.max_children = max_children
+        self.ttl = ttl
+        self.entries = 0
+        self.queries = 0
+        self.evictions = 0
+        self.inotify = None  # type: Optional[Inotify]
+        self._inotify_failed = False
+        self._nodes = OrderedDict()  # type: OrderedDict
+        self._watches = {}  # type: Dict[int, str]
+        self._watched = {}  # type: Dict[str, int]
+        # Bumped by every invalidation, so a listing that raced one isn't cached
+        self._generation = 0
+        self._lock = Lock()
+
+    def __len__(self) -> int:
+        return len(self._nodes)
+
+    @staticmethod
+    def normalize(path: str) -> str:
+        """Path relative to the sync folder ("" for its root); ValueError outside it."""
+        if ".." in path.split("/") or "\0" in path:
+            raise ValueError("path must be inside the sync folder")
+        return os.path.normpath("/" + path.strip("/")).lstrip("/")
+
+    def get(self, path: str, settled: bool = True) -> TreeNode:
+        """
+        The node for ``path`` (relative to the sync folder), from the cache
+        or freshly listed. ``settled`` means Dropbox is up to date, so a
+        watched node stays valid until inotify says otherwise.
+
+        Raises ValueError for paths outside the sync folder and OSError if
+        the directory can't be listed.
+        """
+        rel = self.normalize(path)
+        full = os.path.join(self.root, rel) if rel else self.root
+        real_root = os.path.realpath(self.root)
+        if os.path.commonpath([real_root, os.path.realpath(full)]) != real_root:
+            raise ValueError("path must be inside the sync folder")
+        with self._lock:
+            self._drain()
+            node = self._nodes.get(rel)
+            if node is not None and (
+                (settled and rel in self._watched) or monotonic() - node.built_at <= self.ttl
+            ):
+                self._nodes.move_to_end(rel)
+                return node
+            # Watch before listing so changes made meanwhile aren't missed
+            self._watch(rel, full)
+            generation = self._generation
+        try:
+            node = self._build(rel, full)
+        except OSError:
+            with self._lock:
+                if rel not in self._nodes:
+                    self._unwatch(rel)
+            raise
+        with self._lock:
+            self._drain()
+            if generation == self._generation:
+                self._store(node)
+            elif rel not in self._nodes:
+                self._unwatch(rel)
+        return node
+
+    def invalidate_all(self) -> None:
+        with self._lock:
+            self._generation += 1
+            for rel in list(self._nodes):
+                self._unwatch(rel)
+            self._nodes.clear()
+            self.entries = 0
+
+    def close(self) -> None:
+        with self._lock:
+            self._nodes.clear()
+            self.entries = 0
+            self._watches.clear()
+            self._watched.clear()
+            if self.inotify is not None:
+                self.inotify.close()
+                self.inotify = None
+
+    def _build(self, rel: str, path: str) -> TreeNode:
+        excluded = self._excluded_children(rel)
+        children = []  # type: List[Tuple[str, bool]]
+        total = 0
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if (not rel and entry.name in self.SKIP_AT_ROOT) or entry.name.lower() in excluded:
+                    continue
+                total += 1
+                if len(children) < self.max_children:
+                    try:
+                        children.append((entry.name, entry.is_dir(follow_symlinks=False)))
+                    except OSError:
+                        children.append((entry.name, False))
+
+        statuses = self.dropbox.query_file_statuses(
+            [path] + [os.path.join(path, name) for name, _ in children]
+        )
+        self.queries += len(statuses)
+        rows = [
+            (name, TREE_STATUSES.index(FILE_STATUS_BUCKETS.get(status or "", "unknown"))
+             | (TreeNode.DIR if is_dir else 0))
+            for (name, is_dir), status in zip(children, statuses[1:])
+        ]
+        # Selective sync folders aren't on disk at all
+        rows.extend(
+            (name, TREE_STATUSES.index("excluded") | TreeNode.DIR) for name in excluded.values()
+        )
+        rows.sort()
+        own = FILE_STATUS_BUCKETS.get(statuses[0] or "", "unknown") if statuses else "unknown"
+        return TreeNode(
+            rel,
+            own,
+            [name for name, _ in rows],
+            array("B", [code for _, code in rows]),
+            total + len(excluded),
+        )
+
+    def _excluded_children(self, rel: str) -> Dict[str, str]:
+        """Excluded folders directly in ``rel``, by lowercased name."""
+        try:
+            excluded = self.dropbox.query_exclude_list() or []
+        except Exception:
+            excluded = []
+        children = {}
+        for path in excluded:
+            if os.path.isabs(path):
+                path = os.path.relpath(path, self.root)
+            parent, _, name = path.strip("/").rpartition("/")
+            # Dropbox paths are case-insensitive
+            if name and parent.lower() == rel.lower():
+                children[name.lower()] = name
+        return children
+
+    def _store(self, node: TreeNode) -> None:
+        old = self._nodes.pop(node.path, None)
+        if old is not None:
+            self.entries -= len(old.names)
+        self._nodes[node.path] = node
+        self.entries += len(node.names)
+        while len(self._nodes) > 1 and (
+            len(self._nodes) > self.max_dirs or self.entries > self.max_entries
+        ):
+            rel, evicted = self._nodes.popitem(last=False)
+            self.entries -= len(evicted.names)
+            self.evictions += 1
+            self._unwatch(rel)
+
+    def _invalidate(self, rel: str) -> None:
+        """Drop ``rel`` and its ancestors, whose rolled-up statuses include it."""
+        self._generation += 1
+        while True:
+            node = self._nodes.pop(rel, None)
+            if node is not None:
+                self.entries -= len(node.names)
+                self._unwatch(rel)
+            if not rel:
+                return
+            rel = rel.rpartition("/")[0]
+
+    def _watch(self, rel: str, path: str) -> None:
+        if self.inotify is None and not self._inotify_failed:
+            try:
+                self.inotify = Inotify()
+            except OSError as e:
+                self._inotify_failed = True
+                self.logger.warning("inotify unavailable (%s), /status/tree uses its TTL only", e)
+        if self.inotify is None or rel in self._watched:
+            return
+        try:
+            wd = self.inotify.add_watch(path, self.MASK)
+        except OSError as e:
+            # Most likely out of watches, which the daemon needs more than we do
+            self.logger.debug("Not watching %s: %s", path, e)
+            return
+        self._watches[wd] = rel
+        self._watched[rel] = wd
+
+    def _unwatch(self, rel: str) -> None:
+        wd = self._watched.pop(rel, None)
+        if wd is not None:
+            del self._watches[wd]
+            self.inotify.rm_watch(wd)
+
+    def _drain(self) -> None:
+        """Apply the inotify events queued since the last lookup."""
+        if self.inotify is None:
+            return
+        while True:
+            events = self.inotify.read(0)
+            if not events:
+                return
+            for event in events:
+                if event.mask & Inotify.IN_Q_OVERFLOW:
+                    self._generation += 1
+                    self._nodes.clear()
+                    self.entries = 0
+                    for wd in list(self._watches):
+                        self.inotify.rm_watch(wd)
+                    self._watches.clear()
+                    self._watched.clear()
+                    continue
+                rel = self._watches.get(event.wd)
+                if rel is None:
+                    continue
+                if event.mask & Inotify.IN_IGNORED:
+                    # The directory is gone, and so is its watch
+                    del self._watches[event.wd]
+                    self._watched.pop(rel, None)
+                self._invalidate(rel)
+
+
+class StatusTreeCollector:
+    """Exports the size of the /status/tree cache."""
+
+    def __init__(self, tree: StatusTree) -> None:
+        self.tree = tree
+
+    def collect(self):
+        yield GaugeMetricFamily(
+            "dropbox_status_tree_directories",
+            "Directories held in the /status/tree cache",
+            value=len(self.tree),
+        )
+        yield GaugeMetricFamily(
+            "dropbox_status_tree_entries",
+            "Children of cached directories held in the /status/tree cache",
+            value=self.tree.entries,
+        )
+        yield CounterMetricFamily(
+            "dropbox_status_tree_path_queries",
+            "Paths whose sync status /status/tree asked the daemon for",
+            value=self.tree.queries,
+        )
+        yield CounterMetricFamily(
+            "dropbox_status_tree_evictions",
+            "Directories dropped from the /status/tree cache to stay within its limits",
+            value=self.tree.evictions,
+        )
+
+
+class ExcludeJob:
+    """One POST or DELETE /exclude: a list of paths to exclude or sync again."""
+
+    __slots__ = (
+        "id", "action", "paths", "state", "done", "failed", "errors",
+        "created_at", "started_at", "finished_at",
+    )
+
+    QUEUED = "queued"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+
+    def __init__(self, job_id: str, action: str, paths: List[str]) -> None:
+        self.id = job_id
+        self.action = action
+        self.paths = paths
+        self.state = self.QUEUED
+        self.done = 0
+        self.failed = 0
+        self.errors = []  # type: List[dict]
+        self.created_at = time()
+        self.started_at = None  # type: Optional[float]
+        self.finished_at = None  # type: Optional[float]
+
+    def as_dict(self) -> dict:
+        return {
+            "id": self.id,
+            "action": self.action,
+            "state": self.state,
+            "paths": len(self.paths),
+            "done": self.done,
+            "failed": self.failed,
+            "errors": self.errors,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+        }
+
+
+class ExcludeJobs:
+    """
+    Background queue for selective sync changes.
+
+    Each job's paths (relative to the sync folder) go to the daemon
+    ``batch_size`` at a time from one worker thread, so a request for
+    thousands of paths returns at once and one slow batch doesn't hold up an
+    HTTP thread. A failed batch is recorded on the job and the next one is
+    tried. At most ``max_queued`` jobs wait, and the last ``keep`` jobs stay
+    around for their status URL. ``on_change`` runs after a job changed
+    anything.
+    """
+
+    ACTIONS = ("add", "remove")
+    # Failed batches listed on a job; the rest are only counted
+    MAX_ERRORS = 10
+
+    def __init__(
+        self,
+        dropbox: DropboxInterface,
+        root: str = SYNC_ROOT,
+        logger: Optional[logging.Logger] = None,
+        registry: CollectorRegistry = REGISTRY,
+        on_change: Callable[[], None] = lambda: None,
+        batch_size: int = FILE_STATUS_BATCH,
+        max_queued: int = 16,
+        keep: int = 100,
+    ) -> None:
+        self.dropbox = dropbox
+        self.root = root
+        self.logger = logger or logging.getLogger("dropbox_monitor")
+        self.on_change = on_change
+        self.batch_size = batch_size
+        self.max_queued = max_queued
+        self.keep = keep
+        self.jobs = OrderedDict()  # type: OrderedDict
+        self._queue = deque()  # type: deque
+        self._cond = Condition()
+        self._next_id = 0
+        self._stop = Event()
+        self._thread = None  # type: Optional[Thread]
+        self.paths_counter = Counter(
+            "dropbox_exclude_paths",
+            "Paths sent to the daemon by the /exclude API",
+            ["action", "result"],
+            registry=registry,
+        )
+        self.queued_gauge = Gauge(
+            "dropbox_exclude_jobs_queued",
+            "/exclude jobs waiting for the worker",
+            registry=registry,
+        )
+
+    def start(self) -> None:
+        self.queued_gauge.set_function(lambda: len(self._queue))
+        self._stop.clear()
+        self._thread = Thread(target=self.run, name="dropbox-exclude", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        with self._cond:
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+            self._thread = None
+
+    def submit(self, action: str, paths: List[str]) -> Optional[ExcludeJob]:
+        """Queue a job; None if ``max_queued`` jobs are already waiting."""
+        with self._cond:
+            if len(self._queue) >= self.max_queued:
+                return None
+            self._next_id += 1
+            job = ExcludeJob(str(self._next_id), action, paths)
+            self.jobs[job.id] = job
+            while len(self.jobs) > self.keep:
+                oldest = next(iter(self.jobs.values()))
+                if oldest.state in (ExcludeJob.QUEUED, ExcludeJob.RUNNING):
+                    break
+                self.jobs.popitem(last=False)
+            self._queue.append(job)
+            self._cond.notify()
+            return job
+
+    def get(self, job_id: str) -> Optional[ExcludeJob]:
+        with self._cond:
+            return self.jobs.get(job_id)
+
+    def run(self) -> None:
+        while not self._stop.is_set():
+            with self._cond:
+                while not self._queue and not self._stop.is_set():
+                    self._cond.wait()
+                if self._stop.is_set():
+                    return
+                job = self._queue.popleft()
+            self.process(job)
+
+    def process(self, job: ExcludeJob) -> None:
+        change = self.dropbox.exclude_add if job.action == "add" else self.dropbox.exclude_remove
+        job.state = ExcludeJob.RUNNING
+        job.started_at = time()
+        for start in range(0, len(job.paths), self.batch_size):
+            batch = job.paths[start:start + self.batch_size]
+            try:
+                change([os.path.join(self.root, path) for path in batch])
+            except Exception as e:
+                self.logger.warning("exclude %s of %d paths failed: %s", job.action, len(batch), e)
+                job.failed += len(batch)
+                if len(job.errors) < self.MAX_ERRORS:
+                    job.errors.append({"paths": batch, "error": str(e)})
+                self.paths_counter.labels(action=job.action, result="error").inc(len(batch))
+            else:
+                job.done += len(batch)
+                self.paths_counter.labels(action=job.action, result="ok").inc(len(batch))
+        job.state = ExcludeJob.FAILED if job.failed else ExcludeJob.DONE
+        job.finished_at = time()
+        if job.done:
+            self.on_change()
+
+
+SYNC_ERROR_LINE = re.compile(r'Can\'t sync "(?P<path>.*)" \((?P<reason>[^()]*)\)\s*$')
+
+
+def parse_sync_error(line: str) -> Tuple[str, str]:
+    """Split a `Can't sync "path" (reason)` line into (path, reason)."""
+    match = SYNC_ERROR_LINE.match(line)
+    if match:
+        return match.group("path"), match.group("reason")
+    return "", line[len("Can't sync"):].strip() or "unknown"
+
+
+class SyncError:
+    __slots__ = ("path", "reason", "first_seen", "last_seen", "count")
+
+    def __init__(self, path: str, reason: str, seen: float) -> None:
+        self.path = path
+        self.reason = reason
+        self.first_seen = seen
+        self.last_seen = seen
+        self.count = 0
+
+    def as_dict(self) -> dict:
+        return {
+            "path": self.path,
+            "reason": self.reason,
+            "first_seen": self.first_seen,
+            "last_seen": self.last_seen,
+            "count": self.count,
+        }
+
+
+class SyncErrorIndex:
+    """
+    Sync errors keyed by (path, reason), with first/last seen times and how
+    many polls reported them.
+
+    Bounded on every axis so an error storm can't grow it: the least recently
+    seen entries are evicted past ``max_entries``, paths are truncated to
+    ``max_path_length`` and reasons beyond the first ``max_reasons`` are
+    counted as "other" (they become Prometheus labels).
+    """
+
+    OTHER_REASON = "other"
+
+    def __init__(
+        self, max_entries: int = 1000, max_reasons: int = 32, max_path_length: int = 1024
+    ) -> None:
+        self.max_entries = max_entries
+        self.max_reasons = max_reasons
+        self.max_path_length = max_path_length
+        self.evicted = 0
+        self.counts_by_reason = {}  # type: Dict[str, int]
+        self._entries = OrderedDict()  # type: OrderedDict
+        self._lock = Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def record(self, line: str, seen: float) -> SyncError:
+        path, reason = parse_sync_error(line)
+        path = path[: self.max_path_length]
+        with self._lock:
+            if reason not in self.counts_by_reason:
+                if len(self.counts_by_reason) >= self.max_reasons:
+                    reason = self.OTHER_REASON
+                self.counts_by_reason.setdefault(reason, 0)
+            self.counts_by_reason[reason] += 1
+
+            key = (path, reason)
+            entry = self._entries.get(key)
+            if entry is None:
+                entry = self._entries[key] = SyncError(path, reason, seen)
+                if len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+                    self.evicted += 1
+            else:
+                self._entries.move_to_end(key)
+            entry.last_seen = seen
+            entry.count += 1
+            return entry
+
+    def query(self, offset: int = 0, limit: int = 100, reason: Optional[str] = None) -> dict:
+        """A page of errors, most recently seen first."""
+        with self._lock:
+            entries = [
+                entry.as_dict()
+                for entry in reversed(self._entries.values())
+                if reason is None or entry.reason == reason
+            ]
+        return {
+            "total": len(entries),
+            "offset": offset,
+            "limit": limit,
+            "errors": entries[offset:offset + limit],
+            "evicted": self.evicted,
+        }
+
+
+class SyncErrorCollector:
+    """Exports sync error counts by reason."""
+
+    def __init__(self, index: SyncErrorIndex) -> None:
+        self.index = index
+
+    def collect(self):
+        errors = CounterMetricFamily(
+            "dropbox_sync_errors",
+            "Sync errors reported by Dropbox, counted once per poll that shows them",
+            labels=["reason"],
+        )
+        for reason, count in list(self.index.counts_by_reason.items()):
+            errors.add_metric([reason], count)
+        yield errors
+        yield GaugeMetricFamily(
+            "dropbox_sync_errors_tracked",
+            "Distinct (path, reason) sync errors held in the error index",
+            value=len(self.index),
+        )
+        yield CounterMetricFamily(
+            "dropbox_sync_errors_evicted",
+            "Sync errors dropped from the error index to stay within its limit",
+            value=self.index.evicted,
+        )
+
+
+class ParsedStatus(NamedTuple):
+    """Everything parse_status extracts from one `dropbox status` output."""
+
+    state: State
+    num_syncing: Optional[int] = None
+    num_downloading: Optional[int] = None
+    num_uploading: Optional[int] = None
+    transfer_rates: Optional[Dict[Direction, float]] = None
+    eta_seconds: Optional[int] = None
+    up_to_date: bool = False
+    last_error: Optional[str] = None
+    errors: Tuple[str, ...] = ()
+
+
+def parse_status(results: str, logger: Optional[logging.Logger] = None) -> ParsedStatus:
+    """
+    Parse `dropbox status` output in a single pass.
+
+    Each line is dispatched on its first word; progress lines are then
+    decoded by one combined regex. See DropboxMonitor.parse_output for the
+    observed messages.
+    """
+    state = State.UNKNOWN
+    counts = {}  # type: Dict[str, int]
+    transfer_rates = {}  # type: Dict[Direction, float]
+    eta_seconds = None  # type: Optional[int]
+    up_to_date = False
+    errors = []  # type: List[str]
+
+    for line in results.splitlines():
+        if not line:
+            continue
+        try:
+            word = line.partition(" ")[0].rstrip(".")
+            if word in ACTION_DIRECTIONS or word == "Indexing":
+                match = PROGRESS_LINE.match(line)
+                if match:
+                    state = State.SYNCING
+                    action, count, rate, rate_unit, eta, eta_unit = match.groups()
+                    if action != "Indexing":
+                        counts[action] = int(count.replace(",", "")) if count else 1
+                        if rate:
+                            transfer_rates[ACTION_DIRECTIONS[action]] = (
+                                float(rate.replace(",", "")) * RATE_UNITS[rate_unit]
+                            )
+                    if eta:
+                        eta = int(eta.replace(",", "")) * DURATION_UNITS[eta_unit]
+                        eta_seconds = max(eta, eta_seconds or 0)
+                elif word == "Syncing":
+                    state = State.SYNCING
+                elif word == "Indexing":
+                    state = State.INDEXING
+                elif logger:
+                    logger.debug("Ignoring line '%s'", line)
+            elif word == "Up" and line.startswith("Up to date"):
+                state = State.UP_TO_DATE
+                counts = {"Syncing": 0, "Downloading": 0, "Uploading": 0}
+                up_to_date = True
+            elif word == "Dropbox" and line == "Dropbox isn't running!":
+                state = State.NOT_RUNNING
+            elif word == "Starting":
+                state = State.STARTING
+            elif word == "Can't" and line.startswith("Can't sync"):
+                state = State.SYNC_ERROR
+                errors.append(line)
+            elif logger:
+                logger.debug("Ignoring line '%s'", line)
+        except Exception:
+            if logger:
+                logger.exception("Failed to parse status line '%s'", line)
+
+    last_error = errors[-1] if errors else None
+    if state not in (State.SYNCING, State.UP_TO_DATE):
+        return ParsedStatus(
+            state, transfer_rates={}, up_to_date=up_to_date, last_error=last_error,
+            errors=tuple(errors),
+        )
+    return ParsedStatus(
+        state=state,
+        num_syncing=counts.get("Syncing"),
+        num_downloading=counts.get("Downloading"),
+        num_uploading=counts.get("Uploading"),
+        transfer_rates=transfer_rates,
+        eta_seconds=eta_seconds,
+        up_to_date=up_to_date,
+        last_error=last_error,
+        errors=tuple(errors),
+    )
+
+
+class HealthCheck:
+    """
+    Liveness and readiness for /health, from the latest snapshot only.
+
+    Live: the sampler is still refreshing (the snapshot is younger than
+    ``stale_after``) and the daemon hasn't been gone for longer than
+    ``down_after``: "Dropbox isn't running!", or no answer at all and no
+    process. A daemon that answers counts as up even if its PID can't be
+    found (no pid file, ``hidepid``).
+
+    Ready: live, not stuck on sync errors for longer than ``error_after``,
+    and up to date within the last ``unsynced_after`` seconds (0: no limit).
+    """
+
+    def __init__(
+        self,
+        stale_after: float = 300.0,
+        down_after: float = 120.0,
+        error_after: float = 900.0,
+        unsynced_after: float = 86400.0,
+    ) -> None:
+        self.stale_after = stale_after
+        self.down_after = down_after
+        self.error_after = error_after
+        self.unsynced_after = unsynced_after
+        self.down_since = None  # type: Optional[float]
+        self.error_since = None  # type: Optional[float]
+
+    def observe(self, snapshot: StatusSnapshot) -> None:
+        """Track how long the daemon has been down or in error; once per refresh."""
+        if snapshot.state == State.NOT_RUNNING or (
+            snapshot.state == State.UNKNOWN and snapshot.daemon is None
+        ):
+            if self.down_since is None:
+                self.down_since = snapshot.taken_at
+        else:
+            self.down_since = None
+        if snapshot.state == State.SYNC_ERROR:
+            if self.error_since is None:
+                self.error_since = snapshot.taken_at
+        else:
+            self.error_since = None
+
+    def check(self, snapshot: StatusSnapshot, synced_at: float, now: Optional[float] = None) -> dict:
+        """
+        Evaluate ``snapshot``; ``synced_at`` is when Dropbox was last up to
+        date (or when monitoring started, if never).
+        """
+        now = time() if now is None else now
+        age = max(0.0, now - snapshot.taken_at)
+        down = now - self.down_since if self.down_since is not None else None
+        in_error = now - self.error_since if self.error_since is not None else None
+        unsynced = 0.0 if snapshot.state == State.UP_TO_DATE else max(0.0, now - synced_at)
+
+        failing = []
+        if age > self.stale_after:
+            failing.append("snapshot_stale")
+        if down is not None and down > self.down_after:
+            failing.append("daemon_down")
+        healthy = not failing
+        if in_error is not None and in_error > self.error_after:
+            failing.append("sync_error")
+        if self.unsynced_after and unsynced > self.unsynced_after:
+            failing.append("not_up_to_date")
+        return {
+            "healthy": healthy,
+            "ready": not failing,
+            "failing": failing,
+            "state": snapshot.state.value,
+            "daemon_pid": snapshot.daemon.pid if snapshot.daemon else None,
+            "snapshot_age_seconds": round(age, 3),
+            "down_seconds": round(down, 3) if down is not None else None,
+            "sync_error_seconds": round(in_error, 3) if in_error is not None else None,
+            "since_up_to_date_seconds": round(unsynced, 3),
+        }
+
+
+class DropboxMonitor:
+    def __init__(
+        self,
+        dropbox: DropboxInterface,
+        min_poll_interval_sec: int,
+        logger: logging.Logger,
+        prom_port: int,
+        process_reader: Optional[DaemonProcessReader] = None,
+        max_poll_interval_sec: Optional[int] = None,
+        watch_paths: Sequence[str] = (),
+        journal: Optional[StateJournal] = None,
+        folder_indexer: Optional[FolderIndexer] = None,
+        instance: Optional[str] = None,
+        registry: CollectorRegistry = REGISTRY,
+        socket_path: str = COMMAND_SOCKET,
+        query_slots: Optional["QuerySlots"] = None,
+        status_tree: Optional[StatusTree] = None,
+        health: Optional[HealthCheck] = None,
+    ) -> None:
+        self.dropbox = dropbox
+        self.process_reader = process_reader or DaemonProcessReader()
+        self.min_poll_interval_sec = min_poll_interval_sec
+        self.scheduler = PollScheduler(min_poll_interval_sec, max_poll_interval_sec)
+        # A few missed polls at the slowest interval before the sampler counts as stuck
+        self.health = health or HealthCheck(stale_after=max(300.0, 3 * self.scheduler.ceiling))
+        self.startup = StartupTracker(self.process_reader, socket_path)
+        # With several instances, each one's metrics live in their own
+        # registry and InstanceCollector adds the instance label
+        self.instance = instance
+        self.registry = registry
+        self.query_slots = query_slots
+        self.history = StatusHistory()
+        self.events = StatusEventBus()
+        self.errors = SyncErrorIndex()
+        self.status_tree = (
+            status_tree if status_tree is not None else StatusTree(dropbox, logger=logger)
+        )
+        self.folder_indexer = folder_indexer
+        self.watch_paths = list(watch_paths)
+        self.logger = logger
+        self.prom_port = prom_port
+        self.num_syncing = None  # type: Optional[int]
+        self.num_downloading = None  # type: Optional[int]
+        self.num_uploading = None  # type: Optional[int]
+        self.state = State.STARTING
+        self.raw_status = ""
+        self.last_error = None  # type: Optional[str]
+        self.last_sync_time = None  # type: Optional[float]
+        self.transfer_rates = {}  # type: Dict[Direction, float]
+        self.eta_seconds = None  # type: Optional[int]
+        self.daemon_stats = None  # type: Optional[DaemonProcessStats]
+        self.start_time = time()
+        self.previous_start_time = None  # type: Optional[float]
+        self.restart_count = 0
+        self.journal = journal
+        self._journaled_state = None  # type: Optional[State]
+        self._journaled_sync = None  # type: Optional[float]
+        self._journaled_error = None  # type: Optional[str]
+        if journal is not None:
+            self._replay_journal()
+
+        self.snapshot = self._build_snapshot(self.start_time, 0.0)
+        self._flights = SingleFlight()
+        self._stop_event = Event()
+        self._wake_event = Event()
+        self._sampler = None  # type: Optional[Thread]
+        self._watcher = None  # type: Optional[ChangeWatcher]
+
+        self.num_syncing_gauge = Gauge(
+            "dropbox_num_syncing",
+            "Number of files currently syncing",
+            registry=registry,
+        )
+
+        self.num_downloading_gauge = Gauge(
+            "dropbox_num_downloading",
+            "Number of files currently downloading",
+            registry=registry,
+        )
+
+        self.num_uploading_gauge = Gauge(
+            "dropbox_num_uploading",
+            "Number of files currently uploading",
+            registry=registry,
+        )
+
+        self.status_enum = EnumMetric(
+            "dropbox_status",
+            "Status reported by Dropbox client",
+            states=[state.value for state in State.__members__.values()],
+            registry=registry,
+        )
+
+        self.snapshot_age_gauge = Gauge(
+            "dropbox_status_snapshot_age_seconds",
+            "Seconds since the status snapshot was last refreshed",
+            registry=registry,
+        )
+
+        self.poll_interval_gauge = Gauge(
+            "dropbox_status_poll_interval_seconds",
+            "Current delay between scheduled status polls",
+            registry=registry,
+        )
+
+        self.history_bytes_gauge = Gauge(
+            "dropbox_status_history_bytes",
+            "Memory held by the in-memory status history",
+            registry=registry,
+        )
+
+        self.stream_subscribers_gauge = Gauge(
+            "dropbox_status_stream_subscribers",
+            "Clients connected to /status/stream",
+            registry=registry,
+        )
+
+        self.refreshes_counter = Counter(
+            "dropbox_status_refreshes",
+            "Status refreshes by the background sampler",
+            ["trigger"],
+            registry=registry,
+        )
+
+        self.refresh_duration_histogram = Histogram(
+            "dropbox_status_refresh_duration_seconds",
+            "Time taken to query and parse Dropbox status",
+            buckets=(0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30),
+            registry=registry,
+        )
+
+        self.stage_duration_histogram = Histogram(
+            "dropbox_monitor_stage_duration_seconds",
+            "Time spent by the monitor itself in each stage of a refresh or /status request",
+            ["stage"],
+            buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10),
+            registry=registry,
+        )
+
+        self.transfer_rate_gauge = Gauge(
+            "dropbox_transfer_rate_bytes_per_second",
+            "Transfer rate reported by Dropbox client",
+            ["direction"],
+            registry=registry,
+        )
+
+        self.eta_gauge = Gauge(
+            "dropbox_sync_eta_seconds",
+            "Estimated time remaining reported by Dropbox client",
+            registry=registry,
+        )
+
+        self.transfer_rate_histogram = Histogram(
+            "dropbox_transfer_rate_observed_bytes_per_second",
+            "Distribution of transfer rates reported by Dropbox client",
+            ["direction"],
+            buckets=tuple(1024 * 4 ** i for i in range(11)),
+            registry=registry,
+        )
+
+        registry.register(CacheCollector(dropbox))
+        registry.register(DaemonProcessCollector(self))
+        registry.register(StartupCollector(self.startup))
+        registry.register(SyncErrorCollector(self.errors))
+        registry.register(StatusTreeCollector(self.status_tree))
+        self.exclude_jobs = ExcludeJobs(
+            dropbox, self.status_tree.root, logger, registry,
+            on_change=self.status_tree.invalidate_all,
+        )
+        if folder_indexer is not None:
+            registry.register(FolderIndexCollector(folder_indexer.index))
+
+    def start(self, serve_metrics: bool = True) -> None:
+        self.status_enum.state(State.STARTING.value)
+        self.num_syncing_gauge.set_function(
+            partial(self.get_status, Metric.NUM_SYNCING)
+        )
+        self.num_downloading_gauge.set_function(
+            partial(self.get_status, Metric.NUM_DOWNLOADING)
+        )
+        self.num_uploading_gauge.set_function(
+            partial(self.get_status, Metric.NUM_UPLOADING)
+        )
+        self.snapshot_age_gauge.set_function(self.get_snapshot_age)
+        self.poll_interval_gauge.set_function(lambda: self.scheduler.interval)
+        self.history_bytes_gauge.set_function(self.history.memory_bytes)
+        self.stream_subscribers_gauge.set_function(lambda: self.events.subscribers)
+        for direction in Direction:
+            self.transfer_rate_gauge.labels(direction=direction.value).set_function(
+                partial(self.get_transfer_rate, direction)
+            )
+        self.eta_gauge.set_function(lambda: self.snapshot.eta_seconds or 0)
+
+        self.start_sampler()
+        self.exclude_jobs.start()
+        if self.folder_indexer is not None:
+            self.folder_indexer.start()
+        if serve_metrics:
+            start_http_server(self.prom_port)
+            self.logger.info("Started Prometheus server on port %d", self.prom_port)
+
+    def start_sampler(self) -> None:
+        """Start the background thread that keeps the status snapshot fresh."""
+        self._stop_event.clear()
+        self._wake_event.clear()
+        self._sampler = Thread(
+            target=self._sample_loop, name="dropbox-sampler", daemon=True
+        )
+        self._sampler.start()
+        if self.watch_paths:
+            # The daemon appearing, not its own bookkeeping, is news
+            socket_path = self.startup.socket_path
+            self._watcher = ChangeWatcher(
+                self.watch_paths, self.notify_change, self.logger,
+                triggers={
+                    os.path.dirname(socket_path): ("info.json", os.path.basename(socket_path))
+                },
+            )
+            if not self._watcher.start():
+                self._watcher = None
+        self.logger.info(
+            "Started status sampler (interval: %g-%gs)",
+            self.scheduler.floor,
+            self.scheduler.ceiling,
+        )
+
+    def stop(self) -> None:
+        self._stop_event.set()
+        self._wake_event.set()
+        if self._watcher is not None:
+            self._watcher.stop()
+            self._watcher = None
+        if self._sampler is not None:
+            self._sampler.join(timeout=5)
+            self._sampler = None
+        self.events.close()
+        self.exclude_jobs.stop()
+        self.status_tree.close()
+        if self.folder_indexer is not None:
+            self.folder_indexer.stop()
+        if self.journal is not None:
+            self._journal_changes(final=True)
+            self.journal.close()
+
+    def _replay_journal(self) -> None:
+        """Restore last sync, last error and the state timeline from the journal."""
+        started = monotonic()
+        try:
+            records = self.journal.replay()
+        except OSError as e:
+            self.logger.warning("State journal disabled, can't open %s: %s", self.journal.path, e)
+            self.journal = None
+            return
+        for record in records:
+            if record.kind == StateJournal.START:
+                self.previous_start_time = record.timestamp
+            elif record.kind == StateJournal.STATE:
+                if len(record.payload) == 1 and record.payload[0] < len(STATES_BY_CODE):
+                    self.history.record_state(record.timestamp, STATES_BY_CODE[record.payload[0]])
+                else:
+                    self.logger.warning(
+                        "Skipping journal state record with payload %r", record.payload
+                    )
+            elif record.kind == StateJournal.SYNC:
+                self.last_sync_time = self._journaled_sync = record.timestamp
+            elif record.kind == StateJournal.ERROR:
+                self.last_error = self._journaled_error = record.payload.decode(errors="replace")
+        self.journal.append(StateJournal.START, self.start_time)
+        self.journal.flush(force=True)
+        self.logger.info(
+            "Replayed %d journal records in %.3fs", len(records), monotonic() - started
+        )
+
+    def _journal_changes(self, final: bool = False) -> None:
+        """
+        Append what changed since the last refresh. Syncs are only written once
+        a minute while up to date (and on shutdown), which is plenty for
+        staleness alerts.
+        """
+        journal = self.journal
+        now = time()
+        if self.state != self._journaled_state:
+            journal.append(StateJournal.STATE, now, bytes([STATE_CODES[self.state]]))
+            self._journaled_state = self.state
+        if self.last_sync_time is not None and self.last_sync_time != self._journaled_sync and (
+            final
+            or self._journaled_sync is None
+            or self.last_sync_time - self._journaled_sync >= JOURNAL_SYNC_INTERVAL_SEC
+        ):
+            journal.append(StateJournal.SYNC, self.last_sync_time)
+            self._journaled_sync = self.last_sync_time
+        if self.last_error is not None and self.last_error != self._journaled_error:
+            journal.append(StateJournal.ERROR, now, self.last_error.encode())
+            self._journaled_error = self.last_error
+        journal.flush(force=final)
+
+    def notify_change(self) -> None:
+        """Poll as soon as the floor interval allows, e.g. after a change on disk."""
+        self.scheduler.reset()
+        self._wake_event.set()
+
+    def _sample_loop(self) -> None:
+        trigger = "schedule"
+        while not self._stop_event.is_set():
+            started = monotonic()
+            self.refreshes_counter.labels(trigger=trigger).inc()
+            try:
+                self.refresh()
+            except Exception:
+                self.logger.exception("Status refresh failed")
+            trigger = "schedule"
+            if self._wake_event.wait(self.scheduler.update(self.snapshot.state)):
+                self._wake_event.clear()
+                trigger = "change"
+                # Coalesce bursts of changes: never poll faster than the floor
+                self._stop_event.wait(self.scheduler.floor - (monotonic() - started))
+
+    def refresh(self, timeout: Optional[float] = None) -> StatusSnapshot:
+        """
+        Query Dropbox, parse the result and publish a new snapshot.
+
+        Concurrent callers share one in-flight query.
+        """
+        return self._flights.do("refresh", self._refresh, timeout)
+
+    def _refresh(self) -> StatusSnapshot:
+        started = monotonic()
+        token = self.query_slots.acquire() if self.query_slots is not None else None
+        try:
+            with self.stage_timer("query"):
+                dropbox_result = self.dropbox.query_status()
+        finally:
+            if token is not None:
+                self.query_slots.release(token)
+        if dropbox_result:
+            self.raw_status = dropbox_result.strip()
+            with self.stage_timer("parse"):
+                self.parse_output(dropbox_result)
+        else:
+            self.state = State.UNKNOWN
+            self.status_enum.state(State.UNKNOWN.value)
+            self.num_syncing = None
+            self.num_downloading = None
+            self.num_uploading = None
+            self.transfer_rates = {}
+            self.eta_seconds = None
+        try:
+            with self.stage_timer("process_stats"):
+                self.daemon_stats = self.process_reader.read()
+        except Exception:
+            self.logger.exception("Failed to read dropboxd process stats")
+            self.daemon_stats = None
+        self.startup.observe(self.state, self.daemon_stats, time())
+        duration = monotonic() - started
+        self.refresh_duration_histogram.observe(duration)
+        with self.stage_timer("snapshot"):
+            previous = self.snapshot
+            self.snapshot = self._build_snapshot(time(), duration)
+            self._publish_changes(previous, self.snapshot)
+            self.history.record(self.snapshot)
+            self.health.observe(self.snapshot)
+        if self.snapshot.state != previous.state:
+            # Per-path statuses cached before a transition can't be trusted
+            self.status_tree.invalidate_all()
+        if self.journal is not None:
+            try:
+                self._journal_changes()
+            except OSError:
+                self.logger.exception("Failed to write state journal")
+        return self.snapshot
+
+    def _publish_changes(self, previous: StatusSnapshot, snapshot: StatusSnapshot) -> None:
+        """Push state transitions and changed counts to /status/stream."""
+        if snapshot.state != previous.state:
+            self.events.publish("state", {
+                "state": snapshot.state.value,
+                "previous": previous.state.value,
+                "raw_status": snapshot.raw_status,
+                "taken_at": snapshot.taken_at,
+            })
+        counts = {
+            name: value
+            for name, value, old in (
+                ("syncing", snapshot.num_syncing, previous.num_syncing),
+                ("downloading", snapshot.num_downloading, previous.num_downloading),
+                ("uploading", snapshot.num_uploading, previous.num_uploading),
+            )
+            if value != old
+        }
+        if counts:
+            counts["taken_at"] = snapshot.taken_at
+            self.events.publish("counts", counts)
+
+    def get_stream_snapshot(self) -> dict:
+        """First event of a /status/stream; later events are relative to it."""
+        snapshot = self.snapshot
+        return {
+            "state": snapshot.state.value,
+            "raw_status": snapshot.raw_status,
+            "syncing": snapshot.num_syncing,
+            "downloading": snapshot.num_downloading,
+            "uploading": snapshot.num_uploading,
+            "last_sync": snapshot.last_sync_time,
+            "last_error": snapshot.last_error,
+            "taken_at": snapshot.taken_at,
+        }
+
+    def _build_snapshot(self, taken_at: float, duration: float) -> StatusSnapshot:
+        return StatusSnapshot(
+            state=self.state,
+            raw_status=self.raw_status,
+            num_syncing=self.num_syncing,
+            num_downloading=self.num_downloading,
+            num_uploading=self.num_uploading,
+            last_error=self.last_error,
+            last_sync_time=self.last_sync_time,
+            taken_at=taken_at,
+            refresh_duration=duration,
+            sync_rate=self.transfer_rates.get(Direction.SYNC),
+            download_rate=self.transfer_rates.get(Direction.DOWNLOAD),
+            upload_rate=self.transfer_rates.get(Direction.UPLOAD),
+            eta_seconds=self.eta_seconds,
+            daemon=self.daemon_stats,
+        )
+
+    def get_snapshot_age(self) -> float:
+        return max(0.0, time() - self.snapshot.taken_at)
+
+    def get_transfer_rate(self, direction: Direction) -> float:
+        return self.snapshot.transfer_rate(direction) or 0.0
+
+    def get_status(self, metric: Metric) -> int:
+        """Read a count from the latest snapshot. Never queries Dropbox."""
+        snapshot = self.snapshot
+        if metric == Metric.NUM_SYNCING:
+            return snapshot.num_syncing or 0
+        elif metric == Metric.NUM_DOWNLOADING:
+            return snapshot.num_downloading or 0
+        elif metric == Metric.NUM_UPLOADING:
+            return snapshot.num_uploading or 0
+        else:
+            raise ValueError(metric)
+
+    def get_history(self, since: float = 0.0, step: float = 0.0) -> dict:
+        """
+        History for /status/history. A negative ``since`` is relative to
+        now (``-3600``: the last hour).
+        """
+        if since < 0:
+            since += time()
+        history = self.history.query(since, step)
+        history["memory_bytes"] = self.history.memory_bytes()
+        history["levels"] = self.history.stats()
+        return history
+
+    def get_errors(self, offset: int = 0, limit: int = 100, reason: Optional[str] = None) -> dict:
+        """Page of sync errors for /status/errors."""
+        return self.errors.query(offset, limit, reason)
+
+    def get_health(self) -> dict:
+        """Liveness and readiness for /health. Never queries Dropbox."""
+        snapshot = self.snapshot
+        return self.health.check(snapshot, snapshot.last_sync_time or self.start_time)
+
+    def get_tree(
+        self,
+        path: str = "",
+        offset: int = 0,
+        limit: int = 100,
+        status: Optional[str] = None,
+        timeout: Optional[float] = None,
+    ) -> dict:
+        """
+        Page of /status/tree: one directory's children and their statuses.
+        Concurrent requests for the same directory share one listing.
+        """
+        rel = self.status_tree.normalize(path)
+        settled = self.snapshot.state == State.UP_TO_DATE
+        node = self._flights.do(
+            "tree:" + rel, partial(self.status_tree.get, rel, settled), timeout
+        )
+        return node.as_dict(offset, limit, status)
+
+    def stage_timer(self, stage: str):
+        """Context manager observing the time spent in ``stage``."""
+        return self.stage_duration_histogram.labels(stage=stage).time()
+
+    def get_shared_json_status(self, timeout: Optional[float] = None) -> dict:
+        """get_json_status, shared between concurrent /status requests."""
+        return self._flights.do("json_status", self._timed_json_status, timeout)
+
+    def _timed_json_status(self) -> dict:
+        with self.stage_timer("status_json"):
+            return self.get_json_status()
+
+    def get_json_status(self) -> dict:
+        """Build a JSON-serializable status dict for the /status endpoint."""
+        snapshot = self.snapshot
+
+        # Account info (redacted for privacy — no PII in API responses)
+        account = {}
+        info = self.dropbox.query_account_info()
+        if info:
+            account = {"linked": True}
+        else:
+            account = {"linked": False}
+
+        # Excluded folders
+        excluded = self.dropbox.query_exclude_list()
+
+        # Version
+        version = self.dropbox.query_version()
+
+        # Resource usage of the daemon (not this script), from the snapshot
+        stats = snapshot.daemon
+        mb = 1024 * 1024
+
+        # Uptime
+        uptime_seconds = int(time() - self.start_time)
+
+        return {
+            "status": snapshot.state.value,
+            "raw_status": snapshot.raw_status,
+            "sync": {
+                "syncing": snapshot.num_syncing or 0,
+                "downloading": snapshot.num_downloading or 0,
+                "uploading": snapshot.num_uploading or 0,
+            },
+            "transfer": {
+                "sync_bytes_per_sec": snapshot.sync_rate,
+                "download_bytes_per_sec": snapshot.download_rate,
+                "upload_bytes_per_sec": snapshot.upload_rate,
+                "eta_seconds": snapshot.eta_seconds,
+            },
+            "account": account,
+            "daemon": {
+                "version": version,
+                "uptime_seconds": uptime_seconds,
+                "pid": stats.pid if stats else None,
+                "memory_mb": round(stats.rss_bytes / mb, 1) if stats else None,
+                "peak_memory_mb": round(stats.peak_rss_bytes / mb, 1) if stats else None,
+                "cpu_seconds": round(stats.cpu_seconds, 2) if stats else None,
+                "open_fds": stats.open_fds if stats else None,
+                "threads": stats.threads if stats else None,
+                "inotify_watches": stats.inotify_watches if stats else None,
+                "restart_count": self.restart_count,
+            },
+            "startup": {
+                "daemon_started_at": self.startup.daemon_started_at,
+                "phases_seconds": self.startup.as_dict(),
+            },
+            "snapshot": {
+                "age_seconds": round(max(0.0, time() - snapshot.taken_at), 3),
+                "refresh_duration_seconds": round(snapshot.refresh_duration, 3),
+            },
+            "journal": {
+                "previous_start": self.previous_start_time,
+                "size_bytes": self.journal.size,
+                "compactions": self.journal.compactions,
+            } if self.journal is not None else None,
+            "sync_folder": self._folder_summary(),
+            "last_sync": snapshot.last_sync_time,
+            "last_error": snapshot.last_error,
+            "excluded_folders": excluded or [],
+        }
+
+    def _folder_summary(self) -> Optional[dict]:
+        if self.folder_indexer is None:
+            return None
+        index = self.folder_indexer.index
+        return {
+            scope: {"files": totals.files, "bytes": totals.bytes}
+            for scope, totals in index.selective_sync.items()
+        } if index.last_scan_time is not None else None
+
+    def parse_output(self, results: str) -> None:
+        """
+        Observed messages from `dropbox status`
+
+        Up to date
+        Syncing...
+        Indexing...
+        Syncing 176 files • 6 secs
+        Downloading 176 files (6 secs)
+        Dropbox isn't running!
+        Indexing 1 file...
+        Can't sync "monitoring.txt" (access denied)
+        Syncing "none" • 1 sec
+        Downloading 82 files (2,457 KB/sec, 2 secs)
+        """
+        parsed = parse_status(results, self.logger)
+        if parsed.up_to_date:
+            self.last_sync_time = time()
+        if parsed.last_error is not None:
+            self.last_error = parsed.last_error
+        now = time()
+        for line in parsed.errors:
+            self.errors.record(line, now)
+
+        self.state = parsed.state
+        self.status_enum.state(parsed.state.value)
+        self.num_syncing = parsed.num_syncing
+        self.num_downloading = parsed.num_downloading
+        self.num_uploading = parsed.num_uploading
+        self.transfer_rates = parsed.transfer_rates
+        self.eta_seconds = parsed.eta_seconds
+
+        for direction, rate in self.transfer_rates.items():
+            self.transfer_rate_histogram.labels(direction=direction.value).observe(rate)
+
+
+class InstanceCollector:
+    """Exports every instance's registry with an ``instance`` label on each sample."""
+
+    def __init__(self, monitors: Dict[str, DropboxMonitor]) -> None:
+        self.monitors = monitors
+
+    def collect(self):
+        families = OrderedDict()  # type: OrderedDict
+        for name, monitor in self.monitors.items():
+            for metric in monitor.registry.collect():
+                family = families.get(metric.name)
+                if family is None:
+                    family = families[metric.name] = MetricFamily(
+                        metric.name, metric.documentation, metric.type, metric.unit
+                    )
+                family.samples.extend(
+                    sample._replace(labels=dict(sample.labels, instance=name))
+                    for sample in metric.samples
+                )
+        return iter(families.values())
+
+
+class MonitorGroup:
+    """
+    Several DropboxMonitors, one per Dropbox home, exported together.
+
+    Each monitor keeps its own sampler thread, so a hung daemon only stalls
+    its own snapshot; daemon queries share ``query_slots``.
+    """
+
+    def __init__(
+        self,
+        monitors: Dict[str, DropboxMonitor],
+        query_slots: QuerySlots,
+        registry: CollectorRegistry = REGISTRY,
+    ) -> None:
+        self.monitors = monitors
+        self.query_slots = query_slots
+        self.stuck_gauge = Gauge(
+            "dropbox_monitor_stuck_queries",
+            "Daemon queries running for longer than the stuck threshold",
+            registry=registry,
+        )
+        registry.register(InstanceCollector(monitors))
+
+    def start(self) -> None:
+        self.stuck_gauge.set_function(self.query_slots.stuck)
+        for monitor in self.monitors.values():
+            monitor.start(serve_metrics=False)
+
+    def stop(self) -> None:
+        for monitor in self.monitors.values():
+            monitor.stop()
+
+    def get_health(self) -> dict:
+        """/health for every instance; healthy (ready) only if all of them are."""
+        instances = {name: monitor.get_health() for name, monitor in self.monitors.items()}
+        return {
+            "healthy": all(health["healthy"] for health in instances.values()),
+            "ready": all(health["ready"] for health in instances.values()),
+            "instances": instances,
+        }
+
+    def get_aggregate_status(self) -> dict:
+        """
+        Aggregate view for /status: every instance's latest snapshot. Never
+        waits on a daemon; /status/<instance> has the details.
+        """
+        instances = {}
+        states = {}  # type: Dict[str, int]
+        totals = {"syncing": 0, "downloading": 0, "uploading": 0}
+        now = time()
+        for name, monitor in self.monitors.items():
+            status = monitor.get_stream_snapshot()
+            status["snapshot_age_seconds"] = round(max(0.0, now - status["taken_at"]), 3)
+            instances[name] = status
+            states[status["state"]] = states.get(status["state"], 0) + 1
+            for key in totals:
+                totals[key] += status[key] or 0
+        return {
+            "instances": instances,
+            "summary": dict(totals, instances=len(instances), states=states),
+        }
+
+
+def clean_stale_files(home: str = DROPBOX_HOME) -> None:
+    """Remove sockets and lock files left by a previous daemon."""
+    for name in STALE_FILES:
+        try:
+            os.remove(os.path.join(home, ".dropbox", name))
+        except FileNotFoundError:
+            pass
+
+
+def analytics_roots(home: str = DROPBOX_HOME) -> Tuple[str, str]:
+    """The daemon keeps analytics both in .dropbox and in a nested .dropbox/.dropbox."""
+    return os.path.join(home, ".dropbox"), os.path.join(home, ".dropbox", ".dropbox")
+
+
+def clear_analytics(home: str = DROPBOX_HOME) -> None:
+    """Empty the daemon's analytics directories and delete metrics/store.bin."""
+    for root in analytics_roots(home):
+        for name in ANALYTICS_DIRS:
+            path = os.path.join(root, name)
+            if os.path.isdir(path) and not os.path.islink(path):
+                for entry in os.scandir(path):
+                    if entry.is_dir(follow_symlinks=False):
+                        shutil.rmtree(entry.path, ignore_errors=True)
+                    else:
+                        try:
+                            os.remove(entry.path)
+                        except OSError:
+                            # Gone already, or in a directory the daemon locked us out of
+                            pass
+        try:
+            os.remove(os.path.join(root, "metrics", "store.bin"))
+        except FileNotFoundError:
+            pass
+
+
+def lock_analytics(home: str = DROPBOX_HOME) -> None:
+    """
+    Empty the daemon's analytics directories and make them root-owned and
+    read-only, like ``lock_analytics`` in docker-entrypoint.sh. The daemon
+    recreates them, so this has to run before every (re)start.
+    """
+    clear_analytics(home)
+    for root in analytics_roots(home):
+        for name in ANALYTICS_DIRS:
+            path = os.path.join(root, name)
+            os.makedirs(path, exist_ok=True)
+            os.chown(path, 0, 0)
+            os.chmod(path, 0o555)
+
+
+def clean_tmp_dirs(tmp: str = "/tmp", max_age_sec: float = 86400) -> None:
+    """Remove the daemon's temp directories once they are ``max_age_sec`` old."""
+    cutoff = time() - max_age_sec
+    try:
+        entries = list(os.scandir(tmp))
+    except OSError:
+        return
+    for entry in entries:
+        try:
+            if (
+                entry.name.startswith("dropbox")
+                and entry.is_dir(follow_symlinks=False)
+                and entry.stat(follow_symlinks=False).st_mtime < cutoff
+            ):
+                shutil.rmtree(entry.path, ignore_errors=True)
+        except OSError:
+            pass
+
+
+class DaemonSupervisor:
+    """
+    Runs dropboxd in place of the entrypoint's bash supervision loop.
+
+    A crashed daemon is restarted after ``restart_delay_sec``, doubling for
+    every consecutive crash up to ``max_restart_delay_sec``; a run that
+    lasted ``stable_after_sec`` resets the backoff. After ``max_restarts``
+    consecutive crashes the supervisor gives up. Status changes are logged
+    from the monitor's snapshot, so nothing else polls the daemon.
+    """
+
+    def __init__(
+        self,
+        command: List[str],
+        monitor: DropboxMonitor,
+        logger: logging.Logger,
+        max_restarts: int = 5,
+        restart_delay_sec: float = 10.0,
+        max_restart_delay_sec: float = 300.0,
+        stable_after_sec: float = 600.0,
+        stop_timeout_sec: float = 30.0,
+        home: str = DROPBOX_HOME,
+        tmp_dir: str = "/tmp",
+    ) -> None:
+        self.command = command
+        self.monitor = monitor
+        self.logger = logger
+        self.max_restarts = max_restarts
+        self.restart_delay_sec = restart_delay_sec
+        self.max_restart_delay_sec = max_restart_delay_sec
+        self.stable_after_sec = stable_after_sec
+        self.stop_timeout_sec = stop_timeout_sec
+        self.home = home
+        self.tmp_dir = tmp_dir
+        self.process = None  # type: Optional[subprocess.Popen]
+        self.started_at = 0.0
+        self.consecutive_crashes = 0
+        self._last_logged_status = None  # type: Optional[str]
+        self._next_tmp_cleanup = 0.0
+        self._restart_requested = Event()
+
+        self.restarts_counter = Counter(
+            "dropbox_daemon_restarts",
+            "Times the supervisor restarted dropboxd",
+            registry=monitor.registry,
+        )
+        self.exits_counter = Counter(
+            "dropbox_daemon_exits",
+            "Unexpected dropboxd exits by exit code (negative: killed by signal)",
+            ["code"],
+            registry=monitor.registry,
+        )
+        self.last_exit_code_gauge = Gauge(
+            "dropbox_daemon_last_exit_code",
+            "Exit code of the last unexpected dropboxd exit",
+            registry=monitor.registry,
+        )
+        self.last_crash_gauge = Gauge(
+            "dropbox_daemon_last_crash_timestamp_seconds",
+            "Unix time of the last unexpected dropboxd exit",
+            registry=monitor.registry,
+        )
+        self.planned_restarts_counter = Counter(
+            "dropbox_daemon_planned_restarts",
+            "Times the supervisor restarted a healthy dropboxd on request",
+            registry=monitor.registry,
+        )
+
+    def run(self, stop: Event) -> int:
+        """Supervise the daemon until ``stop`` is set. Returns the exit code for the container."""
+        self.start_daemon()
+        while not stop.is_set():
+            try:
+                code = self.process.wait(timeout=1)
+            except subprocess.TimeoutExpired:
+                self.log_status_change()
+                self.clean_tmp()
+                if self._restart_requested.is_set():
+                    self._restart_requested.clear()
+                    self.stop_daemon()
+                    self.planned_restarts_counter.inc()
+                    self.start_daemon()
+                continue
+            if stop.is_set():
+                break
+
+            uptime = monotonic() - self.started_at
+            if uptime >= self.stable_after_sec:
+                self.consecutive_crashes = 0
+            self.consecutive_crashes += 1
+            self.exits_counter.labels(code=str(code)).inc()
+            self.last_exit_code_gauge.set(code)
+            self.last_crash_gauge.set(time())
+
+            if self.consecutive_crashes > self.max_restarts:
+                self.logger.error(
+                    "Dropbox daemon crashed %d times in a row. Giving up.",
+                    self.consecutive_crashes,
+                )
+                return 1
+            delay = self.restart_delay(self.consecutive_crashes)
+            self.logger.warning(
+                "Dropbox daemon exited with code %s after %.0fs. Restart attempt %d/%d in %.0fs...",
+                code,
+                uptime,
+                self.consecutive_crashes,
+                self.max_restarts,
+                delay,
+            )
+            if stop.wait(delay):
+                break
+            self.restarts_counter.inc()
+            self.monitor.restart_count += 1
+            self.start_daemon()
+
+        self.stop_daemon()
+        return 0
+
+    def request_restart(self) -> None:
+        """
+        Stop and restart a running daemon (re-locking analytics on the way)
+        from the supervision loop. Not counted as a crash.
+        """
+        self._restart_requested.set()
+
+    def restart_delay(self, crashes: int) -> float:
+        return min(self.max_restart_delay_sec, self.restart_delay_sec * 2 ** (crashes - 1))
+
+    def start_daemon(self) -> None:
+        clean_stale_files(self.home)
+        try:
+            lock_analytics(self.home)
+        except OSError:
+            self.logger.exception("Failed to lock analytics directories")
+        self.process = subprocess.Popen(self.command)
+        self.started_at = monotonic()
+        self.logger.info("Started Dropbox daemon (PID: %d)", self.process.pid)
+        # The monitor should notice the new daemon without waiting out its backoff
+        self.monitor.notify_change()
+
+    def stop_daemon(self) -> None:
+        if self.process is None or self.process.poll() is not None:
+            return
+        self.logger.info("Stopping Dropbox daemon (PID: %d)...", self.process.pid)
+        self.process.terminate()
+        try:
+            self.process.wait(timeout=self.stop_timeout_sec)
+        except subprocess.TimeoutExpired:
+            self.logger.warning("Dropbox daemon didn't stop in time, killing it")
+            self.process.kill()
+            self.process.wait()
+        self.logger.info("Dropbox daemon stopped.")
+
+    def log_status_change(self) -> None:
+        status = self.monitor.snapshot.raw_status.split("\n", 1)[0]
+        if status and status != self._last_logged_status:
+            self._last_logged_status = status
+            self.logger.info("Dropbox status: %s", status)
+
+    def clean_tmp(self) -> None:
+        if monotonic() >= self._next_tmp_cleanup:
+            self._next_tmp_cleanup = monotonic() + 600
+            clean_tmp_dirs(self.tmp_dir)
+
+
+class DirectorySizes:
+    """
+    Incremental size accounting for a directory tree.
+
+    A directory is only re-listed when its mtime changes. Files that grow in
+    place don't touch their directory's mtime, so between listings only
+    files of at least ``large_file_bytes`` are stat'ed again; every
+    ``deep_every`` scans all files are. Symlinks are not followed.
+    """
+
+    def __init__(
+        self,
+        root: str,
+        large_file_bytes: int = 1024 * 1024,
+        deep_every: int = 10,
+    ) -> None:
+        self.root = root
+        self.large_file_bytes = large_file_bytes
+        self.deep_every = deep_every
+        self.scans = 0
+        self.listed = 0
+        # path -> (mtime_ns, {file name: size}, [subdirectory paths])
+        self._dirs = {}  # type: Dict[str, Tuple[int, Dict[str, int], List[str]]]
+
+    def scan(self) -> Dict[str, int]:
+        """Bytes of the files directly in each directory, by path relative to ``root``."""
+        deep = self.deep_every > 0 and self.scans % self.deep_every == self.deep_every - 1
+        totals = {}  # type: Dict[str, int]
+        seen = {}  # type: Dict[str, Tuple[int, Dict[str, int], List[str]]]
+        self.listed = 0
+        pending = [self.root]
+        while pending:
+            path = pending.pop()
+            try:
+                mtime_ns = os.lstat(path).st_mtime_ns
+                cached = self._dirs.get(path)
+                if cached is None or cached[0] != mtime_ns:
+                    cached = self._list(path, mtime_ns)
+                else:
+                    self._restat(path, cached[1], deep)
+            except OSError:
+                continue
+            seen[path] = cached
+            totals[os.path.relpath(path, self.root)] = sum(cached[1].values())
+            pending.extend(cached[2])
+        self._dirs = seen
+        self.scans += 1
+        return totals
+
+    def _list(self, path: str, mtime_ns: int) -> Tuple[int, Dict[str, int], List[str]]:
+        self.listed += 1
+        files = {}  # type: Dict[str, int]
+        subdirs = []
+        with os.scandir(path) as entries:
+            for entry in entries:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        subdirs.append(entry.path)
+                    elif entry.is_file(follow_symlinks=False):
+                        files[entry.name] = entry.stat(follow_symlinks=False).st_size
+                except OSError:
+                    pass
+        return mtime_ns, files, subdirs
+
+    def _restat(self, path: str, files: Dict[str, int], deep: bool) -> None:
+        for name, size in list(files.items()):
+            if deep or size >= self.large_file_bytes:
+                try:
+                    files[name] = os.lstat(os.path.join(path, name)).st_size
+                except FileNotFoundError:
+                    del files[name]
+
+
+class CacheWatchdog:
+    """
+    Watches the size of the daemon's .dropbox directory and acts before its
+    analytics caches get big enough to crash it.
+
+    Sizes come from an incremental DirectorySizes scan every
+    ``scan_interval`` seconds. Growth rates are taken over ``rate_window``
+    seconds. Once the analytics caches pass ``limit_bytes``, ``on_limit``
+    (a cleanup or a controlled restart) runs as soon as Dropbox is up to
+    date, or right away past twice the limit, but at most once per
+    ``cooldown`` seconds.
+    """
+
+    def __init__(
+        self,
+        monitor: DropboxMonitor,
+        logger: logging.Logger,
+        on_limit: Optional[Callable[[], None]] = None,
+        limit_bytes: int = 1024 ** 3,
+        home: str = DROPBOX_HOME,
+        scan_interval: float = 60,
+        rate_window: float = 900,
+        cooldown: float = 600,
+    ) -> None:
+        self.monitor = monitor
+        self.logger = logger
+        self.on_limit = on_limit
+        self.limit_bytes = limit_bytes
+        self.scan_interval = scan_interval
+        self.rate_window = rate_window
+        self.cooldown = cooldown
+        self.sizes = DirectorySizes(os.path.join(home, ".dropbox"))
+        self.bytes = {}  # type: Dict[str, int]
+        self.rates = {}  # type: Dict[str, float]
+        self.last_action_time = None  # type: Optional[float]
+        self._samples = deque()  # type: deque
+        self._deferred = False
+        self._stop = Event()
+        self._thread = None  # type: Optional[Thread]
+
+        self.actions_counter = Counter(
+            "dropbox_cache_watchdog_actions",
+            "Cleanups or restarts triggered by the analytics cache limit",
+            registry=monitor.registry,
+        )
+        monitor.registry.register(CacheWatchdogCollector(self))
+
+    def start(self) -> None:
+        self._stop.clear()
+        self._thread = Thread(target=self.run, name="cache-watchdog", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=10)
+            self._thread = None
+
+    def run(self) -> None:
+        lower_thread_priority()
+        while not self._stop.is_set():
+            self.check()
+            self._stop.wait(self.scan_interval)
+
+    @property
+    def analytics_bytes(self) -> int:
+        return sum(self.bytes.get(category, 0) for category in ANALYTICS_CACHE_DIRS)
+
+    def check(self, now: Optional[float] = None) -> None:
+        """Scan, update growth rates and act on the limit if needed."""
+        now = monotonic() if now is None else now
+        self.bytes = self._categorize(self.sizes.scan())
+        self._samples.append((now, self.bytes))
+        while len(self._samples) > 2 and now - self._samples[1][0] >= self.rate_window:
+            self._samples.popleft()
+        then, old = self._samples[0]
+        if now > then:
+            self.rates = {
+                category: (size - old.get(category, 0)) / (now - then)
+                for category, size in self.bytes.items()
+            }
+
+        size = self.analytics_bytes
+        if not self.limit_bytes or size <= self.limit_bytes or self.on_limit is None:
+            self._deferred = False
+            return
+        if self.last_action_time is not None and now - self.last_action_time < self.cooldown:
+            return
+        state = self.monitor.snapshot.state
+        if state != State.UP_TO_DATE and size <= 2 * self.limit_bytes:
+            if not self._deferred:
+                self.logger.warning(
+                    "Analytics caches at %d MB (limit %d MB), cleaning up once Dropbox is up to date",
+                    size >> 20,
+                    self.limit_bytes >> 20,
+                )
+                self._deferred = True
+            return
+        self.logger.warning(
+            "Analytics caches at %d MB (limit %d MB) while %s, cleaning up",
+            size >> 20,
+            self.limit_bytes >> 20,
+            state.value,
+        )
+        self._deferred = False
+        self.last_action_time = now
+        self.actions_counter.inc()
+        try:
+            self.on_limit()
+        except OSError:
+            self.logger.exception("Analytics cache cleanup failed")
+        # Growth since the cleanup is what matters now
+        self._samples.clear()
+
+    @staticmethod
+    def _categorize(totals: Dict[str, int]) -> Dict[str, int]:
+        """Fold .dropbox/.dropbox into the same categories and the rest into "other"."""
+        result = {category: 0 for category in ANALYTICS_CACHE_DIRS + ("other",)}
+        for rel, size in totals.items():
+            parts = rel.split(os.sep)
+            if parts[0] == ".dropbox":
+                parts = parts[1:]
+            category = parts[0] if parts and parts[0] in ANALYTICS_CACHE_DIRS else "other"
+            result[category] += size
+        return result
+
+
+class CacheWatchdogCollector:
+    """Exports .dropbox sizes and growth rates from the last CacheWatchdog scan."""
+
+    def __init__(self, watchdog: CacheWatchdog) -> None:
+        self.watchdog = watchdog
+
+    def collect(self):
+        sizes = GaugeMetricFamily(
+            "dropbox_cache_bytes",
+            "Bytes in the daemon's .dropbox directory, by analytics cache (other: the rest)",
+            labels=["dir"],
+        )
+        for category, size in list(self.watchdog.bytes.items()):
+            sizes.add_metric([category], size)
+        yield sizes
+
+        rates = GaugeMetricFamily(
+            "dropbox_cache_growth_bytes_per_second",
+            "Growth of the daemon's .dropbox directory over the rate window",
+            labels=["dir"],
+        )
+        for category, rate in list(self.watchdog.rates.items()):
+            rates.add_metric([category], rate)
+        yield rates
+
+        yield GaugeMetricFamily(
+            "dropbox_cache_limit_bytes",
+            "Analytics cache size that triggers a cleanup (0: never)",
+            value=self.watchdog.limit_bytes,
+        )
 
 
-class DropboxMonitor:
+class SyncProbe:
+    """
+    Measures how long a local change takes to sync. Every ``interval`` it
+    rewrites a small canary file in ``directory`` and times how long until
+    Dropbox is back to "Up to date" and, if the daemon reports per-file
+    status, the canary itself is "up to date" again.
+
+    Right after the write the daemon usually hasn't noticed the change, and
+    still says everything is up to date. So the canary only counts as synced
+    after the probe has seen it, or the overall status, leave "up to date".
+    A probe that never sees that fails with an error instead of timing the
+    sampler.
+    """
+
+    CANARY_NAME = ".dropbox-monitor-canary"
+
     def __init__(
         self,
-        dropbox: DropboxInterface,
-        min_poll_interval_sec: int,
+        monitor: "DropboxMonitor",
+        directory: str,
         logger: logging.Logger,
-        prom_port: int,
+        interval: float = 300,
+        timeout: float = 600,
+        check_interval: float = 0.5,
+        owner: Optional[Tuple[int, int]] = None,
     ) -> None:
-        self.dropbox = dropbox
-        self.min_poll_interval_sec = min_poll_interval_sec
+        self.monitor = monitor
+        self.directory = directory
+        self.owner = owner
+        self.path = os.path.join(directory, self.CANARY_NAME)
         self.logger = logger
-        self.prom_port = prom_port
-        self.status_matcher = re.compile(
-            "(Syncing|Downloading|Uploading|Indexing) (\\d+) files"
+        self.interval = interval
+        self.timeout = timeout
+        self.check_interval = check_interval
+        self.last_latency = None  # type: Optional[float]
+        self._stop = Event()
+        self._thread = None  # type: Optional[Thread]
+
+        self.latency_histogram = Histogram(
+            "dropbox_sync_probe_latency_seconds",
+            "Time from writing the canary file until Dropbox reports it synced",
+            buckets=(0.5, 1, 2, 5, 10, 30, 60, 120, 300, 600),
+            registry=monitor.registry,
         )
-        self.status_matcher_with_file = re.compile(
-            '(Syncing|Downloading|Uploading|Indexing) ".+"'
+        self.probes_counter = Counter(
+            "dropbox_sync_probes",
+            "Canary sync probes by result",
+            ["result"],
+            registry=monitor.registry,
         )
+        self.last_latency_gauge = Gauge(
+            "dropbox_sync_probe_last_latency_seconds",
+            "Latency of the last successful canary sync probe",
+            registry=monitor.registry,
+        )
+        self.last_latency_gauge.set_function(lambda: self.last_latency or 0.0)
 
-        self.last_query_time = 0
-        self.num_syncing = None  # type: Optional[int]
-        self.num_downloading = None  # type: Optional[int]
-        self.num_uploading = None  # type: Optional[int]
-        self.state = State.STARTING
-        self.raw_status = ""
-        self.last_error = None  # type: Optional[str]
-        self.last_sync_time = None  # type: Optional[float]
-        self.start_time = time()
-        self.restart_count = 0
+    def start(self) -> None:
+        self._stop.clear()
+        self._thread = Thread(target=self.run, name="sync-probe", daemon=True)
+        self._thread.start()
 
-        self.num_syncing_gauge = Gauge(
-            "dropbox_num_syncing",
-            "Number of files currently syncing",
-        )
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+            self._thread = None
 
-        self.num_downloading_gauge = Gauge(
-            "dropbox_num_downloading",
-            "Number of files currently downloading",
-        )
+    def run(self) -> None:
+        while not self._stop.wait(self.interval):
+            if self.monitor.snapshot.state in (State.NOT_RUNNING, State.STARTING):
+                continue
+            self.probe()
 
-        self.num_uploading_gauge = Gauge(
-            "dropbox_num_uploading",
-            "Number of files currently uploading",
-        )
+    def probe(self) -> Optional[float]:
+        """Run one probe; returns the latency, or None if it failed or timed out."""
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(self.path, "w") as f:
+                f.write("%f\n" % time())
+            if self.owner is not None:
+                # Files owned by root don't sync
+                for path in (self.directory, self.path):
+                    os.chown(path, *self.owner)
+        except OSError as e:
+            self.logger.warning("Sync probe couldn't write %s: %s", self.path, e)
+            self.probes_counter.labels(result="error").inc()
+            return None
+        written_at = time()
+        started = monotonic()
+        self.monitor.notify_change()
 
-        self.status_enum = EnumMetric(
-            "dropbox_status",
-            "Status reported by Dropbox client",
-            states=[state.value for state in State.__members__.values()],
-        )
+        changed = False
+        while monotonic() - started < self.timeout:
+            synced = self._synced(written_at)
+            changed = changed or synced is False
+            if changed and synced:
+                latency = monotonic() - started
+                self.last_latency = latency
+                self.latency_histogram.observe(latency)
+                self.probes_counter.labels(result="ok").inc()
+                self.logger.debug("Sync probe took %.2fs", latency)
+                return latency
+            if self._stop.wait(self.check_interval):
+                return None
+        if not changed:
+            self.probes_counter.labels(result="error").inc()
+            self.logger.warning(
+                "Sync probe: Dropbox never reported the canary as changed in %gs", self.timeout
+            )
+            return None
+        self.probes_counter.labels(result="timeout").inc()
+        self.logger.warning("Sync probe: canary not synced after %gs", self.timeout)
+        return None
 
-    def start(self) -> None:
-        self.status_enum.state(State.STARTING.value)
-        self.num_syncing_gauge.set_function(
-            partial(self.get_status, Metric.NUM_SYNCING)
-        )
-        self.num_downloading_gauge.set_function(
-            partial(self.get_status, Metric.NUM_DOWNLOADING)
-        )
-        self.num_uploading_gauge.set_function(
-            partial(self.get_status, Metric.NUM_UPLOADING)
-        )
+    def _synced(self, written_at: float) -> Optional[bool]:
+        """
+        Whether Dropbox says the canary is synced: False as soon as the
+        canary or a snapshot taken after the write says it isn't, None while
+        there is no such snapshot yet.
+        """
+        # Without per-file status, the overall status has to do
+        status = self.monitor.dropbox.query_file_status(self.path)
+        if status is not None and status != "up to date":
+            return False
+        snapshot = self.monitor.snapshot
+        if snapshot.taken_at <= written_at:
+            return None
+        return snapshot.state == State.UP_TO_DATE
 
-        start_http_server(self.prom_port)
-        self.logger.info("Started Prometheus server on port %d", self.prom_port)
 
-    def get_status(self, metric: Metric) -> int:
-        now = time()
-        if now - self.last_query_time > self.min_poll_interval_sec:
-            self.last_query_time = now
-            dropbox_result = self.dropbox.query_status()
-            if dropbox_result:
-                self.raw_status = dropbox_result.strip()
-                self.parse_output(dropbox_result)
-            else:
-                self.status_enum.state(State.UNKNOWN.value)
-                self.num_syncing = None
-                self.num_downloading = None
-                self.num_uploading = None
+class StatusHandler(BaseHTTPRequestHandler):
+    """HTTP handler for the /status JSON endpoint."""
 
-        if metric == Metric.NUM_SYNCING:
-            return self.num_syncing or 0
-        elif metric == Metric.NUM_DOWNLOADING:
-            return self.num_downloading or 0
-        elif metric == Metric.NUM_UPLOADING:
-            return self.num_uploading or 0
+    # Keep-alive: clients may reuse the connection for further requests
+    protocol_version = "HTTP/1.1"
+    # Headers and body go out as separate writes; with Nagle on, every
+    # keep-alive response after the first waits out the client's delayed ACK
+    disable_nagle_algorithm = True
+    # Set per request by route()
+    monitor = None  # type: Optional[DropboxMonitor]
+    instance = None  # type: Optional[str]
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        path = self.route(url.path)
+        if path is None:
+            return
+        if path == "/status/history" or path == "/status/history/":
+            query = parse_qs(url.query)
+            try:
+                since = float(query.get("since", ["0"])[0])
+                step = float(query.get("step", ["0"])[0])
+            except ValueError:
+                self.send_json(400, {"error": "since and step must be numbers"})
+                return
+            if step < 0 or step != step or since != since:
+                self.send_json(400, {"error": "step must not be negative"})
+                return
+            self.send_json(200, self.monitor.get_history(since, step))
+        elif path == "/status/errors" or path == "/status/errors/":
+            query = parse_qs(url.query)
+            try:
+                offset = int(query.get("offset", ["0"])[0])
+                limit = int(query.get("limit", ["100"])[0])
+            except ValueError:
+                self.send_json(400, {"error": "offset and limit must be integers"})
+                return
+            if offset < 0 or not 0 < limit <= 1000:
+                self.send_json(400, {"error": "offset must be >= 0 and limit 1-1000"})
+                return
+            reason = query.get("reason", [None])[0]
+            self.send_json(200, self.monitor.get_errors(offset, limit, reason))
+        elif path == "/status/tree" or path == "/status/tree/":
+            self.status_tree(parse_qs(url.query))
+        elif path == "/status/stream" or path == "/status/stream/":
+            self.stream_status()
+        elif path == "/status" or path == "/status/":
+            if self.monitor is None:
+                self.send_json(200, self.server.group.get_aggregate_status())
+                return
+            try:
+                data = self.monitor.get_shared_json_status(
+                    self.server.request_timeout
+                )
+            except TimeoutError:
+                self.send_json(504, {"error": "timed out waiting for Dropbox"})
+                return
+            etag = status_etag(data)
+            if_none_match = self.headers.get("If-None-Match", "")
+            if etag in [tag.strip() for tag in if_none_match.split(",")] or if_none_match == "*":
+                self.send_response(304)
+                self.send_header("ETag", etag)
+                self.end_headers()
+                return
+            self.send_json(200, data, {"ETag": etag, "Cache-Control": "no-cache"})
+        elif path in ("/health", "/health/", "/health/ready", "/health/ready/"):
+            group = self.server.group
+            health = self.monitor.get_health() if self.monitor is not None else group.get_health()
+            ok = health["ready"] if path.startswith("/health/ready") else health["healthy"]
+            self.send_json(200 if ok else 503, health, {"Cache-Control": "no-store"})
+        elif path == "/debug/profile" or path == "/debug/profile/":
+            self.profile(parse_qs(url.query))
+        elif path.startswith("/exclude/jobs/"):
+            self.exclude_job(path[len("/exclude/jobs/"):].strip("/"))
         else:
-            raise ValueError(metric)
+            self.send_body(404, b"")
 
-    def get_json_status(self) -> dict:
-        """Build a JSON-serializable status dict for the /status endpoint."""
-        # Trigger a refresh if stale
-        self.get_status(Metric.NUM_SYNCING)
+    def do_POST(self):
+        self.change_excludes("add")
 
-        # Account info (redacted for privacy — no PII in API responses)
-        account = {}
-        info = self.dropbox.query_account_info()
-        if info:
-            account = {"linked": True}
-        else:
-            account = {"linked": False}
+    def do_DELETE(self):
+        self.change_excludes("remove")
 
-        # Excluded folders
-        excluded = self.dropbox.query_exclude_list()
+    def route(self, path: str) -> Optional[str]:
+        """
+        Pick the monitor a request is for and return the path to dispatch
+        on. With a MonitorGroup, /status/<instance>/... and
+        /exclude/<instance>/... are one instance's API, and plain /status
+        (with no monitor) is the aggregate. None if a 404 was sent.
+        """
+        self.monitor = self.server.monitor
+        self.instance = None
+        group = self.server.group
+        if group is None:
+            return path
+        for prefix in ("/status", "/exclude"):
+            if path != prefix and not path.startswith(prefix + "/"):
+                continue
+            name, _, rest = path[len(prefix) + 1:].partition("/")
+            if not name and prefix == "/status":
+                return prefix
+            if name not in group.monitors:
+                self.send_json(404, {"error": "no instance %r" % name})
+                return None
+            self.monitor = group.monitors[name]
+            self.instance = name
+            return prefix + "/" + rest if rest else prefix
+        return path
 
-        # Version
-        version = self.dropbox.query_version()
+    def read_body(self) -> Optional[bytes]:
+        """The request body, or None once a 400/413 was sent."""
+        try:
+            length = int(self.headers.get("Content-Length", ""))
+        except ValueError:
+            length = -1
+        if not 0 <= length <= MAX_REQUEST_BYTES:
+            # The unread body would be taken for the next request
+            self.send_json(
+                413 if length > MAX_REQUEST_BYTES else 411,
+                {"error": "a Content-Length of at most %d bytes is required" % MAX_REQUEST_BYTES},
+                {"Connection": "close"},
+            )
+            return None
+        return self.rfile.read(length)
 
-        # Memory usage from /proc
-        memory_mb = None
+    def change_excludes(self, action: str) -> None:
+        """
+        POST /exclude excludes paths from sync, DELETE /exclude syncs them
+        again. The body is {"paths": [...]} relative to the sync folder;
+        the answer is 202 with the queued job and its status URL.
+        """
+        body = self.read_body()
+        if body is None:
+            return
+        path = self.route(urlsplit(self.path).path)
+        if path is None:
+            return
+        if path != "/exclude" and path != "/exclude/":
+            self.send_body(404, b"")
+            return
+        if not self.authorized():
+            return
         try:
-            with open("/proc/self/status") as f:
-                for line in f:
-                    if line.startswith("VmRSS:"):
-                        memory_mb = int(line.split()[1]) / 1024
-                        break
-        except Exception:
-            pass
+            paths = json.loads(body)["paths"]
+            if not isinstance(paths, list) or not 0 < len(paths) <= MAX_EXCLUDE_PATHS:
+                raise ValueError("paths must be a list of 1-%d paths" % MAX_EXCLUDE_PATHS)
+            paths = [StatusTree.normalize(p) if isinstance(p, str) else None for p in paths]
+            if None in paths or "" in paths:
+                raise ValueError("paths must be folders inside the sync folder")
+        except (ValueError, KeyError, TypeError) as e:
+            self.send_json(400, {"error": "expected {\"paths\": [...]}: %s" % e})
+            return
+        job = self.monitor.exclude_jobs.submit(action, paths)
+        if job is None:
+            self.send_json(503, {"error": "too many exclude jobs queued"}, {"Retry-After": "10"})
+            return
+        url = self.job_url(job)
+        self.send_json(202, dict(job.as_dict(), url=url), {"Location": url})
 
-        # Uptime
-        uptime_seconds = int(time() - self.start_time)
+    def exclude_job(self, job_id: str) -> None:
+        if not self.authorized():
+            return
+        job = self.monitor.exclude_jobs.get(job_id)
+        if job is None:
+            self.send_json(404, {"error": "no job %r" % job_id})
+            return
+        self.send_json(200, dict(job.as_dict(), url=self.job_url(job)))
 
-        return {
-            "status": self.state.value,
-            "raw_status": self.raw_status,
-            "sync": {
-                "syncing": self.num_syncing or 0,
-                "downloading": self.num_downloading or 0,
-                "uploading": self.num_uploading or 0,
-            },
-            "account": account,
-            "daemon": {
-                "version": version,
-                "uptime_seconds": uptime_seconds,
-                "memory_mb": round(memory_mb, 1) if memory_mb else None,
-                "restart_count": self.restart_count,
-            },
-            "last_sync": self.last_sync_time,
-            "last_error": self.last_error,
-            "excluded_folders": excluded or [],
-        }
+    def job_url(self, job: ExcludeJob) -> str:
+        instance = "/" + self.instance if self.instance is not None else ""
+        return "/exclude%s/jobs/%s" % (instance, job.id)
 
-    def parse_output(self, results: str) -> None:
+    def authorized(self) -> bool:
         """
-        Observed messages from `dropbox status`
+        Check the admin bearer token. Without a configured token the admin
+        endpoints don't exist at all (404).
+        """
+        token = self.server.admin_token
+        if not token:
+            self.send_body(404, b"")
+            return False
+        scheme, _, supplied = self.headers.get("Authorization", "").partition(" ")
+        if scheme.lower() != "bearer" or not hmac.compare_digest(
+            supplied.strip().encode(), token.encode()
+        ):
+            self.send_json(401, {"error": "admin token required"},
+                           {"WWW-Authenticate": 'Bearer realm="dropbox-monitor"'})
+            return False
+        return True
 
-        Up to date
-        Syncing...
-        Indexing...
-        Syncing 176 files • 6 secs
-        Downloading 176 files (6 secs)
-        Dropbox isn't running!
-        Indexing 1 file...
-        Can't sync "monitoring.txt" (access denied)
-        Syncing "none" • 1 sec
-        Downloading 82 files (2,457 KB/sec, 2 secs)
+    def profile(self, query: Dict[str, List[str]]) -> None:
         """
-        state = State.UNKNOWN
-        num_syncing = None  # type: Optional[int]
-        num_downloading = None  # type: Optional[int]
-        num_uploading = None  # type: Optional[int]
+        Sample every thread's stack for ``seconds`` (default 10) and return
+        collapsed stacks, busiest first. One capture runs at a time.
+        """
+        if not self.authorized():
+            return
+        try:
+            seconds = float(query.get("seconds", ["10"])[0])
+        except ValueError:
+            seconds = -1
+        if not 0 < seconds <= PROFILE_MAX_SECONDS:
+            self.send_json(400, {"error": "seconds must be 0-%d" % PROFILE_MAX_SECONDS})
+            return
+        if not self.server.profile_lock.acquire(blocking=False):
+            self.send_json(409, {"error": "a profile is already running"})
+            return
+        try:
+            stacks, samples = sample_stacks(seconds)
+        finally:
+            self.server.profile_lock.release()
+        body = "".join(
+            "%s %d\n" % (stack, count)
+            for stack, count in sorted(stacks.items(), key=lambda item: -item[1])
+        )
+        self.send_body(200, body.encode(), "text/plain; charset=utf-8", {
+            "Cache-Control": "no-store",
+            "X-Profile-Samples": str(samples),
+        })
 
-        for line in results.splitlines():
-            try:
-                if line.startswith("Up to date"):
-                    state = State.UP_TO_DATE
-                    num_syncing = 0
-                    num_downloading = 0
-                    num_uploading = 0
-                    self.last_sync_time = time()
-                elif line == "Dropbox isn't running!":
-                    state = State.NOT_RUNNING
-                elif line:
-                    # Hack: remove commas; simplifies the regex
-                    line = line.replace(',', '')
-
-                    status_match = self.status_matcher.match(line)
-                    status_match_with_file = self.status_matcher_with_file.match(line)
-                    if status_match:
-                        state = State.SYNCING
-                        action, num_files_str = status_match.groups()
-                        num_files = int(num_files_str)
-                        if action == "Syncing":
-                            num_syncing = num_files
-                        elif action == "Downloading":
-                            num_downloading = num_files
-                        elif action == "Uploading":
-                            num_uploading = num_files
-                    elif status_match_with_file:
-                        state = State.SYNCING
-                        action = status_match_with_file.groups()[0]
-                        if action == "Syncing":
-                            num_syncing = 1
-                        elif action == "Downloading":
-                            num_downloading = 1
-                        elif action == "Uploading":
-                            num_uploading = 1
-                    elif line.startswith("Starting"):
-                        state = State.STARTING
-                    elif line.startswith("Syncing"):
-                        state = State.SYNCING
-                    elif line.startswith("Indexing"):
-                        state = State.INDEXING
-                    elif line.startswith("Can't sync"):
-                        state = State.SYNC_ERROR
-                        self.last_error = line
-                    else:
-                        self.logger.debug("Ignoring line '%s'", line)
-            except Exception:
-                self.logger.exception("Failed to parse status line '%s'", line)
-
-        self.state = state
-        self.status_enum.state(state.value)
-        if state in (State.SYNCING, State.UP_TO_DATE):
-            self.num_syncing = num_syncing
-            self.num_downloading = num_downloading
-            self.num_uploading = num_uploading
-        else:
-            self.num_syncing = None
-            self.num_downloading = None
-            self.num_uploading = None
+    def status_tree(self, query: Dict[str, List[str]]) -> None:
+        try:
+            offset = int(query.get("offset", ["0"])[0])
+            limit = int(query.get("limit", ["100"])[0])
+        except ValueError:
+            self.send_json(400, {"error": "offset and limit must be integers"})
+            return
+        if offset < 0 or not 0 < limit <= 1000:
+            self.send_json(400, {"error": "offset must be >= 0 and limit 1-1000"})
+            return
+        status = query.get("status", [None])[0]
+        if status is not None and status not in TREE_STATUSES:
+            self.send_json(400, {"error": "status must be one of %s" % ", ".join(TREE_STATUSES)})
+            return
+        try:
+            data = self.monitor.get_tree(
+                query.get("path", [""])[0], offset, limit, status, self.server.request_timeout
+            )
+        except ValueError as e:
+            self.send_json(400, {"error": str(e)})
+            return
+        except TimeoutError:
+            self.send_json(504, {"error": "timed out waiting for Dropbox"})
+            return
+        except OSError as e:
+            self.send_json(404, {"error": "can't list directory: %s" % (e.strerror or e)})
+            return
+        self.send_json(200, data)
+
+    def stream_status(self) -> None:
+        """
+        Server-sent events: a ``snapshot`` event, then ``state`` and ``counts``
+        events as the sampler sees changes. Comment lines keep idle
+        connections (and proxies) alive.
+        """
+        monitor = self.monitor
+        events = monitor.events
+        try:
+            last_id = int(self.headers.get("Last-Event-ID", ""))
+        except ValueError:
+            last_id = None
 
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Connection", "close")
+        self.send_header("X-Accel-Buffering", "no")
+        self.end_headers()
+        self.close_connection = True
 
-class StatusHandler(BaseHTTPRequestHandler):
-    """HTTP handler for the /status JSON endpoint."""
+        events.subscribe()
+        try:
+            pending = events.since(last_id) if last_id is not None else None
+            while not events.closed:
+                if pending is None:
+                    # New client, or it fell too far behind: start over from a snapshot
+                    last_id = events.last_id
+                    pending = [StatusEvent(last_id, "snapshot", monitor.get_stream_snapshot())]
+                if pending:
+                    ok = self.write(b"".join(
+                        b"id: %d\nevent: %s\ndata: %s\n\n"
+                        % (event.id, event.event.encode(), compact_json(event.data))
+                        for event in pending
+                    ))
+                    last_id = pending[-1].id
+                else:
+                    ok = self.write(b": heartbeat\n\n")
+                if not ok:
+                    return
+                pending = events.wait(last_id, self.server.heartbeat_interval)
+        finally:
+            events.unsubscribe()
 
-    monitor = None  # type: Optional[DropboxMonitor]
+    def stage_timer(self, stage: str):
+        # The aggregate view of a MonitorGroup belongs to no one monitor
+        return self.monitor.stage_timer(stage) if self.monitor is not None else nullcontext()
 
-    def do_GET(self):
-        if self.path == "/status" or self.path == "/status/":
-            data = self.monitor.get_json_status()
-            payload = json.dumps(data, indent=2)
-            self.send_response(200)
-            self.send_header("Content-Type", "application/json")
-            self.end_headers()
-            self.write(payload.encode())
-        elif self.path == "/health" or self.path == "/health/":
-            self.send_response(200)
-            self.send_header("Content-Type", "application/json")
-            self.end_headers()
-            self.write(b'{"ok":true}')
-        else:
-            self.send_response(404)
-            self.end_headers()
+    def send_json(self, code: int, data: dict, headers: Optional[Dict[str, str]] = None) -> None:
+        with self.stage_timer("serialize"):
+            body = compact_json(data)
+        self.send_body(code, body, headers=headers)
 
-    def write(self, data: bytes):
+    def send_body(
+        self,
+        code: int,
+        body: bytes,
+        content_type: str = "application/json",
+        headers: Optional[Dict[str, str]] = None,
+    ) -> None:
+        self.send_response(code)
+        if body:
+            self.send_header("Content-Type", content_type)
+        if len(body) >= GZIP_MIN_BYTES:
+            self.send_header("Vary", "Accept-Encoding")
+            if accepts_gzip(self.headers.get("Accept-Encoding")):
+                with self.stage_timer("gzip"):
+                    body = gzip.compress(body, compresslevel=6)
+                self.send_header("Content-Encoding", "gzip")
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.write(body)
+
+    def write(self, data: bytes) -> bool:
         try:
             self.wfile.write(data)
-        except BrokenPipeError:
-            pass
+            self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError, socket.timeout):
+            return False
+        return True
 
     def log_message(self, format, *args):
         """Suppress default request logging."""
         pass
 
 
-def start_status_server(monitor: DropboxMonitor, port: int, logger: logging.Logger):
-    """Start the JSON status HTTP server in a background thread."""
-    StatusHandler.monitor = monitor
-    server = HTTPServer(("0.0.0.0", port), StatusHandler)
-    thread = Thread(target=server.serve_forever, daemon=True)
+class StatusServer(ThreadingHTTPServer):
+    """Serves each connection on its own thread so a slow /status never blocks /health."""
+
+    daemon_threads = True
+
+    def __init__(
+        self,
+        address,
+        monitor: Optional[DropboxMonitor],
+        request_timeout: float = 10.0,
+        keepalive_timeout: float = 30.0,
+        heartbeat_interval: float = 15.0,
+        admin_token: Optional[str] = None,
+        group: Optional[MonitorGroup] = None,
+    ) -> None:
+        self.monitor = monitor
+        self.group = group
+        self.request_timeout = request_timeout
+        self.heartbeat_interval = heartbeat_interval
+        self.admin_token = admin_token
+        self.profile_lock = Lock()
+        # Socket timeout for idle keep-alive connections and slow clients
+        handler = type("StatusHandler", (StatusHandler,), {"timeout": keepalive_timeout})
+        super().__init__(address, handler)
+
+
+def start_status_server(
+    monitor: Optional[DropboxMonitor],
+    port: int,
+    logger: logging.Logger,
+    request_timeout: float = 10.0,
+    keepalive_timeout: float = 30.0,
+    host: str = "0.0.0.0",
+    heartbeat_interval: float = 15.0,
+    admin_token: Optional[str] = None,
+    group: Optional[MonitorGroup] = None,
+) -> StatusServer:
+    """
+    Start the JSON status HTTP server in a background thread. With a
+    ``group``, ``monitor`` is None and every instance gets /status/<name>.
+    """
+    server = StatusServer(
+        (host, port), monitor, request_timeout, keepalive_timeout, heartbeat_interval,
+        admin_token, group,
+    )
+    thread = Thread(target=server.serve_forever, name="status-server", daemon=True)
     thread.start()
-    logger.info("Started status API server on port %d", port)
+    logger.info("Started status API server on port %d", server.server_address[1])
+    return server
 
 
 if __name__ == "__main__":
@@ -369,11 +4823,190 @@ if __name__ == "__main__":
         help="minimum interval for polling Dropbox (in seconds)",
         default=5,
     )
+    parser.add_argument(
+        "--max_poll_interval_sec",
+        help="maximum interval for polling Dropbox while it is up to date (in seconds)",
+        default=60,
+    )
+    parser.add_argument(
+        "--no-watch",
+        action="store_true",
+        help="don't poll early when inotify reports changes in the Dropbox folders",
+    )
     parser.add_argument("-p", "--port", help="Prometheus port", default=8000)
     parser.add_argument("--status-port", help="JSON status API port", default=8001)
+    parser.add_argument(
+        "--backend",
+        choices=["socket", "cli"],
+        default="socket",
+        help="how to query the daemon: its command_socket (falls back to the CLI) or the dropbox CLI",
+    )
+    parser.add_argument(
+        "--command-socket",
+        help="path of the daemon's command_socket",
+        default=COMMAND_SOCKET,
+    )
+    parser.add_argument(
+        "--socket-timeout",
+        help="timeout for command_socket requests (in seconds)",
+        default=5,
+    )
+    parser.add_argument(
+        "--request-timeout",
+        help="how long a /status request waits for Dropbox before failing (in seconds)",
+        default=10,
+    )
+    parser.add_argument(
+        "--exclude-cache-ttl",
+        help="how long to cache the selective sync exclude list (in seconds)",
+        default=60,
+    )
+    parser.add_argument(
+        "--cache-max-entries",
+        help="maximum number of entries in the status cache",
+        default=64,
+    )
+    parser.add_argument(
+        "--supervise",
+        action="store_true",
+        help="run COMMAND (dropboxd) and restart it when it crashes; needs root",
+    )
+    parser.add_argument(
+        "--uid",
+        type=int,
+        help="run the dropbox CLI, and own files written to the sync folder, as this user "
+        "(with --supervise, which runs as root)",
+    )
+    parser.add_argument("--gid", type=int, help="group for --uid")
+    parser.add_argument(
+        "--no-servers",
+        action="store_true",
+        help="don't start the Prometheus and status API servers",
+    )
+    parser.add_argument(
+        "--max-restarts",
+        help="consecutive crashes before the supervisor gives up",
+        default=5,
+    )
+    parser.add_argument(
+        "--restart-delay",
+        help="delay before the first restart, doubled for each consecutive crash (in seconds)",
+        default=10,
+    )
+    parser.add_argument(
+        "--max-restart-delay",
+        help="maximum delay between restarts (in seconds)",
+        default=300,
+    )
+    parser.add_argument(
+        "--wait-ready",
+        action="store_true",
+        help="wait for the daemon's info.json or command_socket, then exit "
+        "(0: ready, 1: timed out, 2: daemon exited)",
+    )
+    parser.add_argument(
+        "--ready-timeout",
+        help="how long --wait-ready waits (in seconds)",
+        default=300,
+    )
+    parser.add_argument("--pid", type=int, help="daemon PID for --wait-ready to watch")
+    parser.add_argument(
+        "--journal",
+        help="journal of state changes, so last sync and last error survive restarts",
+        default=JOURNAL_FILE,
+    )
+    parser.add_argument(
+        "--no-journal",
+        action="store_true",
+        help="keep state in memory only",
+    )
+    parser.add_argument(
+        "--sync-probe-dir",
+        help="folder inside the sync folder for the canary sync latency probe "
+        "(disabled if not set)",
+    )
+    parser.add_argument(
+        "--sync-probe-interval",
+        help="seconds between canary sync probes",
+        default=300,
+    )
+    parser.add_argument(
+        "--sync-probe-timeout",
+        help="seconds before a canary sync probe counts as timed out",
+        default=600,
+    )
+    parser.add_argument(
+        "--folder-index",
+        help="SQLite index of sync folder sizes",
+        default=FOLDER_INDEX_FILE,
+    )
+    parser.add_argument(
+        "--folder-scan-interval",
+        help="seconds between folder index scans (0 to disable the index)",
+        default=900,
+    )
+    parser.add_argument(
+        "--cache-limit-mb",
+        help="analytics cache size in .dropbox that triggers a cleanup, or a restart "
+        "with --supervise (0: only export sizes)",
+        default=1024,
+    )
+    parser.add_argument(
+        "--cache-scan-interval",
+        help="seconds between .dropbox size scans (0 to disable the cache watchdog)",
+        default=60,
+    )
+    parser.add_argument(
+        "--instance",
+        action="append",
+        metavar="NAME=HOME",
+        help="monitor the Dropbox home HOME as instance NAME; repeat for several accounts. "
+        "Metrics get an instance label and /status/NAME serves each one",
+    )
+    parser.add_argument(
+        "--workers",
+        help="daemons queried at the same time with --instance",
+        default=4,
+    )
+    parser.add_argument(
+        "--stuck-after",
+        help="seconds after which a daemon query no longer holds up the others",
+        default=10,
+    )
+    parser.add_argument(
+        "--health-unsynced-after",
+        help="seconds without \"Up to date\" after which /health/ready fails (0: never)",
+        default=86400,
+    )
+    parser.add_argument(
+        "--admin-token",
+        help="bearer token for the admin endpoints such as /debug/profile and /exclude "
+        "(disabled if not set; defaults to $MONITOR_ADMIN_TOKEN)",
+        default=os.environ.get("MONITOR_ADMIN_TOKEN"),
+    )
+    parser.add_argument("command", nargs="*", help="daemon command for --supervise")
     parser.add_argument("--log_level", default="INFO")
     parser.add_argument("--global_log_level", default="INFO")
     args = parser.parse_args()
+    if args.supervise and not args.command:
+        parser.error("--supervise needs the daemon command")
+    if (args.uid is None) != (args.gid is None):
+        parser.error("--uid and --gid go together")
+    owner = None if args.uid is None else (args.uid, args.gid)
+    if args.instance:
+        if args.supervise:
+            parser.error("--supervise runs a single daemon and can't be used with --instance")
+        names = [spec.partition("=")[0] for spec in args.instance]
+        for spec in args.instance:
+            name, _, home = spec.partition("=")
+            if not re.match(r"^[A-Za-z0-9_.-]+$", name) or not home:
+                parser.error("--instance needs NAME=HOME with a NAME of letters, digits, _ . -")
+            if name in STATUS_SUBPATHS:
+                parser.error("--instance name %r is reserved for /status/%s" % (name, name))
+        if len(set(names)) != len(names):
+            parser.error("--instance names must be unique")
+        if int(args.workers) < 1:
+            parser.error("--workers must be at least 1")
 
     log_level = logging.getLevelName(args.log_level)
     global_log_level = logging.getLevelName(args.global_log_level)
@@ -383,22 +5016,163 @@ if __name__ == "__main__":
     logger = logging.getLogger("dropbox_monitor")
     logger.setLevel(log_level)
 
-    dropbox = DropboxInterface(logger)
-    monitor = DropboxMonitor(
-        dropbox=dropbox,
-        min_poll_interval_sec=int(args.min_poll_interval_sec),
-        logger=logger,
-        prom_port=args.port,
-    )
-    monitor.start()
+    if args.wait_ready:
+
+        def daemon_alive() -> bool:
+            try:
+                os.kill(args.pid, 0)
+            except ProcessLookupError:
+                return False
+            except PermissionError:
+                pass
+            return True
+
+        readiness = wait_until_ready(
+            timeout=float(args.ready_timeout),
+            is_alive=daemon_alive if args.pid else lambda: True,
+        )
+        raise SystemExit(
+            {Readiness.READY: 0, Readiness.TIMEOUT: 1, Readiness.EXITED: 2}[readiness]
+        )
+
+    # One monitor per Dropbox home. Without --instance that is /opt/dropbox,
+    # with the paths from the command line.
+    instances = [(None, DROPBOX_HOME)]  # type: List[Tuple[Optional[str], str]]
+    query_slots = None  # type: Optional[QuerySlots]
+    if args.instance:
+        instances = [tuple(spec.split("=", 1)) for spec in args.instance]
+        query_slots = QuerySlots(int(args.workers), float(args.stuck_after))
+
+    monitors = OrderedDict()  # type: OrderedDict
+    for name, home in instances:
+        if name is None:
+            socket_path = args.command_socket
+            sync_root = SYNC_ROOT
+            journal_path = args.journal
+            folder_index_path = args.folder_index
+            process_reader = DaemonProcessReader()
+        else:
+            socket_path = os.path.join(home, ".dropbox", "command_socket")
+            sync_root = os.path.join(home, "Dropbox")
+            journal_path = os.path.join(home, ".dropbox-docker", "monitor.journal")
+            folder_index_path = os.path.join(home, ".dropbox-docker", "folders.sqlite")
+            process_reader = DaemonProcessReader(
+                pid_file=os.path.join(home, ".dropbox", "dropbox.pid"), scan_proc=False
+            )
+        cache = StatusCache(
+            max_entries=int(args.cache_max_entries),
+            default_ttl=float(args.exclude_cache_ttl),
+        )
+        if args.backend == "socket":
+            client = CommandSocketClient(socket_path, timeout=float(args.socket_timeout))
+            dropbox = SocketDropboxInterface(
+                logger, client, sync_root, cache=cache, home=home if name else None, owner=owner
+            )  # type: DropboxInterface
+        else:
+            dropbox = DropboxInterface(logger, cache, home=home if name else None, owner=owner)
+        monitors[name] = DropboxMonitor(
+            dropbox=dropbox,
+            min_poll_interval_sec=int(args.min_poll_interval_sec),
+            logger=logging.getLogger("dropbox_monitor.%s" % name) if name else logger,
+            prom_port=int(args.port),
+            process_reader=process_reader,
+            max_poll_interval_sec=int(args.max_poll_interval_sec),
+            watch_paths=[] if args.no_watch else [sync_root],
+            journal=None if args.no_journal else StateJournal(journal_path),
+            folder_indexer=FolderIndexer(
+                FolderIndex(folder_index_path, sync_root, exclude_list=dropbox.query_exclude_list),
+                logger,
+                scan_interval=float(args.folder_scan_interval),
+            ) if float(args.folder_scan_interval) > 0 else None,
+            instance=name,
+            registry=CollectorRegistry() if name else REGISTRY,
+            socket_path=socket_path,
+            query_slots=query_slots,
+            status_tree=StatusTree(dropbox, sync_root, logger),
+            health=HealthCheck(
+                stale_after=max(300.0, 3 * float(args.max_poll_interval_sec)),
+                unsynced_after=float(args.health_unsynced_after),
+            ),
+        )
+
+    group = None  # type: Optional[MonitorGroup]
+    monitor = None  # type: Optional[DropboxMonitor]
+    if query_slots is not None:
+        group = MonitorGroup(monitors, query_slots)
+        group.start()
+        if not args.no_servers:
+            start_http_server(int(args.port))
+            logger.info(
+                "Started Prometheus server on port %d for %d instances",
+                int(args.port),
+                len(monitors),
+            )
+    else:
+        monitor = monitors[None]
+        monitor.start(serve_metrics=not args.no_servers)
 
     # Start JSON status API
-    start_status_server(monitor, int(args.status_port), logger)
+    if not args.no_servers:
+        start_status_server(
+            monitor,
+            int(args.status_port),
+            logger,
+            float(args.request_timeout),
+            admin_token=args.admin_token,
+            group=group,
+        )
 
     exit_event = Event()
     signal.signal(signal.SIGHUP, lambda _s, _f: exit_event.set())
     signal.signal(signal.SIGINT, lambda _s, _f: exit_event.set())
     signal.signal(signal.SIGTERM, lambda _s, _f: exit_event.set())
 
-    exit_event.wait()
+    supervisor = None  # type: Optional[DaemonSupervisor]
+    if args.supervise:
+        supervisor = DaemonSupervisor(
+            args.command,
+            monitor,
+            logger,
+            max_restarts=int(args.max_restarts),
+            restart_delay_sec=float(args.restart_delay),
+            max_restart_delay_sec=float(args.max_restart_delay),
+        )
+
+    workers = []  # type: List[Any]
+    for (name, home), instance_monitor in zip(instances, monitors.values()):
+        if args.sync_probe_dir:
+            sync_root = SYNC_ROOT if name is None else os.path.join(home, "Dropbox")
+            workers.append(SyncProbe(
+                instance_monitor,
+                os.path.join(sync_root, args.sync_probe_dir.strip("/")),
+                instance_monitor.logger,
+                interval=float(args.sync_probe_interval),
+                timeout=float(args.sync_probe_timeout),
+                owner=owner,
+            ))
+        if float(args.cache_scan_interval) > 0:
+            workers.append(CacheWatchdog(
+                instance_monitor,
+                instance_monitor.logger,
+                # The supervisor restarts the daemon with locked analytics; on its
+                # own the monitor can only delete what the daemon has written
+                on_limit=supervisor.request_restart if supervisor is not None
+                else partial(clear_analytics, home),
+                limit_bytes=int(args.cache_limit_mb) * 1024 * 1024,
+                home=home,
+                scan_interval=float(args.cache_scan_interval),
+            ))
+    for worker in workers:
+        worker.start()
+
+    exit_code = 0
+    if supervisor is not None:
+        exit_code = supervisor.run(exit_event)
+    else:
+        exit_event.wait()
+    for worker in workers:
+        worker.stop()
+    for instance_monitor in monitors.values():
+        instance_monitor.stop()
     logger.info("Stopped gracefully")
+    raise SystemExit(exit_code)
@@ -0,0 +1,552 @@
+"""
+Keeps the Dropbox sync folder owned by the dropbox user.
+
+Files created by other users (e.g. root via SSH) won't sync until they are
+owned by the account the daemon runs as. This runs as root next to the
+daemon and repairs ownership incrementally: new entries are fixed as soon
+as inotify reports them, and a rare full scan catches anything inotify
+missed. Full scans skip re-checking the files of any directory whose mtime
+hasn't changed since the last persisted checkpoint.
+
+The ``initial`` command replaces the startup ``chown -R``: a multi-threaded,
+resumable pass over the whole volume.
+"""
+from argparse import ArgumentParser
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+import errno
+import json
+import logging
+import os
+import signal
+import stat
+from threading import Event
+from time import monotonic
+from typing import Dict, List, Optional, Tuple
+
+from prometheus_client import start_http_server, Counter, Gauge, REGISTRY  # type: ignore
+
+from monitoring import DROPBOX_HOME, Inotify, InotifyEvent, STATE_DIR, SYNC_ROOT
+
+CHECKPOINT_FILE = os.path.join(STATE_DIR, "ownership.json")
+INITIAL_CHECKPOINT_FILE = os.path.join(STATE_DIR, "permissions.json")
+
+# Events that may leave an entry owned by someone else
+WATCH_MASK = (
+    Inotify.IN_CREATE
+    | Inotify.IN_MOVED_TO
+    | Inotify.IN_MOVED_FROM
+    | Inotify.IN_ATTRIB
+    | Inotify.IN_ONLYDIR
+    | Inotify.IN_DONT_FOLLOW
+)
+
+
+def chown_if_needed(
+    path: str, uid: int, gid: int, st: Optional[os.stat_result] = None, match_gid: bool = False
+) -> bool:
+    """chown ``path`` unless it is already owned by ``uid`` (and ``gid`` if ``match_gid``)."""
+    try:
+        if st is None:
+            st = os.lstat(path)
+        if st.st_uid == uid and (not match_gid or st.st_gid == gid):
+            return False
+        os.chown(path, uid, gid, follow_symlinks=False)
+    except OSError:
+        return False
+    return True
+
+
+class OwnershipFixer:
+    """
+    Repairs ownership under ``root`` using inotify plus checkpointed scans.
+
+    The checkpoint maps every directory (relative to ``root``) to its mtime
+    and subdirectory names as of the last scan. A directory's mtime only
+    changes when entries are added, removed or renamed, so an unchanged
+    mtime means its files need no re-check and its subdirectories are
+    already known; the scan then costs one stat per directory.
+    """
+
+    def __init__(
+        self,
+        root: str,
+        uid: int,
+        gid: int,
+        logger: logging.Logger,
+        checkpoint_path: Optional[str] = CHECKPOINT_FILE,
+        max_watches: int = 100000,
+        registry=REGISTRY,
+    ) -> None:
+        self.root = root
+        self.uid = uid
+        self.gid = gid
+        self.logger = logger
+        self.checkpoint_path = checkpoint_path
+        self.max_watches = max_watches
+        self.checkpoint = self._load_checkpoint()  # type: Dict[str, Tuple[int, List[str]]]
+        self.scan_requested = False
+        self.inotify = None  # type: Optional[Inotify]
+        self._watches = {}  # type: Dict[int, str]
+        self._watched_paths = {}  # type: Dict[str, int]
+        self._watch_limit_logged = False
+
+        self.fixed_counter = Counter(
+            "dropbox_ownership_fixed",
+            "Entries whose ownership was repaired",
+            ["source"],
+            registry=registry,
+        )
+        self.scans_counter = Counter(
+            "dropbox_ownership_scans",
+            "Ownership scans of the sync folder",
+            ["kind"],
+            registry=registry,
+        )
+        self.scan_duration_gauge = Gauge(
+            "dropbox_ownership_last_scan_duration_seconds",
+            "Duration of the last ownership scan",
+            registry=registry,
+        )
+        self.watches_gauge = Gauge(
+            "dropbox_ownership_watches",
+            "inotify watches held by the ownership fixer",
+            registry=registry,
+        )
+        self.watches_gauge.set_function(lambda: len(self._watches))
+
+    def start_watching(self) -> None:
+        """Enable inotify; watches are added as the tree is scanned."""
+        try:
+            self.inotify = Inotify()
+        except OSError as e:
+            self.logger.warning("inotify unavailable (%s), relying on periodic scans", e)
+
+    def fix(self, path: str, st: Optional[os.stat_result] = None) -> bool:
+        """chown ``path`` to the dropbox user if someone else owns it."""
+        return chown_if_needed(path, self.uid, self.gid, st)
+
+    def scan(self, deep: bool = False) -> int:
+        """
+        Walk the whole tree and fix what needs fixing. A ``deep`` scan
+        ignores the checkpoint and re-checks every entry.
+        """
+        started = monotonic()
+        previous = {} if deep else self.checkpoint
+        self.checkpoint = {}
+        fixed = self._walk(self.root, previous, self.checkpoint)
+        duration = monotonic() - started
+
+        self.scans_counter.labels(kind="deep" if deep else "incremental").inc()
+        self.scan_duration_gauge.set(duration)
+        self.fixed_counter.labels(source="scan").inc(fixed)
+        self.save_checkpoint()
+        self.logger.info(
+            "Ownership scan (%s) fixed %d entries across %d directories in %.1fs",
+            "deep" if deep else "incremental",
+            fixed,
+            len(self.checkpoint),
+            duration,
+        )
+        return fixed
+
+    def _walk(
+        self,
+        start: str,
+        previous: Dict[str, Tuple[int, List[str]]],
+        current: Dict[str, Tuple[int, List[str]]],
+    ) -> int:
+        fixed = 0
+        stack = [start]
+        while stack:
+            path = stack.pop()
+            try:
+                st = os.lstat(path)
+            except OSError:
+                continue
+            if not stat.S_ISDIR(st.st_mode):
+                fixed += self.fix(path, st)
+                continue
+            fixed += self.fix(path, st)
+            self._add_watch(path)
+
+            key = self._relative(path)
+            known = previous.get(key)
+            if known is not None and known[0] == st.st_mtime_ns:
+                subdirs = known[1]
+            else:
+                subdirs = []
+                try:
+                    with os.scandir(path) as entries:
+                        for entry in entries:
+                            if entry.is_dir(follow_symlinks=False):
+                                subdirs.append(entry.name)
+                            else:
+                                fixed += self.fix(entry.path, entry.stat(follow_symlinks=False))
+                except OSError:
+                    continue
+            current[key] = (st.st_mtime_ns, subdirs)
+            stack.extend(os.path.join(path, name) for name in subdirs)
+        return fixed
+
+    def handle_events(self, events: List[InotifyEvent]) -> int:
+        fixed = 0
+        for event in events:
+            if event.mask & Inotify.IN_Q_OVERFLOW:
+                self.logger.warning("inotify queue overflowed, scheduling a full scan")
+                self.scan_requested = True
+                continue
+            if event.mask & Inotify.IN_IGNORED:
+                path = self._watches.pop(event.wd, None)
+                if path is not None and self._watched_paths.get(path) == event.wd:
+                    del self._watched_paths[path]
+                continue
+
+            parent = self._watches.get(event.wd)
+            if parent is None:
+                continue
+            if not event.name:
+                # Attributes of the watched directory itself changed
+                fixed += self.fix(parent)
+                continue
+
+            path = os.path.join(parent, event.name)
+            if event.mask & Inotify.IN_ISDIR:
+                if event.mask & Inotify.IN_MOVED_FROM:
+                    self._forget_subtree(path)
+                elif event.mask & (Inotify.IN_CREATE | Inotify.IN_MOVED_TO):
+                    # Entries may have been created before the watch was added
+                    fixed += self._walk(path, {}, self.checkpoint)
+                else:
+                    fixed += self.fix(path)
+            elif not event.mask & Inotify.IN_MOVED_FROM:
+                fixed += self.fix(path)
+
+        self.fixed_counter.labels(source="event").inc(fixed)
+        return fixed
+
+    def run(
+        self,
+        stop: Event,
+        scan_interval: float = 6 * 3600,
+        deep_scan_every: int = 28,
+    ) -> None:
+        """Fix ownership until ``stop`` is set."""
+        while not os.path.isdir(self.root):
+            self.logger.info("Waiting for %s to appear", self.root)
+            if stop.wait(30):
+                return
+
+        self.start_watching()
+        scans = 0
+        self.scan()
+        next_scan = monotonic() + scan_interval
+        while not stop.is_set():
+            if self.scan_requested or monotonic() >= next_scan:
+                scans += 1
+                self.scan_requested = False
+                self.scan(deep=deep_scan_every > 0 and scans % deep_scan_every == 0)
+                next_scan = monotonic() + scan_interval
+            timeout = min(1.0, max(0.0, next_scan - monotonic()))
+            if self.inotify is not None:
+                self.handle_events(self.inotify.read(timeout))
+            else:
+                stop.wait(timeout)
+
+        self.save_checkpoint()
+        if self.inotify is not None:
+            self.inotify.close()
+
+    def _add_watch(self, path: str) -> None:
+        if self.inotify is None or path in self._watched_paths:
+            return
+        if len(self._watches) >= self.max_watches:
+            self._log_watch_limit()
+            return
+        try:
+            wd = self.inotify.add_watch(path, WATCH_MASK)
+        except OSError as e:
+            self.logger.debug("Could not watch %s: %s", path, e)
+            if e.errno == errno.ENOSPC:  # out of inotify watches
+                self._log_watch_limit()
+            return
+        self._watches[wd] = path
+        self._watched_paths[path] = wd
+
+    def _forget_subtree(self, path: str) -> None:
+        prefix = path + os.sep
+        for watched in [p for p in self._watched_paths if p == path or p.startswith(prefix)]:
+            wd = self._watched_paths.pop(watched)
+            self._watches.pop(wd, None)
+            if self.inotify is not None:
+                self.inotify.rm_watch(wd)
+
+    def _log_watch_limit(self) -> None:
+        if not self._watch_limit_logged:
+            self._watch_limit_logged = True
+            self.logger.warning(
+                "Watch limit reached (%d); remaining directories rely on periodic scans",
+                len(self._watches),
+            )
+
+    def _relative(self, path: str) -> str:
+        return os.path.relpath(path, self.root)
+
+    def _load_checkpoint(self) -> Dict[str, Tuple[int, List[str]]]:
+        if not self.checkpoint_path:
+            return {}
+        try:
+            with open(self.checkpoint_path) as f:
+                data = json.load(f)
+            if data.get("root") != self.root:
+                return {}
+            return {key: (value[0], value[1]) for key, value in data["dirs"].items()}
+        except (OSError, ValueError, KeyError, TypeError):
+            return {}
+
+    def save_checkpoint(self) -> None:
+        if not self.checkpoint_path:
+            return
+        tmp_path = self.checkpoint_path + ".tmp"
+        try:
+            os.makedirs(os.path.dirname(self.checkpoint_path), exist_ok=True)
+            with open(tmp_path, "w") as f:
+                json.dump({"root": self.root, "dirs": self.checkpoint}, f, separators=(",", ":"))
+            os.replace(tmp_path, self.checkpoint_path)
+        except OSError:
+            self.logger.exception("Failed to save ownership checkpoint")
+
+
+class InitialPass:
+    """
+    One-off ownership pass over ``root``, replacing ``chown -R``.
+
+    Directories are listed by a pool of threads and only entries with the
+    wrong owner or group are chowned. The directories still to be visited
+    are checkpointed every ``progress_interval`` seconds, so an interrupted
+    pass resumes from there instead of starting over. The checkpoint is
+    removed once the pass completes.
+    """
+
+    def __init__(
+        self,
+        root: str,
+        uid: int,
+        gid: int,
+        logger: logging.Logger,
+        checkpoint_path: Optional[str] = INITIAL_CHECKPOINT_FILE,
+        workers: int = 8,
+        progress_interval: float = 30.0,
+    ) -> None:
+        self.root = root
+        self.uid = uid
+        self.gid = gid
+        self.logger = logger
+        self.checkpoint_path = checkpoint_path
+        self.workers = max(1, workers)
+        self.progress_interval = progress_interval
+        self.directories = 0
+        self.checked = 0
+        self.fixed = 0
+
+    def run(self, stop: Optional[Event] = None) -> bool:
+        """Run (or resume) the pass. Returns False if ``stop`` interrupted it."""
+        stop = stop or Event()
+        pending = self._load_checkpoint()
+        if pending is None:
+            self.checked += 1
+            self.fixed += chown_if_needed(self.root, self.uid, self.gid, match_gid=True)
+            pending = [self.root]
+        else:
+            self.logger.info(
+                "Resuming permission pass (%d directories pending, %d entries fixed so far)",
+                len(pending),
+                self.fixed,
+            )
+
+        started = last_report = monotonic()
+        in_flight = {}  # type: Dict[Future, str]
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            while (pending or in_flight) and not stop.is_set():
+                # Depth-first keeps the pending list (and the checkpoint) small
+                while pending and len(in_flight) < self.workers * 2:
+                    path = pending.pop()
+                    in_flight[pool.submit(self._visit, path)] = path
+                done, _ = wait(in_flight, timeout=1.0, return_when=FIRST_COMPLETED)
+                for future in done:
+                    del in_flight[future]
+                    subdirs, checked, fixed = future.result()
+                    pending.extend(subdirs)
+                    self.directories += 1
+                    self.checked += checked
+                    self.fixed += fixed
+
+                if monotonic() - last_report >= self.progress_interval:
+                    last_report = monotonic()
+                    self._report(started, len(pending) + len(in_flight))
+                    self._save_checkpoint(pending + list(in_flight.values()))
+            # Directories still running are listed again on resume
+            remaining = pending + list(in_flight.values())
+
+        if remaining:
+            self._save_checkpoint(remaining)
+            self.logger.info(
+                "Permission pass interrupted with %d directories pending", len(remaining)
+            )
+            return False
+
+        self._report(started, 0)
+        self._remove_checkpoint()
+        return True
+
+    def _visit(self, path: str) -> Tuple[List[str], int, int]:
+        subdirs = []
+        checked = fixed = 0
+        try:
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    try:
+                        st = entry.stat(follow_symlinks=False)
+                    except OSError:
+                        continue
+                    checked += 1
+                    fixed += chown_if_needed(entry.path, self.uid, self.gid, st, match_gid=True)
+                    if stat.S_ISDIR(st.st_mode):
+                        subdirs.append(entry.path)
+        except OSError as e:
+            self.logger.warning("Could not list %s: %s", path, e)
+        return subdirs, checked, fixed
+
+    def _report(self, started: float, pending: int) -> None:
+        elapsed = monotonic() - started
+        self.logger.info(
+            "Permissions: %d entries checked, %d fixed, %d directories done, %d pending (%.0f entries/s)",
+            self.checked,
+            self.fixed,
+            self.directories,
+            pending,
+            self.checked / elapsed if elapsed > 0 else 0,
+        )
+
+    def _load_checkpoint(self) -> Optional[List[str]]:
+        if not self.checkpoint_path:
+            return None
+        try:
+            with open(self.checkpoint_path) as f:
+                data = json.load(f)
+            if data.get("root") != self.root:
+                return None
+            pending = [os.path.normpath(os.path.join(self.root, path)) for path in data["pending"]]
+            self.directories = data["directories"]
+            self.checked = data["checked"]
+            self.fixed = data["fixed"]
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+        return pending
+
+    def _save_checkpoint(self, pending: List[str]) -> None:
+        if not self.checkpoint_path:
+            return
+        tmp_path = self.checkpoint_path + ".tmp"
+        try:
+            os.makedirs(os.path.dirname(self.checkpoint_path), exist_ok=True)
+            with open(tmp_path, "w") as f:
+                json.dump(
+                    {
+                        "root": self.root,
+                        "pending": [os.path.relpath(path, self.root) for path in pending],
+                        "directories": self.directories,
+                        "checked": self.checked,
+                        "fixed": self.fixed,
+                    },
+                    f,
+                    separators=(",", ":"),
+                )
+            os.replace(tmp_path, self.checkpoint_path)
+        except OSError:
+            self.logger.exception("Failed to save permission pass checkpoint")
+
+    def _remove_checkpoint(self) -> None:
+        if not self.checkpoint_path:
+            return
+        try:
+            os.remove(self.checkpoint_path)
+        except FileNotFoundError:
+            pass
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Keeps the Dropbox folder owned by the dropbox user")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    watch = subparsers.add_parser("watch", help="repair ownership continuously")
+    watch.add_argument("--uid", type=int, required=True)
+    watch.add_argument("--gid", type=int, required=True)
+    watch.add_argument("--root", default=SYNC_ROOT)
+    watch.add_argument("--checkpoint", default=CHECKPOINT_FILE)
+    watch.add_argument(
+        "--scan-interval",
+        type=float,
+        default=6 * 3600,
+        help="seconds between full scans (in addition to inotify)",
+    )
+    watch.add_argument(
+        "--deep-scan-every",
+        type=int,
+        default=28,
+        help="every Nth full scan ignores the checkpoint (0 disables)",
+    )
+    watch.add_argument("--max-watches", type=int, default=100000)
+    watch.add_argument("--metrics-port", type=int, help="serve Prometheus metrics on this port")
+
+    initial = subparsers.add_parser(
+        "initial", help="one-off parallel, resumable ownership pass (replaces chown -R)"
+    )
+    initial.add_argument("--uid", type=int, required=True)
+    initial.add_argument("--gid", type=int, required=True)
+    initial.add_argument("--root", default=DROPBOX_HOME)
+    initial.add_argument("--checkpoint", default=INITIAL_CHECKPOINT_FILE)
+    initial.add_argument("--workers", type=int, default=8)
+    initial.add_argument(
+        "--progress-interval",
+        type=float,
+        default=30,
+        help="seconds between progress reports and checkpoints",
+    )
+    parser.add_argument("--log_level", default="INFO")
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        format="[OWNERSHIP %(levelname)s]: %(message)s",
+        level=logging.getLevelName(args.log_level),
+    )
+    logger = logging.getLogger("dropbox_ownership")
+
+    exit_event = Event()
+    signal.signal(signal.SIGHUP, lambda _s, _f: exit_event.set())
+    signal.signal(signal.SIGINT, lambda _s, _f: exit_event.set())
+    signal.signal(signal.SIGTERM, lambda _s, _f: exit_event.set())
+
+    if args.command == "initial":
+        permission_pass = InitialPass(
+            args.root,
+            args.uid,
+            args.gid,
+            logger,
+            args.checkpoint,
+            args.workers,
+            args.progress_interval,
+        )
+        if not permission_pass.run(exit_event):
+            raise SystemExit(1)
+        logger.info("Permission pass complete")
+        raise SystemExit(0)
+
+    fixer = OwnershipFixer(
+        args.root, args.uid, args.gid, logger, args.checkpoint, args.max_watches
+    )
+    if args.metrics_port:
+        start_http_server(args.metrics_port)
+        logger.info("Started Prometheus server on port %d", args.metrics_port)
+
+    fixer.run(exit_event, args.scan_interval, args.deep_scan_every)
+    logger.info("Stopped gracefully")
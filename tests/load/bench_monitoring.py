@@ -0,0 +1,288 @@
+"""
+Load test for monitoring.py against the fake Dropbox daemon.
+
+Starts a FakeCommandSocket (replaying tests/unit/data/sync_session.txt) and a
+fake `dropbox` CLI, runs monitoring.py against them as a subprocess, and
+hammers its Prometheus and /status endpoints from concurrent clients. Reports
+p50/p99 latency per endpoint, and the CPU time and RSS of monitoring.py.
+
+    python tests/load/bench_monitoring.py --duration 30 --concurrency 16
+    python tests/load/bench_monitoring.py --daemon-delay 2 --hang-every 10 --json
+
+Faults are injected into the daemon, not the monitor: a slow daemon
+(--daemon-delay), one request that never answers every --hang-every seconds,
+and a crash (--crash-at) followed by a restart two seconds later.
+"""
+import argparse
+import http.client
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".."))
+sys.path.insert(0, os.path.join(ROOT, "tests", "unit"))
+
+from fake_dropbox import FakeCommandSocket, install_cli, load_recording  # noqa: E402
+
+RECORDING = os.path.join(ROOT, "tests", "unit", "data", "sync_session.txt")
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK")
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def percentile(values, p):
+    """Nearest-rank percentile of an unsorted list."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, int(round(p / 100.0 * len(ordered))) - 1))]
+
+
+class ProcessSampler:
+    """Samples CPU time and RSS of one process from /proc."""
+
+    def __init__(self, pid, interval=0.25):
+        self.pid = pid
+        self.interval = interval
+        self.rss_samples = []
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def cpu_seconds(self):
+        with open("/proc/%d/stat" % self.pid) as f:
+            fields = f.read().rpartition(")")[2].split()
+        # utime and stime are fields 14 and 15; the split starts at field 3
+        return (int(fields[11]) + int(fields[12])) / CLOCK_TICKS
+
+    def rss_bytes(self):
+        with open("/proc/%d/status" % self.pid) as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+        return 0
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.rss_samples.append(self.rss_bytes())
+            except OSError:
+                return
+
+
+class Client(threading.Thread):
+    """One keep-alive connection per port, requesting ``paths`` round-robin."""
+
+    def __init__(self, targets, deadline, timeout):
+        super().__init__(daemon=True)
+        self.targets = targets
+        self.deadline = deadline
+        self.timeout = timeout
+        self.latencies = {name: [] for name, _, _ in targets}
+        self.errors = {name: 0 for name, _, _ in targets}
+        self._connections = {}
+
+    def run(self):
+        i = 0
+        while time.monotonic() < self.deadline:
+            name, port, path = self.targets[i % len(self.targets)]
+            i += 1
+            started = time.monotonic()
+            try:
+                conn = self._connections.get(port)
+                if conn is None:
+                    conn = self._connections[port] = http.client.HTTPConnection(
+                        "127.0.0.1", port, timeout=self.timeout
+                    )
+                conn.request("GET", path)
+                response = conn.getresponse()
+                response.read()
+                if response.status != 200:
+                    raise OSError("HTTP %d" % response.status)
+                if response.will_close:
+                    conn.close()
+                    self._connections.pop(port)
+            except (OSError, http.client.HTTPException):
+                self.errors[name] += 1
+                conn = self._connections.pop(port, None)
+                if conn is not None:
+                    conn.close()
+                continue
+            self.latencies[name].append(time.monotonic() - started)
+        for conn in self._connections.values():
+            conn.close()
+
+
+def wait_for_health(port, timeout=15):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            conn = http.client.HTTPConnection("127.0.0.1", port, timeout=1)
+            conn.request("GET", "/health")
+            if conn.getresponse().status == 200:
+                return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError("monitoring.py did not come up on port %d" % port)
+
+
+def run_benchmark(
+    duration=10.0,
+    concurrency=8,
+    poll_interval=1,
+    daemon_delay=0.0,
+    hang_every=0.0,
+    crash_at=None,
+    request_timeout=15.0,
+):
+    workdir = tempfile.mkdtemp(prefix="dbxbench")
+    socket_path = os.path.join(workdir, "command_socket")
+    fake = FakeCommandSocket(socket_path, ignore_set=["/opt/dropbox/Dropbox/Backups"])
+    fake.replay(load_recording(RECORDING))
+    fake.delay = daemon_delay
+    fake.start()
+    install_cli(os.path.join(workdir, "bin"), socket_path)
+
+    prom_port, status_port = free_port(), free_port()
+    env = dict(os.environ, PATH=os.path.join(workdir, "bin") + os.pathsep + os.environ["PATH"])
+    monitor = subprocess.Popen(
+        [
+            sys.executable, os.path.join(ROOT, "monitoring.py"),
+            "--command-socket", socket_path,
+            "-i", str(poll_interval),
+            "--max_poll_interval_sec", str(poll_interval),
+            "-p", str(prom_port),
+            "--status-port", str(status_port),
+            "--no-watch", "--no-journal",
+            "--folder-scan-interval", "0",
+            "--log_level", "WARNING",
+        ],
+        env=env,
+    )
+    sampler = ProcessSampler(monitor.pid)
+    try:
+        wait_for_health(status_port)
+        targets = [
+            ("/metrics", prom_port, "/metrics"),
+            ("/status", status_port, "/status"),
+            ("/status/history", status_port, "/status/history?since=-300"),
+        ]
+        cpu_before = sampler.cpu_seconds()
+        sampler.start()
+        started = time.monotonic()
+        deadline = started + duration
+        clients = [Client(targets, deadline, request_timeout) for _ in range(concurrency)]
+        for client in clients:
+            client.start()
+
+        next_hang = started + hang_every if hang_every else None
+        crashed = False
+        while time.monotonic() < deadline:
+            now = time.monotonic()
+            if next_hang is not None and now >= next_hang:
+                fake.hang_next = True
+                next_hang += hang_every
+            if crash_at is not None and not crashed and now - started >= crash_at:
+                fake.stop()
+                crashed = True
+                threading.Timer(2, fake.start).start()
+            time.sleep(0.05)
+
+        for client in clients:
+            client.join(request_timeout)
+        elapsed = time.monotonic() - started
+        sampler.stop()
+        cpu_seconds = sampler.cpu_seconds() - cpu_before
+        rss = sampler.rss_samples or [sampler.rss_bytes()]
+    finally:
+        monitor.terminate()
+        try:
+            monitor.wait(10)
+        except subprocess.TimeoutExpired:
+            monitor.kill()
+        fake.stop()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    endpoints = {}
+    for name, _, _ in targets:
+        latencies = [l for client in clients for l in client.latencies[name]]
+        endpoints[name] = {
+            "requests": len(latencies),
+            "errors": sum(client.errors[name] for client in clients),
+            "per_second": round(len(latencies) / elapsed, 1),
+            "p50_ms": round(percentile(latencies, 50) * 1000, 2) if latencies else None,
+            "p99_ms": round(percentile(latencies, 99) * 1000, 2) if latencies else None,
+            "max_ms": round(max(latencies) * 1000, 2) if latencies else None,
+        }
+    return {
+        "duration_seconds": round(elapsed, 2),
+        "concurrency": concurrency,
+        "daemon_requests": len(fake.requests),
+        "endpoints": endpoints,
+        "monitor": {
+            "cpu_seconds": round(cpu_seconds, 2),
+            "cpu_percent": round(100 * cpu_seconds / elapsed, 1),
+            "rss_mb": round(rss[-1] / 1024 / 1024, 1),
+            "peak_rss_mb": round(max(rss) / 1024 / 1024, 1),
+        },
+    }
+
+
+def print_report(result):
+    print("%d clients for %.1fs, %d daemon requests" % (
+        result["concurrency"], result["duration_seconds"], result["daemon_requests"]
+    ))
+    print("%-18s %9s %7s %8s %9s %9s %9s" % (
+        "endpoint", "requests", "errors", "req/s", "p50 ms", "p99 ms", "max ms"
+    ))
+    for name, stats in result["endpoints"].items():
+        print("%-18s %9d %7d %8.1f %9s %9s %9s" % (
+            name, stats["requests"], stats["errors"], stats["per_second"],
+            stats["p50_ms"], stats["p99_ms"], stats["max_ms"],
+        ))
+    monitor = result["monitor"]
+    print("monitoring.py: %.2fs CPU (%.1f%%), RSS %.1f MB (peak %.1f MB)" % (
+        monitor["cpu_seconds"], monitor["cpu_percent"], monitor["rss_mb"], monitor["peak_rss_mb"]
+    ))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--duration", type=float, default=10, help="seconds of load")
+    parser.add_argument("--concurrency", type=int, default=8, help="concurrent clients")
+    parser.add_argument("--poll-interval", type=int, default=1, help="monitor polling interval")
+    parser.add_argument("--daemon-delay", type=float, default=0.0,
+                        help="seconds the fake daemon stalls every reply")
+    parser.add_argument("--hang-every", type=float, default=0.0,
+                        help="make one daemon request hang every N seconds")
+    parser.add_argument("--crash-at", type=float, help="crash the daemon after N seconds")
+    parser.add_argument("--json", action="store_true", help="print the result as JSON")
+    args = parser.parse_args()
+    result = run_benchmark(
+        duration=args.duration,
+        concurrency=args.concurrency,
+        poll_interval=args.poll_interval,
+        daemon_delay=args.daemon_delay,
+        hang_every=args.hang_every,
+        crash_at=args.crash_at,
+    )
+    if args.json:
+        print(json.dumps(result, indent=2))
+    else:
+        print_report(result)
@@ -1,5 +1,7 @@
+import logging
 import sys
 import os
+from unittest.mock import MagicMock
 
 import pytest
 from prometheus_client import REGISTRY
@@ -7,6 +9,8 @@ from prometheus_client import REGISTRY
 # Add project root to path so we can import monitoring
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..'))
 
+from monitoring import DropboxInterface, DropboxMonitor  # noqa: E402
+
 
 @pytest.fixture(autouse=True)
 def clear_prometheus_registry():
@@ -18,3 +22,17 @@ def clear_prometheus_registry():
             REGISTRY.unregister(collector)
         except Exception:
             pass
+
+
+@pytest.fixture
+def make_monitor():
+    """Build a DropboxMonitor whose mocked Dropbox reports ``status``."""
+    def make(status="Up to date\n", **kwargs):
+        dropbox = MagicMock(spec=DropboxInterface)
+        dropbox.query_status.return_value = status
+        dropbox.query_account_info.return_value = None
+        dropbox.query_exclude_list.return_value = []
+        dropbox.query_version.return_value = None
+        kwargs.setdefault("logger", logging.getLogger("test"))
+        return DropboxMonitor(dropbox=dropbox, min_poll_interval_sec=5, prom_port=9999, **kwargs)
+    return make
@@ -0,0 +1,255 @@
+"""
+Local stand-in for the Dropbox daemon's command_socket.
+
+Speaks the same line protocol as dropbox.py so that CommandSocketClient and
+SocketDropboxInterface can be tested without a real daemon. Run as a script,
+it is also a fake `dropbox` CLI answering from such a socket (see
+install_cli):
+
+    python fake_dropbox.py --socket PATH status
+"""
+import argparse
+import os
+import socketserver
+import sys
+import threading
+import time
+
+
+class FakeCommandError(Exception):
+    """Raise from a handler to make the fake daemon answer ``notok``."""
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        fake = self.server.fake
+        fake.connections += 1
+        while True:
+            name = self.rfile.readline()
+            if not name:
+                return
+            name = name.decode("utf-8").rstrip("\n")
+            args = {}
+            while True:
+                line = self.rfile.readline()
+                if not line:
+                    return
+                line = line.decode("utf-8").rstrip("\n")
+                if line == "done":
+                    break
+                fields = line.split("\t")
+                args[fields[0]] = fields[1:]
+
+            fake.requests.append((name, args))
+            if fake.delay:
+                time.sleep(fake.delay)
+            if fake.drop_next:
+                fake.drop_next = False
+                return
+            if fake.hang_next:
+                fake.hang_next = False
+                # Never answer, like a wedged daemon; released on stop()
+                fake.stopping.wait()
+                return
+            if fake.crash_after is not None and len(fake.requests) >= fake.crash_after:
+                fake.crash_after = None
+                threading.Thread(target=fake.stop).start()
+                return
+
+            handler = fake.handlers.get(name)
+            try:
+                if handler is None:
+                    raise FakeCommandError("No such command: %s" % name)
+                result = handler(args)
+                lines = ["ok"] + [
+                    "\t".join([key] + list(values)) for key, values in result.items()
+                ]
+            except FakeCommandError as e:
+                lines = ["notok", str(e)]
+            lines.append("done")
+            self.wfile.write(("\n".join(lines) + "\n").encode("utf-8"))
+            self.wfile.flush()
+
+
+class _Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # Clients that timed out and hung up are expected here
+        pass
+
+
+class FakeCommandSocket:
+    """
+    Serves canned command_socket responses on a Unix socket.
+
+    ``handlers`` maps a command name to a callable taking the parsed request
+    arguments and returning a ``key -> [values]`` dict. ``file_status`` maps
+    absolute paths to their per-file status (default "up to date").
+
+    Faults: ``delay`` stalls every reply, ``drop_next`` closes the connection
+    instead of answering the next request, ``hang_next`` never answers it,
+    and ``crash_after`` stops the daemon (socket and all) once that many
+    requests have been received. ``start()`` brings it back.
+    """
+
+    def __init__(self, path, status=None, ignore_set=None):
+        self.path = path
+        self.status = list(status) if status is not None else ["Up to date"]
+        self.ignore_set = list(ignore_set or [])
+        self.file_status = {}
+        self.requests = []
+        self.connections = 0
+        self.delay = 0.0
+        self.drop_next = False
+        self.hang_next = False
+        self.crash_after = None
+        self.stopping = threading.Event()
+        self._sequence = None
+        self._lock = threading.Lock()
+        self.handlers = {
+            "get_dropbox_status": lambda args: {"status": self._next_status()},
+            "get_ignore_set": lambda args: {"ignore_set": self.ignore_set},
+            "icon_overlay_file_status": lambda args: {
+                "status": [self.file_status.get(args["path"][0], "up to date")]
+            },
+            "ignore_set_add": lambda args: self._change_ignore_set(args["paths"], True),
+            "ignore_set_remove": lambda args: self._change_ignore_set(args["paths"], False),
+        }
+        self._server = None
+        self._thread = None
+
+    def replay(self, sequence, loop=True):
+        """
+        Answer successive status requests with the next entry of ``sequence``
+        (a list of status line lists, e.g. from load_recording), starting
+        over at the end if ``loop``, else staying on the last one.
+        """
+        with self._lock:
+            self._sequence = (list(sequence), loop, [0])
+
+    def _change_ignore_set(self, paths, ignored):
+        # Dropbox paths are case-insensitive
+        changed = {path.lower() for path in paths}
+        with self._lock:
+            self.ignore_set = [path for path in self.ignore_set if path.lower() not in changed]
+            if ignored:
+                self.ignore_set.extend(paths)
+        return {}
+
+    def _next_status(self):
+        with self._lock:
+            if self._sequence is None:
+                return self.status
+            sequence, loop, position = self._sequence
+            index = position[0]
+            if index >= len(sequence):
+                index = 0 if loop else len(sequence) - 1
+            position[0] = index + 1
+            self.status = sequence[index]
+            return self.status
+
+    def start(self):
+        self.stopping.clear()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self._server = _Server(self.path, _Handler)
+        self._server.fake = self
+        self._thread = threading.Thread(
+            target=self._server.serve_forever, kwargs={"poll_interval": 0.05}, daemon=True
+        )
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.stopping.set()
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+def load_recording(path):
+    """
+    Read recorded `dropbox status` outputs: blocks separated by blank lines,
+    ``#`` comments and ``= state`` annotations ignored (the format of
+    data/status_corpus.txt).
+    """
+    sequence = []
+    block = []
+    with open(path, encoding="utf-8") as f:
+        for line in f.read().splitlines() + [""]:
+            if line.startswith("#") or line.startswith("= "):
+                continue
+            if line:
+                block.append(line)
+            elif block:
+                sequence.append(block)
+                block = []
+    return sequence
+
+
+def install_cli(bin_dir, socket_path):
+    """Write a fake `dropbox` executable to ``bin_dir`` that asks ``socket_path``."""
+    os.makedirs(bin_dir, exist_ok=True)
+    cli = os.path.join(bin_dir, "dropbox")
+    with open(cli, "w") as f:
+        f.write('#!/bin/sh\nexec "%s" "%s" --socket "%s" "$@"\n' % (
+            sys.executable, os.path.abspath(__file__), socket_path
+        ))
+    os.chmod(cli, 0o755)
+    return cli
+
+
+def cli(argv=None):
+    """The subset of dropbox.py's commands that monitoring.py runs."""
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+    from monitoring import CommandError, CommandSocketClient
+
+    parser = argparse.ArgumentParser(prog="dropbox")
+    parser.add_argument("--socket", required=True)
+    parser.add_argument("command", nargs="+")
+    args = parser.parse_args(argv)
+
+    client = CommandSocketClient(args.socket, timeout=30)
+    command = args.command
+    try:
+        if command == ["status"]:
+            lines = client.send_command("get_dropbox_status").get("status", [])
+            print("\n".join(lines) if lines else "Idle")
+        elif command == ["exclude", "list"]:
+            paths = client.send_command("get_ignore_set").get("ignore_set", [])
+            print("Excluded: " if paths else "No directories are being ignored.")
+            # Like dropbox.py, relative to the current directory
+            for path in paths:
+                print(os.path.relpath(path))
+        elif command[:2] in (["exclude", "add"], ["exclude", "remove"]) and len(command) > 2:
+            client.send_command("ignore_set_" + command[1], {"paths": command[2:]})
+            print("Excluded: " if command[1] == "add" else "Included: ")
+            for path in command[2:]:
+                print(path)
+        elif command[0] == "filestatus" and len(command) >= 2:
+            width = max(len(path) for path in command[1:]) + 1
+            for path in command[1:]:
+                result = client.send_command("icon_overlay_file_status", {"path": path})
+                print("%-*s %s" % (width, path + ":", result.get("status", ["unknown"])[0]))
+        else:
+            print("Unknown command: %s" % " ".join(command), file=sys.stderr)
+            return 1
+    except (OSError, CommandError):
+        print("Dropbox isn't running!")
+    finally:
+        client.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(cli())
@@ -0,0 +1,155 @@
+import logging
+import os
+from unittest.mock import MagicMock
+
+import pytest
+from prometheus_client import REGISTRY
+
+from monitoring import (
+    CacheWatchdog,
+    DirectorySizes,
+    DropboxInterface,
+    DropboxMonitor,
+    State,
+    clear_analytics,
+)
+
+
+def write(path, size):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(b"x" * size)
+
+
+@pytest.fixture
+def home(tmp_path):
+    dot = tmp_path / ".dropbox"
+    write(dot / "events" / "queue.bin", 1000)
+    write(dot / "metrics" / "store.bin", 500)
+    write(dot / ".dropbox" / "ssa_events" / "a" / "b.bin", 200)
+    write(dot / "instance1" / "config.dbx", 300)
+    write(dot / "info.json", 10)
+    return tmp_path
+
+
+@pytest.fixture
+def monitor():
+    dropbox = MagicMock(spec=DropboxInterface)
+    dropbox.query_status.return_value = "Up to date\n"
+    return DropboxMonitor(dropbox=dropbox, min_poll_interval_sec=5,
+                          logger=logging.getLogger("test"), prom_port=9999)
+
+
+def watchdog_for(monitor, home, **kwargs):
+    kwargs.setdefault("on_limit", MagicMock())
+    return CacheWatchdog(monitor, logging.getLogger("test"), home=str(home), **kwargs)
+
+
+class TestDirectorySizes:
+    def test_totals_per_directory(self, home):
+        sizes = DirectorySizes(str(home / ".dropbox"))
+        totals = sizes.scan()
+        assert totals["events"] == 1000
+        assert totals[os.path.join(".dropbox", "ssa_events", "a")] == 200
+        assert totals["."] == 10
+
+    def test_only_changed_directories_are_relisted(self, home):
+        sizes = DirectorySizes(str(home / ".dropbox"))
+        sizes.scan()
+        assert sizes.scan()["events"] == 1000
+        assert sizes.listed == 0
+
+        write(home / ".dropbox" / "events" / "more.bin", 24)
+        assert sizes.scan()["events"] == 1024
+        assert sizes.listed == 1
+
+    def test_large_files_growing_in_place(self, home):
+        sizes = DirectorySizes(str(home / ".dropbox"), large_file_bytes=400, deep_every=0)
+        sizes.scan()
+        with open(home / ".dropbox" / "metrics" / "store.bin", "ab") as f:
+            f.write(b"x" * 100)
+        with open(home / ".dropbox" / "info.json", "ab") as f:
+            f.write(b"x" * 100)
+        totals = sizes.scan()
+        assert sizes.listed == 0
+        assert totals["metrics"] == 600
+        # Small files are only re-read by a deep scan
+        assert totals["."] == 10
+
+    def test_deep_scan_restats_everything(self, home):
+        sizes = DirectorySizes(str(home / ".dropbox"), large_file_bytes=400, deep_every=2)
+        sizes.scan()
+        with open(home / ".dropbox" / "info.json", "ab") as f:
+            f.write(b"x" * 100)
+        assert sizes.scan()["."] == 110
+
+    def test_removed_directories_are_forgotten(self, home):
+        sizes = DirectorySizes(str(home / ".dropbox"))
+        sizes.scan()
+        os.remove(home / ".dropbox" / ".dropbox" / "ssa_events" / "a" / "b.bin")
+        os.rmdir(home / ".dropbox" / ".dropbox" / "ssa_events" / "a")
+        assert os.path.join(".dropbox", "ssa_events", "a") not in sizes.scan()
+
+
+class TestCacheWatchdog:
+    def test_sizes_by_category(self, monitor, home):
+        watchdog = watchdog_for(monitor, home)
+        watchdog.check(now=0)
+        # .dropbox/.dropbox counts towards the same categories
+        assert watchdog.bytes == {
+            "events": 1000, "ssa_events": 200, "sentry_exceptions": 0,
+            "metrics": 500, "other": 310,
+        }
+        assert watchdog.analytics_bytes == 1700
+        assert REGISTRY.get_sample_value("dropbox_cache_bytes", {"dir": "events"}) == 1000
+
+    def test_growth_rate(self, monitor, home):
+        watchdog = watchdog_for(monitor, home, rate_window=100)
+        watchdog.check(now=0)
+        write(home / ".dropbox" / "events" / "more.bin", 500)
+        watchdog.check(now=50)
+        assert watchdog.rates["events"] == 10.0
+        assert REGISTRY.get_sample_value(
+            "dropbox_cache_growth_bytes_per_second", {"dir": "events"}
+        ) == 10.0
+        # Older samples fall out of the window
+        watchdog.check(now=150)
+        watchdog.check(now=200)
+        assert watchdog.rates["events"] == 0.0
+
+    def test_acts_once_up_to_date(self, monitor, home):
+        watchdog = watchdog_for(monitor, home, limit_bytes=1000)
+        monitor.state = State.SYNCING
+        monitor.snapshot = monitor._build_snapshot(0, 0)
+        watchdog.check(now=0)
+        watchdog.on_limit.assert_not_called()
+
+        monitor.refresh()
+        watchdog.check(now=10)
+        watchdog.on_limit.assert_called_once()
+        assert REGISTRY.get_sample_value("dropbox_cache_watchdog_actions_total") == 1
+
+        # Cooldown: no second action while the cache is still big
+        watchdog.check(now=20)
+        watchdog.on_limit.assert_called_once()
+
+    def test_acts_mid_sync_past_twice_the_limit(self, monitor, home):
+        watchdog = watchdog_for(monitor, home, limit_bytes=800)
+        monitor.state = State.SYNCING
+        monitor.snapshot = monitor._build_snapshot(0, 0)
+        watchdog.check(now=0)
+        watchdog.on_limit.assert_called_once()
+
+    def test_zero_limit_only_reports(self, monitor, home):
+        watchdog = watchdog_for(monitor, home, limit_bytes=0)
+        monitor.refresh()
+        watchdog.check(now=0)
+        watchdog.on_limit.assert_not_called()
+
+    def test_clear_analytics_as_cleanup(self, monitor, home):
+        watchdog = watchdog_for(monitor, home, limit_bytes=1000,
+                                on_limit=lambda: clear_analytics(str(home)))
+        monitor.refresh()
+        watchdog.check(now=0)
+        watchdog.check(now=700)
+        assert watchdog.analytics_bytes == 0
+        assert watchdog.bytes["other"] == 310
@@ -0,0 +1,227 @@
+import logging
+import shutil
+import socket
+import tempfile
+import time
+import os
+import subprocess
+from unittest.mock import patch
+
+import pytest
+
+from monitoring import (
+    CommandError,
+    CommandSocketClient,
+    DropboxInterface,
+    SocketDropboxInterface,
+)
+from .fake_dropbox import FakeCommandError, FakeCommandSocket, install_cli, load_recording
+
+SYNC_SESSION = os.path.join(os.path.dirname(__file__), "data", "sync_session.txt")
+
+
+@pytest.fixture
+def socket_path():
+    # Unix socket paths are limited to ~100 bytes, so avoid pytest's long tmp_path
+    directory = tempfile.mkdtemp(prefix="dbx")
+    yield os.path.join(directory, "command_socket")
+    shutil.rmtree(directory, ignore_errors=True)
+
+
+@pytest.fixture
+def fake_daemon(socket_path):
+    with FakeCommandSocket(socket_path) as fake:
+        yield fake
+
+
+@pytest.fixture
+def client(socket_path):
+    client = CommandSocketClient(socket_path, timeout=1.0)
+    yield client
+    client.close()
+
+
+@pytest.fixture
+def dropbox(client):
+    return SocketDropboxInterface(
+        logging.getLogger("test"), client, sync_root="/opt/dropbox/Dropbox"
+    )
+
+
+class TestCommandSocketClient:
+    def test_send_command(self, fake_daemon, client):
+        fake_daemon.status = ["Syncing 3 files", "Downloading 2 files"]
+        result = client.send_command("get_dropbox_status")
+        assert result == {"status": ["Syncing 3 files", "Downloading 2 files"]}
+
+    def test_sends_arguments(self, fake_daemon, client):
+        fake_daemon.handlers["echo"] = lambda args: args
+        result = client.send_command("echo", {"path": "/a", "paths": ["/b", "/c"]})
+        assert result == {"path": ["/a"], "paths": ["/b", "/c"]}
+        assert fake_daemon.requests[-1] == ("echo", {"path": ["/a"], "paths": ["/b", "/c"]})
+
+    def test_connection_is_reused(self, fake_daemon, client):
+        for _ in range(5):
+            client.send_command("get_dropbox_status")
+        assert fake_daemon.connections == 1
+
+    def test_notok_raises_command_error(self, fake_daemon, client):
+        def reject(args):
+            raise FakeCommandError("bad path")
+
+        fake_daemon.handlers["reject"] = reject
+        with pytest.raises(CommandError, match="bad path"):
+            client.send_command("reject")
+        # The connection is still usable afterwards
+        assert client.send_command("get_dropbox_status") == {"status": ["Up to date"]}
+
+    def test_reconnects_after_dropped_connection(self, fake_daemon, client):
+        client.send_command("get_dropbox_status")
+        fake_daemon.drop_next = True
+        assert client.send_command("get_dropbox_status") == {"status": ["Up to date"]}
+        assert fake_daemon.connections == 2
+
+    def test_times_out(self, fake_daemon, socket_path):
+        fake_daemon.delay = 0.5
+        client = CommandSocketClient(socket_path, timeout=0.1)
+        with pytest.raises(socket.timeout):
+            client.send_command("get_dropbox_status")
+        client.close()
+
+    def test_send_batch_is_pipelined(self, fake_daemon, client):
+        def status(args):
+            if args["path"][0] == "/bad":
+                raise FakeCommandError("bad path")
+            return {"status": [args["path"][0]]}
+
+        fake_daemon.handlers["icon_overlay_file_status"] = status
+        paths = ["/a", "/bad", "/c"] * 100
+        responses = client.send_batch(
+            "icon_overlay_file_status", [{"path": path} for path in paths]
+        )
+        assert [r and r["status"][0] for r in responses] == [
+            None if path == "/bad" else path for path in paths
+        ]
+        assert fake_daemon.connections == 1
+        assert client.send_command("get_dropbox_status") == {"status": ["Up to date"]}
+
+    def test_missing_socket(self, socket_path, client):
+        assert client.available() is False
+        with pytest.raises(OSError):
+            client.send_command("get_dropbox_status")
+
+
+class TestSocketDropboxInterface:
+    def test_query_status(self, fake_daemon, dropbox):
+        fake_daemon.status = ["Downloading 82 files (2,457 KB/sec, 2 secs)"]
+        assert dropbox.query_status() == "Downloading 82 files (2,457 KB/sec, 2 secs)\n"
+
+    def test_query_status_idle(self, fake_daemon, dropbox):
+        fake_daemon.status = []
+        assert dropbox.query_status() == "Idle\n"
+
+    def test_query_exclude_list(self, fake_daemon, dropbox):
+        fake_daemon.ignore_set = ["/opt/dropbox/Dropbox/Backups", "/opt/dropbox/Dropbox/a/b"]
+        assert dropbox.query_exclude_list() == ["Backups", "a/b"]
+
+    def test_query_file_status(self, fake_daemon, dropbox):
+        fake_daemon.file_status["/opt/dropbox/Dropbox/a.txt"] = "syncing"
+        assert dropbox.query_file_status("/opt/dropbox/Dropbox/a.txt") == "syncing"
+        assert dropbox.query_file_status("/opt/dropbox/Dropbox/b.txt") == "up to date"
+
+    def test_query_file_statuses(self, fake_daemon, dropbox):
+        fake_daemon.file_status["/opt/dropbox/Dropbox/b"] = "syncing"
+        paths = ["/opt/dropbox/Dropbox/%s" % name for name in ("a", "b")] * 150
+        assert dropbox.query_file_statuses(paths) == ["up to date", "syncing"] * 150
+        # Two pipelined batches over one connection
+        assert fake_daemon.connections == 1
+
+    def test_query_file_statuses_after_timeout(self, fake_daemon, socket_path):
+        fake_daemon.delay = 0.5
+        dropbox = SocketDropboxInterface(
+            logging.getLogger("test"), CommandSocketClient(socket_path, timeout=0.1)
+        )
+        with patch.object(DropboxInterface, "query_file_statuses") as cli:
+            assert dropbox.query_file_statuses(["/a", "/b"]) == [None, None]
+        assert cli.call_count == 0
+        dropbox.client.close()
+
+    def test_query_file_status_unsupported(self, fake_daemon, dropbox):
+        del fake_daemon.handlers["icon_overlay_file_status"]
+        assert dropbox.query_file_status("/opt/dropbox/Dropbox/a.txt") is None
+
+    def test_falls_back_to_cli_without_socket(self, dropbox):
+        with patch.object(DropboxInterface, "query_status", return_value="Up to date\n") as cli:
+            assert dropbox.query_status() == "Up to date\n"
+        assert cli.call_count == 1
+
+    def test_falls_back_to_cli_on_timeout(self, fake_daemon, socket_path):
+        fake_daemon.delay = 0.5
+        dropbox = SocketDropboxInterface(
+            logging.getLogger("test"), CommandSocketClient(socket_path, timeout=0.1)
+        )
+        with patch.object(DropboxInterface, "_load_exclude_list", return_value=[]) as cli:
+            assert dropbox.query_exclude_list() == []
+        assert cli.call_count == 1
+        dropbox.client.close()
+
+
+class TestFakeDaemon:
+    def test_replay(self, fake_daemon, dropbox):
+        sequence = load_recording(SYNC_SESSION)
+        assert sequence[0] == ["Starting..."]
+        assert sequence[-1] == ["Up to date"]
+        fake_daemon.replay(sequence[-2:], loop=False)
+        assert dropbox.query_status().startswith('Syncing "Q3 report')
+        assert dropbox.query_status() == "Up to date\n"
+        assert dropbox.query_status() == "Up to date\n"
+
+    def test_replay_loops(self, fake_daemon, client):
+        fake_daemon.replay([["Indexing..."], ["Up to date"]])
+        statuses = [client.send_command("get_dropbox_status")["status"] for _ in range(3)]
+        assert statuses == [["Indexing..."], ["Up to date"], ["Indexing..."]]
+
+    def test_hang(self, fake_daemon, socket_path):
+        fake_daemon.hang_next = True
+        client = CommandSocketClient(socket_path, timeout=0.2)
+        with pytest.raises(socket.timeout):
+            client.send_command("get_dropbox_status")
+        # Only that request hangs
+        assert client.send_command("get_dropbox_status") == {"status": ["Up to date"]}
+        client.close()
+
+    def test_crash_and_restart(self, fake_daemon, client):
+        fake_daemon.crash_after = 2
+        client.send_command("get_dropbox_status")
+        with pytest.raises(OSError):
+            client.send_command("get_dropbox_status")
+        deadline = time.monotonic() + 2
+        while client.available() and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert not client.available()
+
+        fake_daemon.start()
+        assert client.send_command("get_dropbox_status") == {"status": ["Up to date"]}
+
+    def test_cli(self, fake_daemon, socket_path, tmp_path, monkeypatch):
+        install_cli(str(tmp_path / "bin"), socket_path)
+        monkeypatch.setenv("PATH", str(tmp_path / "bin") + os.pathsep + os.environ["PATH"])
+        fake_daemon.status = ["Syncing 3 files", "Uploading 3 files"]
+        fake_daemon.ignore_set = ["/opt/dropbox/Dropbox/Backups"]
+        fake_daemon.file_status["/opt/dropbox/Dropbox/a.txt"] = "syncing"
+
+        dropbox = DropboxInterface(logging.getLogger("test"))
+        assert dropbox.query_status() == "Syncing 3 files\nUploading 3 files\n"
+        assert dropbox.query_exclude_list() == ["/opt/dropbox/Dropbox/Backups"]
+        # The CLI itself prints them relative to its working directory
+        listed = subprocess.run(
+            ["dropbox", "exclude", "list"], capture_output=True, text=True, cwd="/opt"
+        )
+        assert listed.stdout.splitlines()[1:] == ["dropbox/Dropbox/Backups"]
+        assert dropbox.query_file_status("/opt/dropbox/Dropbox/a.txt") == "syncing"
+        assert dropbox.query_file_statuses(
+            ["/opt/dropbox/Dropbox/b.txt", "/opt/dropbox/Dropbox/a.txt"]
+        ) == ["up to date", "syncing"]
+
+        fake_daemon.stop()
+        assert dropbox.query_status() == "Dropbox isn't running!\n"
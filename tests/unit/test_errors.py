@@ -0,0 +1,80 @@
+import pytest
+from prometheus_client import REGISTRY
+
+from monitoring import SyncErrorCollector, SyncErrorIndex, parse_sync_error
+
+
+def error(path, reason="access denied"):
+    return 'Can\'t sync "%s" (%s)' % (path, reason)
+
+
+class TestParseSyncError:
+    @pytest.mark.parametrize("line,expected", [
+        (error("a.txt"), ("a.txt", "access denied")),
+        (error("Q3 (final).pdf", "disk full"), ("Q3 (final).pdf", "disk full")),
+        ('Can\'t sync "a "quoted" name" (access denied)', ('a "quoted" name', "access denied")),
+        ("Can't sync anything", ("", "anything")),
+    ])
+    def test_parse(self, line, expected):
+        assert parse_sync_error(line) == expected
+
+
+class TestSyncErrorIndex:
+    def test_counts_and_timestamps(self):
+        index = SyncErrorIndex()
+        index.record(error("a.txt"), 100)
+        index.record(error("b.txt", "disk full"), 110)
+        index.record(error("a.txt"), 120)
+
+        page = index.query()
+        assert page["total"] == 2
+        assert page["errors"][0] == {
+            "path": "a.txt", "reason": "access denied",
+            "first_seen": 100, "last_seen": 120, "count": 2,
+        }
+        assert index.counts_by_reason == {"access denied": 2, "disk full": 1}
+
+    def test_same_path_different_reasons(self):
+        index = SyncErrorIndex()
+        index.record(error("a.txt"), 100)
+        index.record(error("a.txt", "disk full"), 100)
+        assert len(index) == 2
+
+    def test_evicts_least_recently_seen(self):
+        index = SyncErrorIndex(max_entries=3)
+        for i in range(5):
+            index.record(error("file-%d" % i), i)
+        index.record(error("file-2"), 10)
+        index.record(error("new"), 11)
+        paths = [e["path"] for e in index.query()["errors"]]
+        assert paths == ["new", "file-2", "file-4"]
+        assert index.evicted == 3
+
+    def test_error_storm_stays_bounded(self):
+        index = SyncErrorIndex(max_entries=100, max_reasons=4, max_path_length=16)
+        for i in range(10000):
+            index.record(error(str(i) + "x" * 100, "reason %d" % (i % 50)), i)
+        assert len(index) == 100
+        assert len(index.counts_by_reason) == 5
+        assert index.counts_by_reason["other"] == 10000 - 4 * 200
+        assert all(len(e["path"]) == 16 for e in index.query()["errors"])
+
+    def test_pagination_and_filter(self):
+        index = SyncErrorIndex()
+        for i in range(10):
+            index.record(error("file-%d" % i, "disk full" if i % 2 else "access denied"), i)
+        page = index.query(offset=2, limit=3)
+        assert [e["path"] for e in page["errors"]] == ["file-7", "file-6", "file-5"]
+        assert page["total"] == 10
+        page = index.query(reason="disk full")
+        assert page["total"] == 5
+
+    def test_exported(self):
+        index = SyncErrorIndex()
+        REGISTRY.register(SyncErrorCollector(index))
+        index.record(error("a.txt"), 1)
+        index.record(error("a.txt"), 2)
+        assert REGISTRY.get_sample_value(
+            "dropbox_sync_errors_total", {"reason": "access denied"}
+        ) == 2
+        assert REGISTRY.get_sample_value("dropbox_sync_errors_tracked") == 1
@@ -0,0 +1,294 @@
+import http.client
+import json
+import logging
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+from collections import OrderedDict
+from unittest.mock import MagicMock
+
+import pytest
+from prometheus_client import REGISTRY, CollectorRegistry
+
+from monitoring import (
+    CommandSocketClient,
+    DropboxInterface,
+    DropboxMonitor,
+    ExcludeJob,
+    ExcludeJobs,
+    MonitorGroup,
+    QuerySlots,
+    SocketDropboxInterface,
+    StatusTree,
+    start_status_server,
+)
+from .fake_dropbox import FakeCommandError, FakeCommandSocket, install_cli
+
+ROOT = "/opt/dropbox/Dropbox"
+
+
+@pytest.fixture
+def logger():
+    return logging.getLogger("test")
+
+
+@pytest.fixture
+def fake_daemon():
+    # Unix socket paths are limited to ~100 bytes, so avoid pytest's long tmp_path
+    directory = tempfile.mkdtemp(prefix="dbx")
+    with FakeCommandSocket(os.path.join(directory, "command_socket")) as fake:
+        yield fake
+    shutil.rmtree(directory, ignore_errors=True)
+
+
+@pytest.fixture
+def dropbox(fake_daemon, logger):
+    dropbox = SocketDropboxInterface(
+        logger, CommandSocketClient(fake_daemon.path, timeout=1.0), sync_root=ROOT
+    )
+    yield dropbox
+    dropbox.client.close()
+
+
+def requests(fake, name):
+    return [args for command, args in fake.requests if command == name]
+
+
+class TestExcludeInterface:
+    def test_socket_updates_cached_list(self, fake_daemon, dropbox):
+        fake_daemon.ignore_set = [ROOT + "/Backups"]
+        assert dropbox.query_exclude_list() == ["Backups"]
+        dropbox.exclude_add([ROOT + "/Photos", ROOT + "/Music"])
+        assert requests(fake_daemon, "ignore_set_add") == [
+            {"paths": [ROOT + "/Photos", ROOT + "/Music"]}
+        ]
+        dropbox.exclude_remove([ROOT + "/Backups"])
+        assert dropbox.query_exclude_list() == ["Photos", "Music"]
+        assert dropbox.cache.stats()["exclude_list"] == {"hits": 1, "misses": 1}
+
+    def test_socket_rejection(self, fake_daemon, dropbox):
+        def reject(args):
+            raise FakeCommandError("not a folder")
+
+        fake_daemon.handlers["ignore_set_add"] = reject
+        with pytest.raises(OSError, match="not a folder"):
+            dropbox.exclude_add([ROOT + "/a.txt"])
+
+    def test_cli_updates_cached_list(self, fake_daemon, tmp_path, monkeypatch, logger):
+        install_cli(str(tmp_path / "bin"), fake_daemon.path)
+        monkeypatch.setenv("PATH", str(tmp_path / "bin") + os.pathsep + os.environ["PATH"])
+        fake_daemon.ignore_set = [ROOT + "/Backups"]
+        dropbox = DropboxInterface(logger)
+        assert dropbox.query_exclude_list() == [ROOT + "/Backups"]
+
+        dropbox.exclude_add([ROOT + "/Photos"])
+        dropbox.exclude_remove([ROOT + "/backups"])
+        assert fake_daemon.ignore_set == [ROOT + "/Photos"]
+        # Paths are case-insensitive, and the CLI isn't asked for the list again
+        assert dropbox.query_exclude_list() == [ROOT + "/Photos"]
+        assert len(requests(fake_daemon, "get_ignore_set")) == 1
+
+        fake_daemon.stop()
+        with pytest.raises(OSError, match="isn't running"):
+            dropbox.exclude_add([ROOT + "/Music"])
+
+    def test_cli_list_is_relative_to_the_working_directory(self, tmp_path, monkeypatch, logger):
+        monkeypatch.chdir(tmp_path)
+        listed = subprocess.CompletedProcess([], 0, "Excluded: \nDropbox/Backups\n", "")
+        run = MagicMock(return_value=listed)
+        monkeypatch.setattr(subprocess, "run", run)
+        dropbox = DropboxInterface(logger)
+        assert dropbox.query_exclude_list() == [str(tmp_path / "Dropbox" / "Backups")]
+
+        run.return_value = subprocess.CompletedProcess([], 0, "", "")
+        dropbox.exclude_add([str(tmp_path / "Dropbox" / "Photos")])
+        dropbox.exclude_remove([str(tmp_path / "Dropbox" / "backups")])
+        assert dropbox.query_exclude_list() == [str(tmp_path / "Dropbox" / "Photos")]
+
+    def test_socket_falls_back_to_cli_list(self, fake_daemon, tmp_path, monkeypatch, logger):
+        monkeypatch.chdir(tmp_path)
+        listed = subprocess.CompletedProcess([], 0, "Excluded: \nDropbox/Backups\n", "")
+        monkeypatch.setattr(subprocess, "run", MagicMock(return_value=listed))
+        dropbox = SocketDropboxInterface(
+            logger, CommandSocketClient(str(tmp_path / "nope")), sync_root=str(tmp_path / "Dropbox")
+        )
+        # Same format as the socket's own ignore set
+        assert dropbox.query_exclude_list() == ["Backups"]
+
+
+@pytest.fixture
+def jobs(dropbox, logger):
+    jobs = ExcludeJobs(dropbox, ROOT, logger, CollectorRegistry(), batch_size=2)
+    yield jobs
+    jobs.stop()
+
+
+def wait_for(job, timeout=5):
+    deadline = time.monotonic() + timeout
+    while job.state in (ExcludeJob.QUEUED, ExcludeJob.RUNNING):
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+    return job
+
+
+class TestExcludeJobs:
+    def test_sends_batches(self, jobs, fake_daemon):
+        changed = []
+        jobs.on_change = lambda: changed.append(True)
+        jobs.start()
+        job = wait_for(jobs.submit("add", ["a", "b", "c", "d/e", "f"]))
+        assert job.as_dict()["state"] == "done"
+        assert job.done == 5
+        assert [len(args["paths"]) for args in requests(fake_daemon, "ignore_set_add")] == [2, 2, 1]
+        assert fake_daemon.ignore_set[-1] == ROOT + "/f"
+        assert changed == [True]
+
+        wait_for(jobs.submit("remove", ["a", "b"]))
+        assert fake_daemon.ignore_set == [ROOT + "/c", ROOT + "/d/e", ROOT + "/f"]
+
+    def test_failed_batch_does_not_stop_the_job(self, jobs, fake_daemon):
+        def add(args):
+            if ROOT + "/bad" in args["paths"]:
+                raise FakeCommandError("no such folder")
+            return {}
+
+        fake_daemon.handlers["ignore_set_add"] = add
+        jobs.start()
+        job = wait_for(jobs.submit("add", ["a", "bad", "c"]))
+        assert job.state == "failed"
+        assert (job.done, job.failed) == (1, 2)
+        assert job.errors == [{"paths": ["a", "bad"], "error": "Dropbox rejected exclude add: no such folder"}]
+
+    def test_queue_is_bounded(self, jobs):
+        jobs.max_queued = 2
+        assert jobs.submit("add", ["a"]) is not None
+        assert jobs.submit("add", ["b"]) is not None
+        assert jobs.submit("add", ["c"]) is None
+
+    def test_keeps_recent_jobs(self, jobs):
+        jobs.keep = 2
+        jobs.start()
+        ids = [wait_for(jobs.submit("add", [name])).id for name in "abc"]
+        assert list(jobs.jobs) == ids[1:]
+        assert jobs.get(ids[0]) is None
+
+
+def request(server, method, path, body=None, token="s3cret", headers=None):
+    conn = http.client.HTTPConnection("127.0.0.1", server.server_address[1], timeout=5)
+    headers = dict(headers or {})
+    if token:
+        headers["Authorization"] = "Bearer " + token
+    conn.request(method, path, body=json.dumps(body) if body is not None else None, headers=headers)
+    response = conn.getresponse()
+    data = response.read()
+    conn.close()
+    return response.status, json.loads(data) if data else None, response
+
+
+def make_monitor(dropbox, logger, **kwargs):
+    monitor = DropboxMonitor(
+        dropbox=dropbox, min_poll_interval_sec=5, logger=logger, prom_port=9999,
+        status_tree=StatusTree(dropbox, ROOT, logger), **kwargs
+    )
+    monitor.exclude_jobs.start()
+    return monitor
+
+
+@pytest.fixture
+def server(dropbox, logger):
+    monitor = make_monitor(dropbox, logger)
+    server = start_status_server(monitor, 0, logger, host="127.0.0.1", admin_token="s3cret")
+    yield server
+    server.shutdown()
+    server.server_close()
+    monitor.stop()
+
+
+def poll(server, url):
+    deadline = time.monotonic() + 5
+    while True:
+        status, job, _ = request(server, "GET", url)
+        assert status == 200
+        if job["state"] not in ("queued", "running"):
+            return job
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+class TestExcludeEndpoint:
+    def test_add_and_remove(self, server, fake_daemon):
+        status, job, response = request(server, "POST", "/exclude", {"paths": ["Photos/2019", "/Music/"]})
+        assert status == 202
+        assert response.getheader("Location") == job["url"] == "/exclude/jobs/1"
+        assert poll(server, job["url"])["done"] == 2
+        assert fake_daemon.ignore_set == [ROOT + "/Photos/2019", ROOT + "/Music"]
+        assert server.monitor.dropbox.query_exclude_list() == ["Photos/2019", "Music"]
+
+        status, job, _ = request(server, "DELETE", "/exclude", {"paths": ["Music"]})
+        assert status == 202
+        assert poll(server, job["url"])["state"] == "done"
+        assert fake_daemon.ignore_set == [ROOT + "/Photos/2019"]
+        assert REGISTRY.get_sample_value(
+            "dropbox_exclude_paths_total", {"action": "add", "result": "ok"}
+        ) == 2
+
+    def test_admin_token_required(self, server):
+        assert request(server, "POST", "/exclude", {"paths": ["a"]}, token=None)[0] == 401
+        assert request(server, "GET", "/exclude/jobs/1", token="wrong")[0] == 401
+
+    @pytest.mark.parametrize("body", [
+        {}, {"paths": []}, {"paths": "a"}, {"paths": [1]}, {"paths": ["../etc"]}, {"paths": ["/"]},
+    ])
+    def test_bad_request(self, server, body):
+        assert request(server, "POST", "/exclude", body)[0] == 400
+
+    def test_body_required(self, server):
+        conn = http.client.HTTPConnection("127.0.0.1", server.server_address[1], timeout=5)
+        conn.putrequest("POST", "/exclude")
+        conn.putheader("Authorization", "Bearer s3cret")
+        conn.endheaders()
+        assert conn.getresponse().status == 411
+        conn.close()
+
+    def test_unknown_job(self, server):
+        assert request(server, "GET", "/exclude/jobs/42")[0] == 404
+
+    def test_disabled_without_token(self, dropbox, logger):
+        monitor = make_monitor(dropbox, logger)
+        server = start_status_server(monitor, 0, logger, host="127.0.0.1")
+        try:
+            assert request(server, "POST", "/exclude", {"paths": ["a"]})[0] == 404
+        finally:
+            server.shutdown()
+            server.server_close()
+            monitor.stop()
+
+
+class TestGroupExcludeEndpoint:
+    def test_per_instance(self, dropbox, fake_daemon, logger):
+        other = MagicMock(spec=DropboxInterface)
+        slots = QuerySlots()
+        monitors = OrderedDict([
+            ("home", make_monitor(other, logger, instance="home", registry=CollectorRegistry())),
+            ("work", make_monitor(dropbox, logger, instance="work", registry=CollectorRegistry())),
+        ])
+        server = start_status_server(
+            None, 0, logger, host="127.0.0.1", admin_token="s3cret",
+            group=MonitorGroup(monitors, slots),
+        )
+        try:
+            status, job, _ = request(server, "POST", "/exclude/work", {"paths": ["Photos"]})
+            assert status == 202
+            assert job["url"] == "/exclude/work/jobs/1"
+            assert poll(server, job["url"])["state"] == "done"
+            assert fake_daemon.ignore_set == [ROOT + "/Photos"]
+            assert other.exclude_add.call_count == 0
+            assert request(server, "POST", "/exclude", {"paths": ["Photos"]})[0] == 404
+            assert request(server, "GET", "/exclude/home/jobs/1")[0] == 404
+        finally:
+            server.shutdown()
+            server.server_close()
+            for monitor in monitors.values():
+                monitor.stop()
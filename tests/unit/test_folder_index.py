@@ -0,0 +1,144 @@
+import logging
+import os
+
+import pytest
+from prometheus_client import REGISTRY
+
+from monitoring import FolderIndex, FolderIndexCollector, FolderIndexer, FolderTotals
+
+
+@pytest.fixture
+def tree(tmp_path):
+    root = tmp_path / "Dropbox"
+    (root / "Photos" / "2024").mkdir(parents=True)
+    (root / "Work" / "Archive").mkdir(parents=True)
+    (root / "top.txt").write_bytes(b"x" * 10)
+    (root / "Photos" / "a.jpg").write_bytes(b"x" * 100)
+    (root / "Photos" / "2024" / "b.jpg").write_bytes(b"x" * 200)
+    (root / "Work" / "doc.txt").write_bytes(b"x" * 1000)
+    (root / "Work" / "Archive" / "old.zip").write_bytes(b"x" * 5000)
+    return root
+
+
+@pytest.fixture
+def index(tree, tmp_path):
+    index = FolderIndex(str(tmp_path / "state" / "folders.sqlite"), root=str(tree))
+    index.open()
+    yield index
+    index.close()
+
+
+def touch_dir(path):
+    """Bump a directory's mtime even on filesystems with coarse timestamps."""
+    st = os.stat(path)
+    os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 10 ** 9))
+
+
+class TestFolderIndex:
+    def test_totals(self, index):
+        assert index.scan() == 5
+        assert index.folders == {
+            "/": FolderTotals(1, 10),
+            "Photos": FolderTotals(2, 300),
+            "Work": FolderTotals(2, 6000),
+        }
+        assert index.selective_sync["included"] == FolderTotals(5, 6310)
+        assert index.directories == 5
+
+    def test_only_changed_directories_are_rescanned(self, index, tree):
+        index.scan()
+        assert index.scan() == 0
+
+        (tree / "Photos" / "2024" / "c.jpg").write_bytes(b"x" * 50)
+        touch_dir(tree / "Photos" / "2024")
+        assert index.scan() == 1
+        assert index.folders["Photos"] == FolderTotals(3, 350)
+
+    def test_deep_scan_relists_everything(self, index):
+        index.scan()
+        assert index.scan(deep=True) == 5
+
+    def test_removed_directories_are_dropped(self, index, tree):
+        index.scan()
+        for name in os.listdir(tree / "Work" / "Archive"):
+            os.remove(tree / "Work" / "Archive" / name)
+        os.rmdir(tree / "Work" / "Archive")
+        touch_dir(tree / "Work")
+        index.scan()
+        assert index.folders["Work"] == FolderTotals(1, 1000)
+        assert index.directories == 4
+
+    def test_new_directories_are_indexed(self, index, tree):
+        index.scan()
+        (tree / "Music" / "Live").mkdir(parents=True)
+        (tree / "Music" / "Live" / "song.mp3").write_bytes(b"x" * 42)
+        touch_dir(tree)
+        assert index.scan() == 3
+        assert index.folders["Music"] == FolderTotals(1, 42)
+
+    def test_excluded_folders(self, tree, tmp_path):
+        index = FolderIndex(
+            str(tmp_path / "folders.sqlite"),
+            root=str(tree),
+            exclude_list=lambda: ["work/archive", str(tree / "Photos" / "2024")],
+        )
+        index.open()
+        index.scan()
+        assert index.selective_sync == {
+            "included": FolderTotals(3, 1110),
+            "excluded": FolderTotals(2, 5200),
+        }
+        index.close()
+
+    def test_aggregates_survive_restart(self, index, tree, tmp_path):
+        index.scan()
+        index.close()
+        reopened = FolderIndex(index.db_path, root=str(tree))
+        reopened.open()
+        # Served from the database before any scan has run
+        assert reopened.folders["Work"] == FolderTotals(2, 6000)
+        assert reopened.scan() == 0
+        reopened.close()
+
+    def test_folder_labels_are_capped(self, tree, tmp_path):
+        index = FolderIndex(str(tmp_path / "folders.sqlite"), root=str(tree), max_folders=2)
+        index.open()
+        index.scan()
+        assert index.folders == {
+            "Work": FolderTotals(2, 6000),
+            "Photos": FolderTotals(2, 300),
+            "other": FolderTotals(1, 10),
+        }
+        index.close()
+
+    def test_exported(self, index):
+        REGISTRY.register(FolderIndexCollector(index))
+        index.scan()
+        assert REGISTRY.get_sample_value("dropbox_folder_bytes", {"folder": "Work"}) == 6000
+        assert REGISTRY.get_sample_value(
+            "dropbox_sync_folder_files", {"selective_sync": "included"}
+        ) == 5
+        assert REGISTRY.get_sample_value("dropbox_folder_index_last_scan_timestamp_seconds") > 0
+
+
+class TestFolderIndexer:
+    def test_scans_in_background(self, tree, tmp_path):
+        index = FolderIndex(str(tmp_path / "folders.sqlite"), root=str(tree))
+        indexer = FolderIndexer(index, logging.getLogger("test"), scan_interval=60)
+        indexer.start()
+        try:
+            deadline = 50
+            while indexer.scans == 0 and deadline:
+                indexer._stop.wait(0.1)
+                deadline -= 1
+            assert index.folders["Work"] == FolderTotals(2, 6000)
+        finally:
+            indexer.stop()
+
+    def test_deep_scan_schedule(self, index):
+        indexer = FolderIndexer(index, logging.getLogger("test"), deep_scan_every=2)
+        relisted = []
+        for _ in range(4):
+            indexer.scan()
+            relisted.append(index.last_rescanned)
+        assert relisted == [5, 0, 5, 0]
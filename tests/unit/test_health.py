@@ -0,0 +1,196 @@
+import http.client
+import json
+import logging
+import os
+import socket
+import subprocess
+
+import pytest
+
+from monitoring import (
+    DaemonProcessStats,
+    HealthCheck,
+    State,
+    StatusSnapshot,
+    start_status_server,
+)
+
+ENTRYPOINT = os.path.join(os.path.dirname(__file__), "..", "..", "docker-entrypoint.sh")
+DAEMON = DaemonProcessStats(
+    pid=42, num_processes=1, rss_bytes=0, peak_rss_bytes=0, cpu_seconds=0.0, open_fds=0,
+    threads=1, read_bytes=0, write_bytes=0, inotify_watches=None, inotify_max_user_watches=None,
+)
+
+
+def snapshot(taken_at, state=State.UP_TO_DATE, daemon=DAEMON):
+    return StatusSnapshot(
+        state=state,
+        raw_status="",
+        num_syncing=0,
+        num_downloading=None,
+        num_uploading=0,
+        last_error=None,
+        last_sync_time=None,
+        taken_at=taken_at,
+        refresh_duration=0.0,
+        daemon=daemon,
+    )
+
+
+def checked(health, snapshots, synced_at=0.0, now=None):
+    for s in snapshots:
+        health.observe(s)
+    return health.check(snapshots[-1], synced_at, now=snapshots[-1].taken_at if now is None else now)
+
+
+class TestHealthCheck:
+    def test_up_to_date(self):
+        result = checked(HealthCheck(), [snapshot(1000.0)])
+        assert result["healthy"] and result["ready"]
+        assert result["failing"] == []
+        assert result["daemon_pid"] == 42
+        assert result["since_up_to_date_seconds"] == 0
+
+    def test_stale_snapshot(self):
+        result = checked(HealthCheck(stale_after=300), [snapshot(1000.0)], now=1301.0)
+        assert not result["healthy"] and not result["ready"]
+        assert result["failing"] == ["snapshot_stale"]
+        assert result["snapshot_age_seconds"] == 301
+
+    def test_daemon_down_after_grace_period(self):
+        health = HealthCheck(down_after=120)
+        down = [snapshot(t, State.NOT_RUNNING, daemon=None) for t in (1000.0, 1060.0)]
+        assert checked(health, down)["healthy"]
+        result = checked(health, [snapshot(1121.0, State.NOT_RUNNING, daemon=None)])
+        assert result["failing"] == ["daemon_down"]
+        assert result["down_seconds"] == 121
+        # Coming back resets the clock
+        assert checked(health, [snapshot(1130.0)])["down_seconds"] is None
+
+    def test_daemon_without_pid_is_up(self):
+        health = HealthCheck(down_after=120)
+        result = checked(health, [snapshot(t, daemon=None) for t in (1000.0, 1200.0)])
+        assert result["healthy"] and result["down_seconds"] is None
+        # No answer and no process
+        result = checked(health, [snapshot(t, State.UNKNOWN, daemon=None) for t in (1300.0, 1500.0)])
+        assert result["failing"] == ["daemon_down"]
+        # No answer, but the process is still there
+        health = HealthCheck(down_after=120)
+        assert checked(health, [snapshot(t, State.UNKNOWN) for t in (1000.0, 1200.0)])["healthy"]
+
+    def test_sync_errors_only_affect_readiness(self):
+        health = HealthCheck(error_after=900)
+        result = checked(health, [snapshot(t, State.SYNC_ERROR) for t in (1000.0, 1901.0)])
+        assert result["healthy"] and not result["ready"]
+        assert result["failing"] == ["sync_error"]
+
+    def test_not_up_to_date(self):
+        health = HealthCheck(unsynced_after=3600)
+        result = checked(health, [snapshot(5000.0, State.SYNCING)], synced_at=1000.0)
+        assert result["healthy"] and not result["ready"]
+        assert result["failing"] == ["not_up_to_date"]
+        assert result["since_up_to_date_seconds"] == 4000
+        # 0 turns the check off
+        health.unsynced_after = 0
+        assert checked(health, [snapshot(5000.0, State.SYNCING)], synced_at=1000.0)["ready"]
+
+
+def get(port, path):
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=5)
+    conn.request("GET", path)
+    response = conn.getresponse()
+    body = response.read()
+    conn.close()
+    return response.status, json.loads(body), response
+
+
+def serve(monitor, port=0):
+    return start_status_server(monitor, port, logging.getLogger("test"), host="127.0.0.1")
+
+
+class TestHealthEndpoint:
+    def test_healthy(self, make_monitor):
+        monitor = make_monitor("Up to date\n")
+        monitor.refresh()
+        server = serve(monitor)
+        try:
+            status, body, response = get(server.server_address[1], "/health")
+            assert status == 200
+            assert body["state"] == "up to date"
+            assert response.getheader("Cache-Control") == "no-store"
+            assert get(server.server_address[1], "/health/ready")[0] == 200
+            # Answered from the snapshot; Dropbox isn't asked again
+            assert monitor.dropbox.query_status.call_count == 1
+        finally:
+            server.shutdown()
+            server.server_close()
+            monitor.stop()
+
+    def test_not_ready(self, make_monitor):
+        monitor = make_monitor("Syncing 3 files\n", health=HealthCheck(unsynced_after=1))
+        monitor.refresh()
+        monitor.start_time -= 10
+        server = serve(monitor)
+        try:
+            assert get(server.server_address[1], "/health")[0] == 200
+            status, body, _ = get(server.server_address[1], "/health/ready")
+            assert status == 503
+            assert body["failing"] == ["not_up_to_date"]
+        finally:
+            server.shutdown()
+            server.server_close()
+            monitor.stop()
+
+    def test_daemon_down(self, make_monitor):
+        monitor = make_monitor("Dropbox isn't running!\n", health=HealthCheck(down_after=0))
+        monitor.refresh()
+        server = serve(monitor)
+        try:
+            status, body, _ = get(server.server_address[1], "/health")
+            assert status == 503
+            assert "daemon_down" in body["failing"]
+        finally:
+            server.shutdown()
+            server.server_close()
+            monitor.stop()
+
+
+def probe():
+    return subprocess.run(
+        ["bash", ENTRYPOINT, "healthcheck"], capture_output=True, text=True, timeout=10,
+        env=dict(os.environ, ENABLE_MONITORING="True"),
+    )
+
+
+@pytest.fixture
+def health_port():
+    # The probe always asks the status port the container uses
+    with socket.socket() as s:
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        try:
+            s.bind(("127.0.0.1", 8001))
+        except OSError:
+            pytest.skip("port 8001 is in use")
+
+
+class TestEntrypointProbe:
+    def test_reports_the_monitor_health(self, health_port, make_monitor):
+        monitor = make_monitor("Up to date\n")
+        monitor.refresh()
+        server = serve(monitor, 8001)
+        try:
+            result = probe()
+            assert result.returncode == 0, result.stderr
+            assert json.loads(result.stdout)["healthy"] is True
+
+            monitor.health.stale_after = -1
+            result = probe()
+            assert result.returncode == 1
+            assert json.loads(result.stdout)["failing"] == ["snapshot_stale"]
+        finally:
+            server.shutdown()
+            server.server_close()
+            monitor.stop()
+
+    def test_monitor_not_listening(self, health_port):
+        assert probe().returncode == 1
@@ -0,0 +1,139 @@
+import logging
+import math
+from unittest.mock import MagicMock
+
+import pytest
+
+from monitoring import (
+    DaemonProcessStats,
+    DropboxInterface,
+    DropboxMonitor,
+    HistoryRing,
+    State,
+    StatusHistory,
+    StatusSnapshot,
+)
+
+
+def snapshot(taken_at, state=State.UP_TO_DATE, syncing=0, download_rate=None, rss=None):
+    daemon = None
+    if rss is not None:
+        daemon = DaemonProcessStats(
+            pid=1, num_processes=1, rss_bytes=rss, peak_rss_bytes=rss, cpu_seconds=0.0,
+            open_fds=0, threads=1, read_bytes=0, write_bytes=0, inotify_watches=None,
+            inotify_max_user_watches=None,
+        )
+    return StatusSnapshot(
+        state=state,
+        raw_status="",
+        num_syncing=syncing,
+        num_downloading=None,
+        num_uploading=0,
+        last_error=None,
+        last_sync_time=None,
+        taken_at=taken_at,
+        refresh_duration=0.0,
+        download_rate=download_rate,
+        daemon=daemon,
+    )
+
+
+class TestHistoryRing:
+    def test_wraps_around(self):
+        ring = HistoryRing(0, 3)
+        for t in range(5):
+            ring.append((float(t), 0, 0, 0, 0, 0.0, 0.0, 0.0, 0))
+        assert [row[0] for row in ring.rows()] == [2.0, 3.0, 4.0]
+        assert ring.oldest() == 2.0
+        assert ring.covers(2.0) and not ring.covers(1.0)
+
+    def test_memory_is_preallocated(self):
+        ring = HistoryRing(0, 100)
+        before = ring.memory_bytes()
+        for t in range(250):
+            ring.append((float(t), 0, 0, 0, 0, 0.0, 0.0, 0.0, 0))
+        assert ring.memory_bytes() == before
+        # time (8) + state (1) + 3 counts (4) + 3 rates (4) + rss (8)
+        assert before == 100 * (8 + 1 + 3 * 4 + 3 * 4 + 8)
+
+
+class TestStatusHistory:
+    def test_query_raw_samples(self):
+        history = StatusHistory()
+        history.record(snapshot(1000, State.SYNCING, syncing=5, download_rate=2048.0, rss=1 << 20))
+        history.record(snapshot(1005))
+
+        result = history.query()
+        assert result["step"] == 0
+        points = result["points"]
+        assert points["time"] == [1000, 1005]
+        assert points["state"] == ["syncing", "up to date"]
+        assert points["syncing"] == [5, 0]
+        assert points["downloading"] == [None, None]
+        assert points["download_rate"] == [2048.0, None]
+        assert points["rss_bytes"] == [1 << 20, None]
+
+    def test_since(self):
+        history = StatusHistory()
+        for t in range(0, 100, 10):
+            history.record(snapshot(1000 + t))
+        assert history.query(since=1050)["points"]["time"] == [1050, 1060, 1070, 1080, 1090]
+
+    def test_downsampled_levels(self):
+        history = StatusHistory(levels=((0, 10), (60, 100)))
+        for t in range(0, 300, 5):
+            history.record(snapshot(6000 + t, syncing=t))
+
+        # The raw ring only holds the last 10 samples, so older data comes
+        # from the one-minute ring: peak count per minute
+        result = history.query(since=6000)
+        assert result["step"] == 60
+        assert result["points"]["time"] == [6000, 6060, 6120, 6180, 6240]
+        assert result["points"]["syncing"] == [55, 115, 175, 235, 295]
+
+        assert history.query(since=6250)["step"] == 0
+
+    def test_rates_are_averaged_and_state_is_last(self):
+        history = StatusHistory(levels=((0, 1), (60, 10)))
+        history.record(snapshot(600, State.SYNCING, download_rate=100.0))
+        history.record(snapshot(610, State.SYNCING, download_rate=300.0))
+        history.record(snapshot(620, State.UP_TO_DATE))
+        history.record(snapshot(660))
+        points = history.query(since=600)["points"]
+        assert points["download_rate"][0] == 200.0
+        assert points["state"][0] == "up to date"
+
+    def test_step_reaggregates(self):
+        history = StatusHistory()
+        for t in range(0, 120, 10):
+            history.record(snapshot(1200 + t, syncing=t))
+        result = history.query(step=30)
+        assert result["step"] == 30
+        assert result["points"]["time"] == [1200, 1230, 1260, 1290]
+        assert result["points"]["syncing"] == [20, 50, 80, 110]
+
+    def test_memory_bytes(self):
+        history = StatusHistory()
+        assert 0 < history.memory_bytes() < 200 * 1024
+        assert [level["step"] for level in history.stats()] == [0, 60, 900]
+
+    def test_nan_rates_survive_downsampling(self):
+        history = StatusHistory(levels=((0, 1), (60, 10)))
+        history.record(snapshot(60))
+        history.record(snapshot(120))
+        row = next(history.rings[1].rows())
+        assert math.isnan(row[6])
+        assert history.query(since=60)["points"]["download_rate"][0] is None
+
+
+class TestMonitorHistory:
+    @pytest.mark.parametrize("since", [0, -3600])
+    def test_refresh_records_history(self, since):
+        dropbox = MagicMock(spec=DropboxInterface)
+        dropbox.query_status.return_value = "Syncing 3 files\n"
+        monitor = DropboxMonitor(dropbox=dropbox, min_poll_interval_sec=5,
+                                 logger=logging.getLogger("test"), prom_port=9999)
+        monitor.refresh()
+        history = monitor.get_history(since)
+        assert history["points"]["syncing"] == [3]
+        assert history["memory_bytes"] == monitor.history.memory_bytes()
@@ -0,0 +1,213 @@
+import http.client
+import json
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+import pytest
+from prometheus_client import REGISTRY, CollectorRegistry
+
+from monitoring import (
+    CommandSocketClient,
+    DropboxInterface,
+    DropboxMonitor,
+    MonitorGroup,
+    PollScheduler,
+    QuerySlots,
+    SocketDropboxInterface,
+    start_status_server,
+)
+from .fake_dropbox import FakeCommandSocket
+
+MONITORING = os.path.join(os.path.dirname(__file__), "..", "..", "monitoring.py")
+
+
+@pytest.fixture
+def logger():
+    return logging.getLogger("test")
+
+
+class TestInstanceHome:
+    def test_reads_info_json_from_its_home(self, tmp_path, logger):
+        (tmp_path / ".dropbox").mkdir()
+        (tmp_path / ".dropbox" / "info.json").write_text('{"personal": {}}')
+        assert DropboxInterface(logger, home=str(tmp_path)).query_account_info() == {
+            "personal": {}
+        }
+
+    def test_reads_version_from_its_home(self, tmp_path, logger):
+        for name, version in (("home", "242.4.5815"), ("work", "250.1.1")):
+            (tmp_path / name / "bin").mkdir(parents=True)
+            (tmp_path / name / "bin" / "VERSION").write_text(version + "\n")
+        assert DropboxInterface(logger, home=str(tmp_path / "home")).query_version() == "242.4.5815"
+        assert DropboxInterface(logger, home=str(tmp_path / "work")).query_version() == "250.1.1"
+
+    @pytest.mark.parametrize("name", ["history", "errors", "tree", "stream"])
+    def test_status_subpaths_are_not_instance_names(self, tmp_path, name):
+        result = subprocess.run(
+            [sys.executable, MONITORING, "--instance", "%s=%s" % (name, tmp_path)],
+            capture_output=True, text=True, timeout=30,
+        )
+        assert result.returncode == 2
+        assert "reserved for /status/%s" % name in result.stderr
+
+
+class TestQuerySlots:
+    def test_bounds_concurrent_queries(self):
+        slots = QuerySlots(workers=1, stuck_after=10)
+        token = slots.acquire()
+        acquired = threading.Event()
+
+        def contender():
+            second = slots.acquire()
+            acquired.set()
+            slots.release(second)
+
+        thread = threading.Thread(target=contender)
+        thread.start()
+        assert not acquired.wait(0.1)
+        slots.release(token)
+        assert acquired.wait(1)
+        thread.join()
+
+    def test_stuck_query_frees_its_slot(self):
+        slots = QuerySlots(workers=1, stuck_after=0.1)
+        slots.acquire()
+        started = time.monotonic()
+        slots.release(slots.acquire())
+        assert 0.05 < time.monotonic() - started < 1
+        assert slots.stuck() == 1
+
+
+@pytest.fixture
+def group(logger, make_monitor):
+    slots = QuerySlots()
+    monitors = OrderedDict(
+        (name, make_monitor(
+            status, logger=logger, instance=name, registry=CollectorRegistry(), query_slots=slots
+        ))
+        for name, status in (("home", "Up to date\n"), ("work", "Syncing 3 files\n"))
+    )
+    group = MonitorGroup(monitors, slots)
+    group.start()
+    for monitor in monitors.values():
+        monitor.refresh()
+    yield group
+    group.stop()
+
+
+class TestMonitorGroup:
+    def test_every_metric_has_an_instance_label(self, group):
+        assert REGISTRY.get_sample_value("dropbox_num_syncing", {"instance": "work"}) == 3
+        assert REGISTRY.get_sample_value("dropbox_num_syncing", {"instance": "home"}) == 0
+        assert REGISTRY.get_sample_value(
+            "dropbox_status", {"instance": "home", "dropbox_status": "up to date"}
+        ) == 1
+        for metric in REGISTRY.collect():
+            if metric.name.startswith("dropbox_") and metric.name != "dropbox_monitor_stuck_queries":
+                assert all("instance" in sample.labels for sample in metric.samples), metric.name
+
+    def test_aggregate_status(self, group):
+        status = group.get_aggregate_status()
+        assert list(status["instances"]) == ["home", "work"]
+        assert status["instances"]["work"]["state"] == "syncing"
+        assert status["summary"] == {
+            "instances": 2,
+            "states": {"up to date": 1, "syncing": 1},
+            "syncing": 3,
+            "downloading": 0,
+            "uploading": 0,
+        }
+
+
+def get(server, path):
+    conn = http.client.HTTPConnection("127.0.0.1", server.server_address[1], timeout=5)
+    conn.request("GET", path)
+    response = conn.getresponse()
+    body = response.read()
+    conn.close()
+    return response.status, body
+
+
+@pytest.fixture
+def group_server(group, logger):
+    server = start_status_server(None, 0, logger, host="127.0.0.1", group=group)
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+class TestGroupStatusServer:
+    def test_aggregate(self, group_server):
+        status, body = get(group_server, "/status")
+        assert status == 200
+        assert json.loads(body)["summary"]["instances"] == 2
+
+    def test_per_instance(self, group_server):
+        status, body = get(group_server, "/status/work")
+        assert status == 200
+        assert json.loads(body)["status"] == "syncing"
+        status, body = get(group_server, "/status/home/history?since=-60")
+        assert status == 200
+        # The sampler may have recorded a sample of its own next to the fixture's
+        assert set(json.loads(body)["points"]["state"]) == {"up to date"}
+
+    def test_unknown_instance(self, group_server):
+        assert get(group_server, "/status/nope")[0] == 404
+        # Single-instance paths don't exist without an instance
+        assert get(group_server, "/status/history")[0] == 404
+
+    def test_health(self, group_server):
+        assert get(group_server, "/health")[0] == 200
+
+
+@pytest.fixture
+def daemons():
+    # Unix socket paths are limited to ~100 bytes, so avoid pytest's long tmp_path
+    directory = tempfile.mkdtemp(prefix="dbx")
+    fakes = OrderedDict()
+    for name in ("stuck", "fine"):
+        fakes[name] = FakeCommandSocket(os.path.join(directory, name))
+        fakes[name].start()
+    yield fakes
+    for fake in fakes.values():
+        fake.stop()
+    shutil.rmtree(directory, ignore_errors=True)
+
+
+class TestStuckInstance:
+    def test_does_not_delay_the_others(self, daemons, logger):
+        slots = QuerySlots(workers=1, stuck_after=0.2)
+        monitors = OrderedDict()
+        for name, fake in daemons.items():
+            client = CommandSocketClient(fake.path, timeout=30)
+            monitors[name] = DropboxMonitor(
+                dropbox=SocketDropboxInterface(logger, client), min_poll_interval_sec=0,
+                logger=logger, prom_port=9999, instance=name, registry=CollectorRegistry(),
+                query_slots=slots,
+            )
+            monitors[name].scheduler = PollScheduler(0.05)
+        group = MonitorGroup(monitors, slots)
+        daemons["stuck"].hang_next = True
+        daemons["fine"].status = ["Syncing 2 files"]
+        group.start()
+        try:
+            time.sleep(1)
+            daemons["fine"].status = ["Up to date"]
+            deadline = time.monotonic() + 2
+            while monitors["fine"].snapshot.raw_status != "Up to date":
+                assert time.monotonic() < deadline
+                time.sleep(0.02)
+            assert slots.stuck() == 1
+            assert REGISTRY.get_sample_value("dropbox_monitor_stuck_queries") == 1
+            assert monitors["stuck"].snapshot.raw_status == ""
+        finally:
+            # Unblock the hung request so the sampler can exit
+            daemons["stuck"].stop()
+            group.stop()
@@ -0,0 +1,154 @@
+import os
+
+import pytest
+from prometheus_client import REGISTRY
+
+from monitoring import State, StateJournal
+
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / "state" / "monitor.journal")
+
+
+def replayed(path, **kwargs):
+    journal = StateJournal(path, **kwargs)
+    records = journal.replay()
+    journal.close()
+    return records
+
+
+class TestStateJournal:
+    def test_round_trip(self, path):
+        journal = StateJournal(path)
+        assert journal.replay() == []
+        journal.append(StateJournal.STATE, 100.0, b"\x02")
+        journal.append(StateJournal.SYNC, 101.5)
+        journal.append(StateJournal.ERROR, 102.0, "Can't sync \"é\"".encode())
+        journal.close()
+
+        records = replayed(path)
+        assert [(r.kind, r.timestamp) for r in records] == [(2, 100.0), (3, 101.5), (4, 102.0)]
+        assert records[2].payload.decode() == "Can't sync \"é\""
+
+    def test_torn_tail_is_truncated(self, path):
+        journal = StateJournal(path)
+        journal.replay()
+        journal.append(StateJournal.SYNC, 1.0)
+        journal.append(StateJournal.SYNC, 2.0)
+        journal.close()
+        intact = os.path.getsize(path)
+        with open(path, "ab") as f:
+            f.write(b"\x03\x00\x00")
+
+        journal = StateJournal(path)
+        assert [r.timestamp for r in journal.replay()] == [1.0, 2.0]
+        assert os.path.getsize(path) == intact
+        # New records land after the last intact one
+        journal.append(StateJournal.SYNC, 3.0)
+        journal.close()
+        assert [r.timestamp for r in replayed(path)] == [1.0, 2.0, 3.0]
+
+    def test_corrupt_record_stops_replay(self, path):
+        journal = StateJournal(path)
+        journal.replay()
+        journal.append(StateJournal.SYNC, 1.0)
+        journal.append(StateJournal.SYNC, 2.0)
+        journal.close()
+        with open(path, "r+b") as f:
+            f.seek(-1, os.SEEK_END)
+            f.write(b"\xff")
+        assert [r.timestamp for r in replayed(path)] == [1.0]
+
+    def test_unknown_file_is_replaced(self, path):
+        os.makedirs(os.path.dirname(path))
+        with open(path, "w") as f:
+            f.write("not a journal")
+        assert replayed(path) == []
+        with open(path, "rb") as f:
+            assert f.read() == StateJournal.MAGIC
+
+    def test_compaction_keeps_latest_records(self, path):
+        journal = StateJournal(path, max_bytes=512, keep_transitions=3)
+        journal.replay()
+        journal.append(StateJournal.START, 0.0)
+        for t in range(1, 50):
+            journal.append(StateJournal.STATE, float(t), bytes([t % 2]))
+            journal.append(StateJournal.SYNC, float(t))
+        journal.close()
+        assert journal.compactions > 0
+        assert os.path.getsize(path) <= 512
+
+        records = replayed(path)
+        assert [r.timestamp for r in records if r.kind == StateJournal.STATE][-1] == 49.0
+        # Older transitions were dropped; only those since the last compaction remain
+        assert records[0].kind == StateJournal.START
+        assert 1.0 not in [r.timestamp for r in records if r.kind == StateJournal.STATE]
+        assert [r.timestamp for r in records if r.kind == StateJournal.SYNC][-1] == 49.0
+        assert [r.timestamp for r in records if r.kind == StateJournal.START] == [0.0]
+
+    def test_fsync_is_batched(self, path, monkeypatch):
+        fsyncs = []
+        real_fsync = os.fsync
+        monkeypatch.setattr(os, "fsync", lambda fd: fsyncs.append(fd) or real_fsync(fd))
+        journal = StateJournal(path, fsync_interval_sec=60)
+        journal.replay()
+        fsyncs.clear()
+        for t in range(10):
+            journal.append(StateJournal.SYNC, float(t))
+            journal.flush()
+        assert fsyncs == []
+        journal.flush(force=True)
+        assert len(fsyncs) == 1
+
+    def test_error_payload_is_capped(self, path):
+        journal = StateJournal(path)
+        journal.replay()
+        journal.append(StateJournal.ERROR, 1.0, b"x" * 5000)
+        journal.close()
+        assert len(replayed(path)[0].payload) == StateJournal.MAX_PAYLOAD
+
+
+class TestMonitorJournal:
+    def test_last_sync_and_error_survive_restart(self, path, make_monitor):
+        monitor = make_monitor('Can\'t sync "a.txt" (access denied)\n', journal=StateJournal(path))
+        monitor.refresh()
+        monitor.dropbox.query_status.return_value = "Up to date\n"
+        monitor.refresh()
+        last_sync = monitor.last_sync_time
+        first_start = monitor.start_time
+        monitor.stop()
+        for collector in set(REGISTRY._names_to_collectors.values()):
+            REGISTRY.unregister(collector)
+
+        restarted = make_monitor("Syncing 3 files\n", journal=StateJournal(path))
+        assert restarted.last_sync_time == last_sync
+        assert restarted.last_error == 'Can\'t sync "a.txt" (access denied)'
+        assert restarted.previous_start_time == first_start
+
+        status = restarted.get_json_status()
+        assert status["last_sync"] == last_sync
+        assert status["journal"]["previous_start"] == first_start
+        # The state timeline is back in the history as well
+        assert restarted.get_history()["points"]["state"][-1] == State.UP_TO_DATE.value
+
+    def test_bad_state_record_is_skipped(self, path, caplog, make_monitor):
+        journal = StateJournal(path)
+        journal.replay()
+        journal.append(StateJournal.STATE, 1.0, b"")
+        journal.append(StateJournal.STATE, 2.0, b"\x02\x02")
+        journal.append(StateJournal.SYNC, 3.0)
+        journal.close()
+
+        monitor = make_monitor("Up to date\n", journal=StateJournal(path))
+        assert monitor.last_sync_time == 3.0
+        assert monitor.get_history()["points"]["state"] == []
+        assert caplog.text.count("Skipping journal state record") == 2
+
+    def test_unwritable_journal_is_disabled(self, tmp_path, make_monitor):
+        (tmp_path / "volume").write_text("")
+        journal = StateJournal(str(tmp_path / "volume" / "monitor.journal"))
+        monitor = make_monitor("Up to date\n", journal=journal)
+        assert monitor.journal is None
+        monitor.refresh()
+        assert monitor.get_json_status()["journal"] is None
@@ -1,7 +1,18 @@
+import json
 import logging
+import os
+import time
 import pytest
-from unittest.mock import MagicMock
-from monitoring import DropboxMonitor, DropboxInterface, State, Metric
+from unittest.mock import MagicMock, patch
+import monitoring
+from monitoring import (
+    DropboxMonitor,
+    DropboxInterface,
+    Direction,
+    State,
+    Metric,
+    StatusCache,
+)
 
 
 @pytest.fixture
@@ -102,21 +113,134 @@ class TestParseOutput:
 
     def test_raw_status_stored(self, monitor, mock_dropbox):
         mock_dropbox.query_status.return_value = "Syncing 5 files\n"
-        monitor.get_status(Metric.NUM_SYNCING)
+        monitor.refresh()
         assert "Syncing 5 files" in monitor.raw_status
 
 
+class TestTransferProgress:
+    def test_download_rate_and_eta(self, monitor):
+        monitor.parse_output("Downloading 82 files (2,457 KB/sec, 2 secs)\n")
+        assert monitor.transfer_rates == {Direction.DOWNLOAD: 2457 * 1024}
+        assert monitor.eta_seconds == 2
+
+    def test_eta_without_rate(self, monitor):
+        monitor.parse_output("Downloading 176 files (6 secs)\n")
+        assert monitor.transfer_rates == {}
+        assert monitor.eta_seconds == 6
+
+    def test_bullet_eta(self, monitor):
+        monitor.parse_output("Syncing 176 files • 6 secs\n")
+        assert monitor.eta_seconds == 6
+
+    def test_single_file_eta(self, monitor):
+        monitor.parse_output('Syncing "none" • 1 sec\n')
+        assert monitor.eta_seconds == 1
+
+    @pytest.mark.parametrize(
+        "rate,expected",
+        [
+            ("512 B/sec", 512),
+            ("2 KB/sec", 2048),
+            ("1.5 MB/sec", 1.5 * 1024 ** 2),
+        ],
+    )
+    def test_rate_units(self, monitor, rate, expected):
+        monitor.parse_output("Uploading 3 files (%s, 1 min)\n" % rate)
+        assert monitor.transfer_rates[Direction.UPLOAD] == expected
+
+    @pytest.mark.parametrize(
+        "eta,expected",
+        [("1 sec", 1), ("5 mins", 300), ("1 min", 60), ("2 hrs", 7200), ("1 hr", 3600)],
+    )
+    def test_eta_units(self, monitor, eta, expected):
+        monitor.parse_output("Downloading 3 files (1 KB/sec, %s)\n" % eta)
+        assert monitor.eta_seconds == expected
+
+    def test_per_direction_rates(self, monitor):
+        monitor.parse_output(
+            "Uploading 2 files (100 KB/sec, 5 secs)\n"
+            "Downloading 82 files (2 MB/sec, 1 min)\n"
+        )
+        assert monitor.transfer_rates == {
+            Direction.UPLOAD: 100 * 1024,
+            Direction.DOWNLOAD: 2 * 1024 ** 2,
+        }
+        assert monitor.eta_seconds == 60
+
+    def test_file_name_is_not_parsed(self, monitor):
+        monitor.parse_output('Downloading "10 KB/sec 5 mins.txt"\n')
+        assert monitor.transfer_rates == {}
+        assert monitor.eta_seconds is None
+
+    def test_cleared_when_up_to_date(self, monitor):
+        monitor.parse_output("Downloading 82 files (2 KB/sec, 2 secs)\n")
+        monitor.parse_output("Up to date\n")
+        assert monitor.transfer_rates == {}
+        assert monitor.eta_seconds is None
+
+    def test_exported(self, monitor, mock_dropbox):
+        from prometheus_client import REGISTRY
+
+        mock_dropbox.query_status.return_value = "Downloading 82 files (2 KB/sec, 2 mins)\n"
+        monitor.start_sampler = MagicMock()
+        with patch("monitoring.start_http_server"):
+            monitor.start()
+        monitor.refresh()
+
+        labels = {"direction": "download"}
+        assert REGISTRY.get_sample_value(
+            "dropbox_transfer_rate_bytes_per_second", labels
+        ) == 2048
+        assert REGISTRY.get_sample_value(
+            "dropbox_transfer_rate_bytes_per_second", {"direction": "upload"}
+        ) == 0
+        assert REGISTRY.get_sample_value("dropbox_sync_eta_seconds") == 120
+        assert REGISTRY.get_sample_value(
+            "dropbox_transfer_rate_observed_bytes_per_second_count", labels
+        ) == 1
+
+    def test_in_json_status(self, monitor, mock_dropbox):
+        mock_dropbox.query_status.return_value = "Uploading 5 files (1 MB/sec, 3 secs)\n"
+        mock_dropbox.query_account_info.return_value = None
+        mock_dropbox.query_exclude_list.return_value = None
+        mock_dropbox.query_version.return_value = None
+        monitor.refresh()
+        transfer = monitor.get_json_status()["transfer"]
+        assert transfer == {
+            "sync_bytes_per_sec": None,
+            "download_bytes_per_sec": None,
+            "upload_bytes_per_sec": 1024 ** 2,
+            "eta_seconds": 3,
+        }
+
+
 class TestGetStatus:
-    def test_respects_polling_interval(self, monitor, mock_dropbox):
+    def test_sampler_respects_polling_interval(self, monitor, mock_dropbox):
         mock_dropbox.query_status.return_value = "Up to date\n"
-
-        # First call should query
+        mock_dropbox.query_exclude_list.return_value = []
+        monitor.start_sampler()
+        try:
+            deadline = time.monotonic() + 2
+            while mock_dropbox.query_status.call_count == 0:
+                assert time.monotonic() < deadline
+                time.sleep(0.01)
+            # The next poll waits out the 5 second floor, however often we read
+            time.sleep(0.2)
+            for _ in range(10):
+                monitor.get_status(Metric.NUM_SYNCING)
+            assert mock_dropbox.query_status.call_count == 1
+            assert monitor.scheduler.interval == 5
+        finally:
+            monitor.stop()
+
+    def test_never_queries_dropbox(self, monitor, mock_dropbox):
         monitor.get_status(Metric.NUM_SYNCING)
-        assert mock_dropbox.query_status.call_count == 1
+        assert mock_dropbox.query_status.call_count == 0
 
-        # Immediate second call should NOT query (within interval)
-        monitor.get_status(Metric.NUM_SYNCING)
-        assert mock_dropbox.query_status.call_count == 1
+    def test_reads_latest_snapshot(self, monitor, mock_dropbox):
+        mock_dropbox.query_status.return_value = "Downloading 7 files\n"
+        monitor.refresh()
+        assert monitor.get_status(Metric.NUM_DOWNLOADING) == 7
 
     def test_returns_zero_for_none(self, monitor):
         result = monitor.get_status(Metric.NUM_SYNCING)
@@ -127,6 +251,53 @@ class TestGetStatus:
             monitor.get_status("invalid")
 
 
+class TestSnapshot:
+    def test_refresh_publishes_new_snapshot(self, monitor, mock_dropbox):
+        mock_dropbox.query_status.return_value = "Syncing 3 files\n"
+        before = monitor.snapshot
+        after = monitor.refresh()
+        assert after is monitor.snapshot
+        assert after is not before
+        assert after.state == State.SYNCING
+        assert after.num_syncing == 3
+        assert after.refresh_duration >= 0
+
+    def test_snapshot_is_immutable(self, monitor):
+        with pytest.raises(AttributeError):
+            monitor.snapshot.num_syncing = 5
+
+    def test_failed_query_marks_unknown(self, monitor, mock_dropbox):
+        mock_dropbox.query_status.return_value = "Up to date\n"
+        monitor.refresh()
+        mock_dropbox.query_status.return_value = None
+        snapshot = monitor.refresh()
+        assert snapshot.state == State.UNKNOWN
+        assert snapshot.num_syncing is None
+
+    def test_snapshot_age(self, monitor, mock_dropbox):
+        mock_dropbox.query_status.return_value = "Up to date\n"
+        monitor.refresh()
+        assert 0 <= monitor.get_snapshot_age() < 5
+
+    def test_sampler_thread_refreshes(self, mock_dropbox, logger):
+        mock_dropbox.query_status.return_value = "Uploading 4 files\n"
+        monitor = DropboxMonitor(
+            dropbox=mock_dropbox,
+            min_poll_interval_sec=0,
+            logger=logger,
+            prom_port=9999,
+        )
+        monitor.start_sampler()
+        try:
+            deadline = time.time() + 5
+            while monitor.snapshot.num_uploading != 4 and time.time() < deadline:
+                time.sleep(0.01)
+        finally:
+            monitor.stop()
+        assert monitor.snapshot.num_uploading == 4
+        assert mock_dropbox.query_status.call_count >= 1
+
+
 class TestJsonStatus:
     def test_json_status_structure(self, monitor, mock_dropbox):
         mock_dropbox.query_status.return_value = "Up to date\n"
@@ -136,6 +307,7 @@ class TestJsonStatus:
         mock_dropbox.query_exclude_list.return_value = ["Backups"]
         mock_dropbox.query_version.return_value = "242.4.5815"
 
+        monitor.refresh()
         result = monitor.get_json_status()
 
         assert result["status"] == "up to date"
@@ -156,6 +328,7 @@ class TestJsonStatus:
         mock_dropbox.query_exclude_list.return_value = None
         mock_dropbox.query_version.return_value = None
 
+        monitor.refresh()
         result = monitor.get_json_status()
 
         assert result["status"] == "starting"
@@ -169,7 +342,119 @@ class TestJsonStatus:
         mock_dropbox.query_exclude_list.return_value = None
         mock_dropbox.query_version.return_value = "242.4.5815"
 
+        monitor.refresh()
         result = monitor.get_json_status()
 
         assert result["status"] == "sync_error"
         assert "big.zip" in result["last_error"]
+
+    def test_json_status_does_not_query_dropbox(self, monitor, mock_dropbox):
+        mock_dropbox.query_account_info.return_value = None
+        mock_dropbox.query_exclude_list.return_value = None
+        mock_dropbox.query_version.return_value = None
+
+        result = monitor.get_json_status()
+
+        assert mock_dropbox.query_status.call_count == 0
+        assert result["status"] == "starting"
+        assert "age_seconds" in result["snapshot"]
+
+
+class TestStatusCache:
+    def test_file_entry_hits_until_file_changes(self, tmp_path):
+        path = tmp_path / "VERSION"
+        path.write_text("1.0")
+        cache = StatusCache()
+        loader = MagicMock(side_effect=lambda: path.read_text())
+
+        assert cache.get_file("version", str(path), loader) == "1.0"
+        assert cache.get_file("version", str(path), loader) == "1.0"
+        assert loader.call_count == 1
+
+        path.write_text("2.00")
+        assert cache.get_file("version", str(path), loader) == "2.00"
+        assert loader.call_count == 2
+        assert cache.stats()["version"] == {"hits": 1, "misses": 2}
+
+    def test_file_entry_detects_atomic_replace(self, tmp_path):
+        path = tmp_path / "info.json"
+        path.write_text("a")
+        cache = StatusCache()
+        cache.get_file("info", str(path), lambda: path.read_text())
+
+        replacement = tmp_path / "info.json.tmp"
+        replacement.write_text("b")
+        stat = os.stat(path)
+        os.replace(replacement, path)
+        os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+
+        assert cache.get_file("info", str(path), lambda: path.read_text()) == "b"
+
+    def test_ttl_entry_expires(self):
+        cache = StatusCache()
+        loader = MagicMock(return_value=["Backups"])
+        with patch.object(monitoring, "monotonic", return_value=100.0):
+            cache.get_ttl("exclude_list", loader, ttl=10)
+            cache.get_ttl("exclude_list", loader, ttl=10)
+        assert loader.call_count == 1
+        with patch.object(monitoring, "monotonic", return_value=111.0):
+            cache.get_ttl("exclude_list", loader, ttl=10)
+        assert loader.call_count == 2
+
+    def test_failed_loads_are_not_cached(self):
+        cache = StatusCache()
+        loader = MagicMock(return_value=None)
+        cache.get_ttl("exclude_list", loader)
+        cache.get_ttl("exclude_list", loader)
+        assert loader.call_count == 2
+
+    def test_invalidate_and_set(self):
+        cache = StatusCache()
+        loader = MagicMock(return_value=["a"])
+        cache.get_ttl("exclude_list", loader)
+        cache.invalidate("exclude_list")
+        cache.get_ttl("exclude_list", loader)
+        assert loader.call_count == 2
+
+        cache.set("exclude_list", ["b"])
+        assert cache.get_ttl("exclude_list", loader) == ["b"]
+        assert loader.call_count == 2
+
+    def test_evicts_least_recently_used(self):
+        cache = StatusCache(max_entries=2)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        cache.get_ttl("a", lambda: 0)
+        cache.set("c", 3)
+        assert cache.get_ttl("a", lambda: 0) == 1
+        assert cache.get_ttl("b", lambda: 0) == 0
+
+    def test_interface_reads_info_json_once(self, tmp_path, monkeypatch, logger):
+        info = tmp_path / "info.json"
+        info.write_text(json.dumps({"personal": {}}))
+        monkeypatch.setattr(monitoring, "INFO_JSON", str(info))
+        dropbox = DropboxInterface(logger)
+        with patch("builtins.open", wraps=open) as opened:
+            assert dropbox.query_account_info() == {"personal": {}}
+            assert dropbox.query_account_info() == {"personal": {}}
+        assert opened.call_count == 1
+
+    def test_interface_invalidates_exclude_list(self, logger):
+        dropbox = DropboxInterface(logger)
+        with patch.object(DropboxInterface, "_load_exclude_list", return_value=["a"]) as load:
+            dropbox.query_exclude_list()
+            dropbox.query_exclude_list()
+            dropbox.invalidate_exclude_list()
+            dropbox.query_exclude_list()
+        assert load.call_count == 2
+
+    def test_hit_miss_counters_are_exported(self, logger):
+        from prometheus_client import REGISTRY
+
+        dropbox = DropboxInterface(logger)
+        DropboxMonitor(dropbox=dropbox, min_poll_interval_sec=5, logger=logger, prom_port=9999)
+        dropbox.cache.set("version", "1.0")
+        dropbox.cache.get_ttl("version", lambda: None)
+
+        assert REGISTRY.get_sample_value("dropbox_cache_hits_total", {"cache": "version"}) == 1
+        assert REGISTRY.get_sample_value("dropbox_cache_misses_total", {"cache": "version"}) == 0
@@ -0,0 +1,219 @@
+import json
+import logging
+import os
+import threading
+import time
+
+import pytest
+from prometheus_client import CollectorRegistry
+
+from ownership import InitialPass, OwnershipFixer
+
+DROPBOX_UID = os.getuid() + 1000
+DROPBOX_GID = os.getgid() + 1000
+
+
+@pytest.fixture
+def chowned(monkeypatch):
+    """Record chown calls instead of performing them (tests don't run as root)."""
+    calls = []
+    monkeypatch.setattr(os, "chown", lambda path, uid, gid, follow_symlinks=True: calls.append(path))
+    return calls
+
+
+@pytest.fixture
+def tree(tmp_path):
+    root = tmp_path / "Dropbox"
+    (root / "a" / "b").mkdir(parents=True)
+    (root / "c").mkdir()
+    (root / "top.txt").write_text("x")
+    (root / "a" / "one.txt").write_text("x")
+    (root / "a" / "b" / "two.txt").write_text("x")
+    return root
+
+
+@pytest.fixture
+def fixer(tree, tmp_path):
+    fixer = OwnershipFixer(
+        str(tree),
+        DROPBOX_UID,
+        DROPBOX_GID,
+        logging.getLogger("test"),
+        checkpoint_path=str(tmp_path / "state" / "ownership.json"),
+    )
+    yield fixer
+    if fixer.inotify is not None:
+        fixer.inotify.close()
+
+
+def wait_for_events(fixer, predicate, timeout=2.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        fixer.handle_events(fixer.inotify.read(0.05))
+        if predicate():
+            return
+
+
+class TestOwnershipFixer:
+    def test_fix_skips_entries_already_owned(self, tree, chowned):
+        fixer = OwnershipFixer(str(tree), os.getuid(), os.getgid(), logging.getLogger("test"), None)
+        assert fixer.fix(str(tree / "top.txt")) is False
+        assert chowned == []
+
+    def test_full_scan_fixes_everything(self, fixer, tree, chowned):
+        assert fixer.scan() == 7
+        assert str(tree / "a" / "b" / "two.txt") in chowned
+
+    def test_scan_skips_unchanged_directories(self, fixer, tree, chowned):
+        fixer.scan()
+        chowned.clear()
+        fixer.scan()
+        # Only the directories themselves are re-checked
+        assert sorted(chowned) == sorted(
+            str(p) for p in (tree, tree / "a", tree / "a" / "b", tree / "c")
+        )
+
+    def test_scan_rechecks_changed_directory(self, fixer, tree, chowned):
+        fixer.scan()
+        (tree / "a" / "b" / "new.txt").write_text("x")
+        os.utime(tree / "a" / "b", ns=(0, os.stat(tree / "a" / "b").st_mtime_ns + 10 ** 9))
+        chowned.clear()
+        fixer.scan()
+        assert str(tree / "a" / "b" / "new.txt") in chowned
+        assert str(tree / "a" / "one.txt") not in chowned
+
+    def test_deep_scan_ignores_checkpoint(self, fixer, chowned):
+        fixer.scan()
+        chowned.clear()
+        assert fixer.scan(deep=True) == 7
+
+    def test_checkpoint_is_persisted(self, fixer, tree, tmp_path, chowned):
+        fixer.scan()
+        reloaded = OwnershipFixer(
+            str(tree),
+            DROPBOX_UID,
+            DROPBOX_GID,
+            logging.getLogger("test"),
+            checkpoint_path=fixer.checkpoint_path,
+            registry=CollectorRegistry(),
+        )
+        assert reloaded.checkpoint == fixer.checkpoint
+        assert reloaded.checkpoint["a"][1] == ["b"]
+
+    def test_checkpoint_for_other_root_is_ignored(self, fixer, tmp_path, chowned):
+        fixer.scan()
+        other = OwnershipFixer(
+            str(tmp_path),
+            DROPBOX_UID,
+            DROPBOX_GID,
+            logging.getLogger("test"),
+            fixer.checkpoint_path,
+            registry=CollectorRegistry(),
+        )
+        assert other.checkpoint == {}
+
+    def test_inotify_fixes_new_files(self, fixer, tree, chowned):
+        fixer.start_watching()
+        fixer.scan()
+        assert len(fixer._watches) == 4
+        chowned.clear()
+
+        (tree / "c" / "from-ssh.txt").write_text("x")
+        wait_for_events(fixer, lambda: chowned)
+        assert chowned == [str(tree / "c" / "from-ssh.txt")]
+
+    def test_inotify_walks_new_directories(self, fixer, tree, chowned):
+        fixer.start_watching()
+        fixer.scan()
+        chowned.clear()
+
+        (tree / "c" / "new" / "deeper").mkdir(parents=True)
+        (tree / "c" / "new" / "deeper" / "file.txt").write_text("x")
+        target = str(tree / "c" / "new" / "deeper" / "file.txt")
+        wait_for_events(fixer, lambda: target in chowned)
+        assert target in chowned
+        assert str(tree / "c" / "new" / "deeper") in fixer._watched_paths
+
+    def test_watch_limit(self, fixer, chowned):
+        fixer.max_watches = 2
+        fixer.start_watching()
+        fixer.scan()
+        assert len(fixer._watches) == 2
+
+    def test_queue_overflow_requests_scan(self, fixer):
+        from monitoring import Inotify, InotifyEvent
+
+        fixer.handle_events([InotifyEvent(-1, Inotify.IN_Q_OVERFLOW, 0, "")])
+        assert fixer.scan_requested is True
+
+
+@pytest.fixture
+def initial_pass(tree, tmp_path):
+    return InitialPass(
+        str(tree),
+        DROPBOX_UID,
+        DROPBOX_GID,
+        logging.getLogger("test"),
+        checkpoint_path=str(tmp_path / "state" / "permissions.json"),
+        workers=4,
+    )
+
+
+class TestInitialPass:
+    def test_fixes_everything(self, initial_pass, tree, chowned):
+        assert initial_pass.run() is True
+        assert (initial_pass.checked, initial_pass.fixed, initial_pass.directories) == (7, 7, 4)
+        assert sorted(chowned) == sorted(str(p) for p in [tree, *tree.rglob("*")])
+        assert not os.path.exists(initial_pass.checkpoint_path)
+
+    def test_matches_group_too(self, tree, chowned):
+        # Right owner, wrong group: chown -R would have fixed it as well
+        permission_pass = InitialPass(
+            str(tree), os.getuid(), DROPBOX_GID, logging.getLogger("test"), None
+        )
+        permission_pass.run()
+        assert permission_pass.fixed == 7
+
+    def test_skips_entries_already_owned(self, tree, chowned):
+        permission_pass = InitialPass(
+            str(tree), os.getuid(), os.getgid(), logging.getLogger("test"), None
+        )
+        assert permission_pass.run() is True
+        assert permission_pass.checked == 7
+        assert chowned == []
+
+    def test_interrupted_pass_resumes(self, initial_pass, tree, monkeypatch):
+        stop = threading.Event()
+        calls = []
+
+        def chown(path, uid, gid, follow_symlinks=True):
+            calls.append(path)
+            if len(calls) == 3:
+                stop.set()
+
+        monkeypatch.setattr(os, "chown", chown)
+        initial_pass.workers = 1
+        assert initial_pass.run(stop) is False
+        with open(initial_pass.checkpoint_path) as f:
+            checkpoint = json.load(f)
+        assert checkpoint["root"] == str(tree)
+        assert checkpoint["pending"]
+        assert checkpoint["pending"] != ["."]
+
+        resumed = InitialPass(
+            str(tree), DROPBOX_UID, DROPBOX_GID, logging.getLogger("test"),
+            initial_pass.checkpoint_path,
+        )
+        assert resumed.run() is True
+        # Everything got fixed across both runs, nothing was re-walked from the top
+        assert set(calls) == {str(p) for p in [tree, *tree.rglob("*")]}
+        assert calls.count(str(tree)) == 1
+        assert not os.path.exists(initial_pass.checkpoint_path)
+
+    def test_checkpoint_for_other_root_is_ignored(self, initial_pass, tmp_path, chowned):
+        os.makedirs(os.path.dirname(initial_pass.checkpoint_path))
+        with open(initial_pass.checkpoint_path, "w") as f:
+            json.dump({"root": "/elsewhere", "pending": ["x"], "directories": 1,
+                       "checked": 1, "fixed": 1}, f)
+        assert initial_pass.run() is True
+        assert initial_pass.checked == 7
@@ -0,0 +1,110 @@
+import os
+
+import pytest
+
+try:
+    import pytest_benchmark
+except ImportError:  # pragma: no cover
+    pytest_benchmark = None
+
+from monitoring import Direction, ParsedStatus, State, parse_status
+
+CORPUS = os.path.join(os.path.dirname(__file__), "data", "status_corpus.txt")
+
+
+def load_corpus():
+    """Return (expected state, output) pairs from the recorded corpus."""
+    with open(CORPUS, encoding="utf-8") as f:
+        text = "".join(line for line in f if not line.startswith("#"))
+    samples = []
+    for block in text.strip().split("\n\n"):
+        header, _, output = block.partition("\n")
+        samples.append((State(header[2:]), output + "\n"))
+    return samples
+
+
+SAMPLES = load_corpus()
+
+
+class TestParseStatus:
+    @pytest.mark.parametrize("expected,output", SAMPLES)
+    def test_corpus_state(self, expected, output):
+        assert parse_status(output).state == expected
+
+    def test_returns_typed_result(self):
+        result = parse_status("Downloading 82 files (2,457 KB/sec, 2 secs)\n")
+        assert result == ParsedStatus(
+            state=State.SYNCING,
+            num_downloading=82,
+            transfer_rates={Direction.DOWNLOAD: 2457 * 1024},
+            eta_seconds=2,
+        )
+
+    def test_multi_line_counts(self):
+        result = parse_status(
+            "Syncing 25,316 files • 2 hrs\n"
+            "Downloading 25,310 files (11.6 MB/sec, 2 hrs)\n"
+            "Uploading 6 files (96 B/sec, 4 secs)\n"
+        )
+        assert (result.num_syncing, result.num_downloading, result.num_uploading) == (
+            25316,
+            25310,
+            6,
+        )
+        assert result.eta_seconds == 7200
+
+    def test_file_name_with_commas_and_parentheses(self):
+        result = parse_status(
+            'Downloading "Documents/Q3 report, final (v2).pdf" (350 KB/sec, 12 secs)\n'
+        )
+        assert result.num_downloading == 1
+        assert result.transfer_rates == {Direction.DOWNLOAD: 350 * 1024}
+        assert result.eta_seconds == 12
+
+    def test_rates_are_not_shared(self):
+        first, second = parse_status("Starting...\n"), parse_status("Starting...\n")
+        assert first.transfer_rates == {}
+        assert first.transfer_rates is not second.transfer_rates
+
+    def test_error_keeps_line(self):
+        result = parse_status('Can\'t sync "a, b.txt" (access denied)\n')
+        assert result.last_error == 'Can\'t sync "a, b.txt" (access denied)'
+        assert result.num_syncing is None
+
+    def test_keeps_every_error(self):
+        result = parse_status('Can\'t sync "a.txt" (access denied)\nCan\'t sync "b.txt" (disk full)\n')
+        assert result.errors == (
+            'Can\'t sync "a.txt" (access denied)',
+            'Can\'t sync "b.txt" (disk full)',
+        )
+        assert result.last_error == 'Can\'t sync "b.txt" (disk full)'
+
+    def test_up_to_date_flag(self):
+        assert parse_status("Up to date\n").up_to_date is True
+        assert parse_status("Syncing...\n").up_to_date is False
+
+    def test_counts_dropped_outside_syncing(self):
+        result = parse_status("Syncing 3 files\nDropbox isn't running!\n")
+        assert result.state == State.NOT_RUNNING
+        assert result.num_syncing is None
+
+
+@pytest.mark.skipif(pytest_benchmark is None, reason="pytest-benchmark not installed")
+class TestParserBenchmark:
+    """Throughput of parse_status over the recorded corpus (pytest-benchmark)."""
+
+    def test_corpus_throughput(self, benchmark):
+        outputs = [output for _, output in SAMPLES] * 50
+
+        def replay():
+            for output in outputs:
+                parse_status(output)
+
+        benchmark(replay)
+
+    def test_many_line_output_throughput(self, benchmark):
+        # A daemon juggling many transfers at once, replayed as one long output
+        output = "".join(output for _, output in SAMPLES if "files" in output) * 200
+
+        result = benchmark(parse_status, output)
+        assert result.state in (State.SYNCING, State.SYNC_ERROR)
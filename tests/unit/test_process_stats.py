@@ -0,0 +1,152 @@
+import logging
+import os
+import shutil
+from unittest.mock import MagicMock
+
+import pytest
+from prometheus_client import REGISTRY
+
+from monitoring import DaemonProcessReader, DropboxInterface, DropboxMonitor
+
+CLK_TCK = os.sysconf("SC_CLK_TCK")
+
+
+def make_process(proc, pid, ppid, comm="dropbox", rss_kb=1024, hwm_kb=2048, threads=4,
+                 ticks=(0, 0), start=1000, io=(0, 0), fds=3, inotify_watches=None,
+                 children=()):
+    """Create a fake /proc/<pid> entry under ``proc``."""
+    root = proc / str(pid)
+    (root / "fd").mkdir(parents=True)
+    (root / "fdinfo").mkdir()
+    (root / "task" / str(pid)).mkdir(parents=True)
+    (root / "comm").write_text(comm + "\n")
+    (root / "stat").write_text(
+        "%d (%s) S %d 0 0 0 0 0 0 0 0 0 %d %d 0 0 20 0 %d 0 %d 0 0\n"
+        % (pid, comm, ppid, ticks[0], ticks[1], threads, start)
+    )
+    (root / "status").write_text(
+        "Name:\t%s\nVmHWM:\t%8d kB\nVmRSS:\t%8d kB\nThreads:\t%d\n"
+        % (comm, hwm_kb, rss_kb, threads)
+    )
+    (root / "io").write_text(
+        "rchar: 1\nwchar: 2\nread_bytes: %d\nwrite_bytes: %d\n" % io
+    )
+    (root / "task" / str(pid) / "children").write_text(" ".join(map(str, children)))
+    for fd in range(fds):
+        os.symlink("/dev/null", root / "fd" / str(fd))
+    if inotify_watches is not None:
+        fd = str(fds)
+        os.symlink("anon_inode:inotify", root / "fd" / fd)
+        (root / "fdinfo" / fd).write_text(
+            "pos:\t0\nflags:\t02004000\n"
+            + "".join("inotify wd:%x ino:1 sdev:1 mask:fce ignored_mask:0\n" % i
+                      for i in range(1, inotify_watches + 1))
+        )
+    return root
+
+
+@pytest.fixture
+def proc(tmp_path):
+    proc = tmp_path / "proc"
+    (proc / "sys" / "fs" / "inotify").mkdir(parents=True)
+    (proc / "sys" / "fs" / "inotify" / "max_user_watches").write_text("524288\n")
+    make_process(proc, 1, 0, comm="docker-entrypoi")
+    return proc
+
+
+@pytest.fixture
+def daemon_tree(proc):
+    make_process(proc, 100, 1, rss_kb=1024 * 1024, hwm_kb=2 * 1024 * 1024, threads=40,
+                 ticks=(300 * CLK_TCK, 100 * CLK_TCK), io=(5000, 7000), fds=10,
+                 inotify_watches=3, children=(101,))
+    make_process(proc, 101, 100, rss_kb=1024, hwm_kb=1024, threads=2,
+                 ticks=(CLK_TCK, 0), io=(1, 1), fds=2)
+    return proc
+
+
+def reader_for(proc, tmp_path, pid=None):
+    pid_file = tmp_path / "dropbox.pid"
+    if pid is not None:
+        pid_file.write_text("%d\n" % pid)
+    return DaemonProcessReader(proc_root=str(proc), pid_file=str(pid_file))
+
+
+class TestDaemonProcessReader:
+    def test_sums_process_tree(self, daemon_tree, tmp_path):
+        stats = reader_for(daemon_tree, tmp_path, pid=100).read()
+        assert stats.pid == 100
+        assert stats.num_processes == 2
+        assert stats.rss_bytes == (1024 * 1024 + 1024) * 1024
+        assert stats.peak_rss_bytes == (2 * 1024 * 1024 + 1024) * 1024
+        assert stats.cpu_seconds == pytest.approx(401)
+        assert stats.threads == 42
+        assert stats.open_fds == 11 + 2
+        assert (stats.read_bytes, stats.write_bytes) == (5001, 7001)
+        assert stats.inotify_watches == 3
+        assert stats.inotify_max_user_watches == 524288
+
+    def test_scans_proc_without_pid_file(self, daemon_tree, tmp_path):
+        assert reader_for(daemon_tree, tmp_path).read().pid == 100
+
+    def test_ignores_stale_pid_file(self, daemon_tree, tmp_path):
+        # PID 1 exists but isn't dropbox
+        assert reader_for(daemon_tree, tmp_path, pid=1).read().pid == 100
+
+    def test_no_daemon(self, proc, tmp_path):
+        assert reader_for(proc, tmp_path).read() is None
+
+    def test_falls_back_to_ppid_walk(self, daemon_tree, tmp_path):
+        (daemon_tree / "100" / "task" / "100" / "children").unlink()
+        assert reader_for(daemon_tree, tmp_path, pid=100).process_tree(100) == [100, 101]
+
+    def test_follows_restarted_daemon(self, daemon_tree, tmp_path):
+        reader = reader_for(daemon_tree, tmp_path)
+        assert reader.read().pid == 100
+        shutil.rmtree(daemon_tree / "100")
+        shutil.rmtree(daemon_tree / "101")
+        make_process(daemon_tree, 200, 1, start=5000)
+        assert reader.read().pid == 200
+
+    def test_process_start_time(self, daemon_tree, tmp_path):
+        reader = reader_for(daemon_tree, tmp_path, pid=100)
+        assert reader.process_start_time(100) is None
+        (daemon_tree / "stat").write_text("cpu  1 2 3\nbtime 1700000000\n")
+        assert reader.process_start_time(100) == 1700000000 + 1000 / CLK_TCK
+        assert reader.read().started_at == reader.process_start_time(100)
+
+    def test_inotify_count_is_rate_limited(self, daemon_tree, tmp_path):
+        reader = reader_for(daemon_tree, tmp_path, pid=100)
+        assert reader.read().inotify_watches == 3
+        (daemon_tree / "100" / "fdinfo" / "10").write_text("inotify wd:1\n")
+        assert reader.read().inotify_watches == 3
+        reader.inotify_interval_sec = 0
+        assert reader.read().inotify_watches == 1
+
+
+class TestDaemonMetrics:
+    def test_snapshot_and_metrics(self, daemon_tree, tmp_path):
+        dropbox = MagicMock(spec=DropboxInterface)
+        dropbox.query_status.return_value = "Up to date\n"
+        dropbox.query_account_info.return_value = None
+        dropbox.query_exclude_list.return_value = None
+        dropbox.query_version.return_value = None
+        monitor = DropboxMonitor(
+            dropbox=dropbox,
+            min_poll_interval_sec=5,
+            logger=logging.getLogger("test"),
+            prom_port=9999,
+            process_reader=reader_for(daemon_tree, tmp_path, pid=100),
+        )
+
+        assert REGISTRY.get_sample_value("dropbox_daemon_up") == 0
+        monitor.refresh()
+
+        assert REGISTRY.get_sample_value("dropbox_daemon_up") == 1
+        assert REGISTRY.get_sample_value("dropbox_daemon_threads") == 42
+        assert REGISTRY.get_sample_value("dropbox_daemon_cpu_seconds_total") == pytest.approx(401)
+        assert REGISTRY.get_sample_value("dropbox_daemon_inotify_watches") == 3
+
+        daemon = monitor.get_json_status()["daemon"]
+        assert daemon["pid"] == 100
+        assert daemon["memory_mb"] == 1025.0
+        assert daemon["open_fds"] == 13
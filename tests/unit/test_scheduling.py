@@ -0,0 +1,212 @@
+import logging
+import threading
+import time
+from unittest.mock import MagicMock
+
+import pytest
+from prometheus_client import REGISTRY
+
+from monitoring import ChangeWatcher, DropboxInterface, DropboxMonitor, PollScheduler, State
+
+
+@pytest.fixture
+def logger():
+    return logging.getLogger("test")
+
+
+@pytest.fixture
+def mock_dropbox():
+    dropbox = MagicMock(spec=DropboxInterface)
+    dropbox.query_status.return_value = "Up to date\n"
+    return dropbox
+
+
+def wait_until(predicate, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not predicate() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return predicate()
+
+
+class TestPollScheduler:
+    def test_backs_off_while_up_to_date(self):
+        scheduler = PollScheduler(5, 60)
+        intervals = [scheduler.update(State.UP_TO_DATE) for _ in range(5)]
+        assert intervals == [10, 20, 40, 60, 60]
+
+    @pytest.mark.parametrize("state", [State.SYNCING, State.INDEXING, State.NOT_RUNNING])
+    def test_other_states_poll_at_floor(self, state):
+        scheduler = PollScheduler(5, 60)
+        for _ in range(3):
+            scheduler.update(State.UP_TO_DATE)
+        assert scheduler.update(state) == 5
+
+    def test_reset(self):
+        scheduler = PollScheduler(5, 60)
+        scheduler.update(State.UP_TO_DATE)
+        scheduler.reset()
+        assert scheduler.interval == 5
+
+    def test_fixed_interval_without_ceiling(self):
+        scheduler = PollScheduler(5)
+        assert scheduler.update(State.UP_TO_DATE) == 5
+
+    def test_ceiling_below_floor(self):
+        assert PollScheduler(10, 1).ceiling == 10
+
+
+class TestChangeWatcher:
+    def test_reports_changes(self, tmp_path, logger):
+        changed = threading.Event()
+        watcher = ChangeWatcher([str(tmp_path)], changed.set, logger)
+        assert watcher.start()
+        try:
+            wait_until(lambda: watcher._watches)
+            (tmp_path / "new.txt").write_text("x")
+            assert changed.wait(2)
+        finally:
+            watcher.stop()
+
+    def test_reports_nested_changes(self, tmp_path, logger):
+        (tmp_path / "Photos" / "2024").mkdir(parents=True)
+        changed = threading.Event()
+        watcher = ChangeWatcher([str(tmp_path)], changed.set, logger)
+        assert watcher.start()
+        try:
+            assert wait_until(lambda: len(watcher._watches) == 3)
+            (tmp_path / "Photos" / "2024" / "x.jpg").write_text("x")
+            assert changed.wait(2)
+
+            # Directories created later are watched as well
+            changed.clear()
+            (tmp_path / "Docs" / "Old").mkdir(parents=True)
+            assert wait_until(lambda: len(watcher._watches) == 5)
+            changed.clear()
+            (tmp_path / "Docs" / "Old" / "a.txt").write_text("a")
+            assert changed.wait(2)
+        finally:
+            watcher.stop()
+
+    def test_triggers(self, tmp_path, logger):
+        (tmp_path / "instance1").mkdir()
+        changed = threading.Event()
+        watcher = ChangeWatcher(
+            [], changed.set, logger, triggers={str(tmp_path): ["info.json"]}
+        )
+        assert watcher.start()
+        try:
+            assert wait_until(lambda: watcher._trigger_watches)
+            (tmp_path / "config.dbx").write_text("x")
+            (tmp_path / "instance1" / "config.dbx").write_text("x")
+            assert not changed.wait(0.2)
+            (tmp_path / "info.json").write_text("{}")
+            assert changed.wait(2)
+        finally:
+            watcher.stop()
+
+    def test_bounded(self, tmp_path, logger):
+        for name in ("a/deep", "b", "c"):
+            (tmp_path / name).mkdir(parents=True)
+        watcher = ChangeWatcher([str(tmp_path)], lambda: None, logger, max_watches=3)
+        assert watcher.start()
+        try:
+            assert wait_until(lambda: len(watcher._watches) == 3)
+            time.sleep(0.05)
+            # Shallowest first
+            watched = set(watcher._watches.values())
+            assert len(watched) == 3 and str(tmp_path) in watched
+            assert str(tmp_path / "a" / "deep") not in watched
+        finally:
+            watcher.stop()
+
+    def test_waits_for_missing_directory(self, tmp_path, logger):
+        changed = threading.Event()
+        watcher = ChangeWatcher([str(tmp_path / "Dropbox")], changed.set, logger, retry_interval=0)
+        assert watcher.start()
+        try:
+            time.sleep(0.05)
+            assert watcher._watches == {}
+            (tmp_path / "Dropbox").mkdir()
+            assert wait_until(lambda: watcher._watches)
+            (tmp_path / "Dropbox" / "new.txt").write_text("x")
+            assert changed.wait(2)
+        finally:
+            watcher.stop()
+
+
+class TestAdaptivePolling:
+    def test_change_triggers_early_poll(self, mock_dropbox, logger, tmp_path):
+        (tmp_path / "Photos" / "2024").mkdir(parents=True)
+        monitor = DropboxMonitor(
+            dropbox=mock_dropbox,
+            min_poll_interval_sec=0,
+            logger=logger,
+            prom_port=9999,
+            max_poll_interval_sec=30,
+            watch_paths=[str(tmp_path)],
+        )
+        # First "up to date" poll jumps straight to the ceiling
+        monitor.scheduler = PollScheduler(0.01, 30, backoff=10000)
+        monitor.start_sampler()
+        try:
+            assert wait_until(lambda: monitor.scheduler.interval == 30)
+            assert mock_dropbox.query_status.call_count == 1
+            assert wait_until(lambda: len(monitor._watcher._watches) == 3)
+
+            # A change two levels down wakes the sampler too
+            (tmp_path / "Photos" / "2024" / "new.jpg").write_text("x")
+            assert wait_until(lambda: mock_dropbox.query_status.call_count == 2)
+            assert REGISTRY.get_sample_value(
+                "dropbox_status_refreshes_total", {"trigger": "change"}
+            ) == 1
+        finally:
+            monitor.stop()
+
+    def test_daemon_bookkeeping_does_not_hold_the_floor(self, mock_dropbox, logger, tmp_path):
+        home = tmp_path / ".dropbox"
+        (home / "instance1").mkdir(parents=True)
+        (tmp_path / "Dropbox").mkdir()
+        monitor = DropboxMonitor(
+            dropbox=mock_dropbox,
+            min_poll_interval_sec=0,
+            logger=logger,
+            prom_port=9999,
+            max_poll_interval_sec=30,
+            watch_paths=[str(tmp_path / "Dropbox")],
+            socket_path=str(home / "command_socket"),
+        )
+        monitor.scheduler = PollScheduler(0.01, 30, backoff=10000)
+        monitor.start_sampler()
+        try:
+            assert wait_until(lambda: monitor.scheduler.interval == 30)
+            assert wait_until(lambda: monitor._watcher._trigger_watches)
+            # An idle daemon keeps rewriting its own state
+            for _ in range(10):
+                (home / "instance1" / "config.dbx").write_text("x")
+                (home / "config.dbx").write_text("x")
+                time.sleep(0.02)
+            time.sleep(0.2)
+            assert mock_dropbox.query_status.call_count == 1
+            assert monitor.scheduler.interval == 30
+
+            # A daemon (re)starting is worth a poll
+            (home / "info.json").write_text("{}")
+            assert wait_until(lambda: mock_dropbox.query_status.call_count == 2)
+        finally:
+            monitor.stop()
+
+    def test_syncing_polls_at_floor(self, mock_dropbox, logger):
+        mock_dropbox.query_status.return_value = "Syncing 3 files\n"
+        monitor = DropboxMonitor(
+            dropbox=mock_dropbox,
+            min_poll_interval_sec=0,
+            logger=logger,
+            prom_port=9999,
+            max_poll_interval_sec=30,
+        )
+        monitor.start_sampler()
+        try:
+            assert wait_until(lambda: mock_dropbox.query_status.call_count >= 3)
+            assert monitor.scheduler.interval == 0
+        finally:
+            monitor.stop()
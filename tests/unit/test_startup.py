@@ -0,0 +1,123 @@
+import os
+import threading
+import time
+from unittest.mock import MagicMock
+
+import pytest
+from prometheus_client import REGISTRY
+
+from monitoring import (
+    DaemonProcessReader,
+    DaemonProcessStats,
+    Readiness,
+    StartupCollector,
+    StartupPhase,
+    StartupTracker,
+    State,
+    wait_until_ready,
+)
+
+
+def later(delay, fn):
+    timer = threading.Timer(delay, fn)
+    timer.start()
+    return timer
+
+
+def stats(pid=100, started_at=1000.0):
+    return DaemonProcessStats(
+        pid=pid, num_processes=1, rss_bytes=0, peak_rss_bytes=0, cpu_seconds=0.0,
+        open_fds=0, threads=1, read_bytes=0, write_bytes=0, inotify_watches=None,
+        inotify_max_user_watches=None, started_at=started_at,
+    )
+
+
+class TestWaitUntilReady:
+    def test_wakes_when_socket_appears(self, tmp_path):
+        (tmp_path / ".dropbox").mkdir()
+        later(0.1, lambda: (tmp_path / ".dropbox" / "command_socket").write_text(""))
+        started = time.monotonic()
+        assert wait_until_ready(str(tmp_path), timeout=5) == Readiness.READY
+        # inotify wakes us up instead of waiting for the next 1s liveness check
+        assert time.monotonic() - started < 0.9
+
+    def test_waits_for_dot_dropbox_to_be_created(self, tmp_path):
+        def create():
+            (tmp_path / ".dropbox").mkdir()
+            later(0.05, lambda: (tmp_path / ".dropbox" / "info.json").write_text("{}"))
+
+        later(0.05, create)
+        assert wait_until_ready(str(tmp_path), timeout=5) == Readiness.READY
+
+    def test_already_ready(self, tmp_path):
+        (tmp_path / ".dropbox").mkdir()
+        (tmp_path / ".dropbox" / "info.json").write_text("{}")
+        assert wait_until_ready(str(tmp_path), timeout=0) == Readiness.READY
+
+    def test_timeout(self, tmp_path):
+        assert wait_until_ready(str(tmp_path), timeout=0.1) == Readiness.TIMEOUT
+
+    def test_daemon_exited(self, tmp_path):
+        assert wait_until_ready(str(tmp_path), timeout=5, is_alive=lambda: False) == Readiness.EXITED
+
+
+@pytest.fixture
+def reader():
+    reader = MagicMock(spec=DaemonProcessReader)
+    reader.process_start_time.return_value = 990.0
+    return reader
+
+
+@pytest.fixture
+def socket_path(tmp_path):
+    return str(tmp_path / "command_socket")
+
+
+class TestStartupTracker:
+    def test_phases(self, reader, socket_path):
+        started = time.time() - 10
+        tracker = StartupTracker(reader, socket_path)
+        reader.process_start_time.return_value = started - 2
+
+        tracker.observe(State.STARTING, stats(started_at=started), started + 1)
+        assert tracker.phases == {StartupPhase.SPAWN: pytest.approx(2)}
+
+        open(socket_path, "w").close()
+        socket_ready = os.stat(socket_path).st_ctime - started
+        tracker.observe(State.INDEXING, stats(started_at=started), started + 5)
+        tracker.observe(State.INDEXING, stats(started_at=started), started + 6)
+        tracker.observe(State.UP_TO_DATE, stats(started_at=started), started + 9)
+
+        assert tracker.as_dict() == {
+            "spawn": 2.0,
+            "socket_ready": round(socket_ready, 3),
+            "first_indexing": 5.0,
+            "first_up_to_date": 9.0,
+        }
+
+    def test_restarted_daemon_resets_phases_but_keeps_spawn(self, reader, socket_path):
+        tracker = StartupTracker(reader, socket_path)
+        tracker.observe(State.STARTING, stats(pid=100, started_at=1000.0), 1001)
+        tracker.observe(State.UP_TO_DATE, stats(pid=100, started_at=1000.0), 1030)
+        tracker.observe(State.STARTING, stats(pid=200, started_at=2000.0), 2001)
+        tracker.observe(State.UP_TO_DATE, stats(pid=200, started_at=2000.0), 2004)
+        assert tracker.as_dict() == {"spawn": 10.0, "first_up_to_date": 4.0}
+
+    def test_ignores_daemon_already_up_to_date(self, reader, socket_path):
+        tracker = StartupTracker(reader, socket_path)
+        tracker.observe(State.UP_TO_DATE, stats(), 5000)
+        assert tracker.phases == {}
+
+    def test_ignores_stale_socket(self, reader, socket_path):
+        open(socket_path, "w").close()
+        tracker = StartupTracker(reader, socket_path)
+        tracker.observe(State.STARTING, stats(started_at=time.time() + 60), time.time())
+        assert StartupPhase.SOCKET_READY not in tracker.phases
+
+    def test_exported(self, reader, socket_path):
+        tracker = StartupTracker(reader, socket_path)
+        REGISTRY.register(StartupCollector(tracker))
+        tracker.observe(State.STARTING, stats(), 1001)
+        assert REGISTRY.get_sample_value(
+            "dropbox_startup_phase_seconds", {"phase": "spawn"}
+        ) == 10.0
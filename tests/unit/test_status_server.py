@@ -0,0 +1,492 @@
+import gzip
+import http.client
+import json
+import logging
+import threading
+import time
+from unittest.mock import MagicMock
+
+import pytest
+from prometheus_client import REGISTRY
+
+from monitoring import (
+    DropboxInterface,
+    DropboxMonitor,
+    SingleFlight,
+    StatusEventBus,
+    accepts_gzip,
+    sample_stacks,
+    start_status_server,
+)
+
+
+@pytest.fixture
+def logger():
+    return logging.getLogger("test")
+
+
+@pytest.fixture
+def mock_dropbox():
+    dropbox = MagicMock(spec=DropboxInterface)
+    dropbox.query_status.return_value = "Up to date\n"
+    dropbox.query_account_info.return_value = None
+    dropbox.query_exclude_list.return_value = []
+    dropbox.query_version.return_value = "242.4.5815"
+    return dropbox
+
+
+@pytest.fixture
+def monitor(mock_dropbox, logger):
+    return DropboxMonitor(
+        dropbox=mock_dropbox, min_poll_interval_sec=5, logger=logger, prom_port=9999
+    )
+
+
+@pytest.fixture
+def server(monitor, logger):
+    server = start_status_server(monitor, 0, logger, request_timeout=0.5, host="127.0.0.1")
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def connect(server):
+    return http.client.HTTPConnection("127.0.0.1", server.server_address[1], timeout=5)
+
+
+def get(server, path, headers=None):
+    conn = connect(server)
+    conn.request("GET", path, headers=headers or {})
+    response = conn.getresponse()
+    body = response.read()
+    conn.close()
+    return response.status, body
+
+
+def read_event(response):
+    """Read one server-sent event (or heartbeat comment) as a dict."""
+    event = {}
+    while True:
+        line = response.readline().decode().rstrip("\n")
+        if not line:
+            return event
+        if line.startswith(":"):
+            event["comment"] = line[1:].strip()
+        else:
+            name, _, value = line.partition(": ")
+            event[name] = json.loads(value) if name == "data" else value
+
+
+class TestSingleFlight:
+    def test_concurrent_calls_share_one_execution(self):
+        flights = SingleFlight()
+        release = threading.Event()
+        fn = MagicMock(side_effect=lambda: release.wait(5) and "done")
+        results = []
+
+        threads = [
+            threading.Thread(target=lambda: results.append(flights.do("k", fn, 5)))
+            for _ in range(8)
+        ]
+        for t in threads:
+            t.start()
+        time.sleep(0.05)
+        release.set()
+        for t in threads:
+            t.join()
+
+        assert fn.call_count == 1
+        assert results == ["done"] * 8
+
+    def test_sequential_calls_run_again(self):
+        flights = SingleFlight()
+        fn = MagicMock(return_value=1)
+        flights.do("k", fn)
+        flights.do("k", fn)
+        assert fn.call_count == 2
+
+    def test_runs_on_the_callers_thread_without_timeout(self):
+        flights = SingleFlight()
+        assert flights.do("k", threading.current_thread) is threading.current_thread()
+        assert flights.do("k", threading.current_thread, 5) is not threading.current_thread()
+
+    def test_errors_propagate_to_all_waiters(self):
+        flights = SingleFlight()
+        fn = MagicMock(side_effect=[RuntimeError("boom"), 1])
+        with pytest.raises(RuntimeError):
+            flights.do("k", fn)
+        # The failed call is over; the next one runs again
+        assert flights.do("k", fn) == 1
+        assert fn.call_count == 2
+
+    def test_timeout_leaves_call_running(self):
+        flights = SingleFlight()
+        release = threading.Event()
+        fn = MagicMock(side_effect=lambda: release.wait(5) and 42)
+        with pytest.raises(TimeoutError):
+            flights.do("k", fn, timeout=0.05)
+        threading.Timer(0.05, release.set).start()
+        # The second caller joins the call that timed out instead of starting another
+        assert flights.do("k", fn, timeout=5) == 42
+        assert fn.call_count == 1
+
+
+class TestStatusServer:
+    def test_status(self, server, monitor):
+        monitor.refresh()
+        status, body = get(server, "/status")
+        assert status == 200
+        assert json.loads(body)["status"] == "up to date"
+
+    def test_status_ignores_query_string(self, server):
+        status, _ = get(server, "/status?foo=bar")
+        assert status == 200
+
+    def test_history(self, server, monitor):
+        monitor.refresh()
+        status, body = get(server, "/status/history?since=-60&step=0")
+        assert status == 200
+        history = json.loads(body)
+        assert history["points"]["state"] == ["up to date"]
+        assert history["memory_bytes"] > 0
+
+    def test_history_rejects_bad_parameters(self, server):
+        assert get(server, "/status/history?step=abc")[0] == 400
+        assert get(server, "/status/history?step=-1")[0] == 400
+
+    def test_health(self, server):
+        status, body = get(server, "/health")
+        assert status == 200
+        assert json.loads(body)["healthy"] is True
+
+    def test_not_found(self, server):
+        assert get(server, "/nope")[0] == 404
+
+    def test_keep_alive(self, server):
+        conn = connect(server)
+        for path in ("/health", "/status", "/health"):
+            conn.request("GET", path)
+            response = conn.getresponse()
+            response.read()
+            assert response.status == 200
+            assert not response.will_close
+        conn.close()
+
+    def test_concurrent_requests_share_one_build(self, server, monitor, mock_dropbox):
+        release = threading.Event()
+
+        def slow_exclude_list():
+            release.wait(5)
+            return []
+
+        mock_dropbox.query_exclude_list.side_effect = slow_exclude_list
+        statuses = []
+        threads = [
+            threading.Thread(target=lambda: statuses.append(get(server, "/status")[0]))
+            for _ in range(5)
+        ]
+        for t in threads:
+            t.start()
+        time.sleep(0.1)
+        release.set()
+        for t in threads:
+            t.join()
+
+        assert statuses == [200] * 5
+        assert mock_dropbox.query_exclude_list.call_count == 1
+
+    def test_slow_status_times_out_without_blocking_health(self, server, mock_dropbox):
+        release = threading.Event()
+        mock_dropbox.query_exclude_list.side_effect = lambda: release.wait(5)
+        result = {}
+        slow = threading.Thread(target=lambda: result.update(status=get(server, "/status")))
+        slow.start()
+        time.sleep(0.05)
+
+        started = time.monotonic()
+        assert get(server, "/health")[0] == 200
+        assert time.monotonic() - started < 0.25
+
+        slow.join()
+        release.set()
+        assert result["status"][0] == 504
+
+
+def stage_count(stage):
+    return REGISTRY.get_sample_value(
+        "dropbox_monitor_stage_duration_seconds_count", {"stage": stage}
+    )
+
+
+class TestStageTimings:
+    def test_refresh_stages(self, monitor):
+        monitor.refresh()
+        for stage in ("query", "parse", "process_stats", "snapshot"):
+            assert stage_count(stage) == 1
+
+    def test_status_request_stages(self, server, monitor):
+        monitor.refresh()
+        get(server, "/status", {"Accept-Encoding": "gzip"})
+        assert stage_count("status_json") == 1
+        assert stage_count("serialize") == 1
+        # A /status body with no errors is under GZIP_MIN_BYTES
+        assert stage_count("gzip") is None
+
+
+@pytest.fixture
+def admin_server(monitor, logger):
+    server = start_status_server(monitor, 0, logger, host="127.0.0.1", admin_token="s3cret")
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+class TestProfileEndpoint:
+    def test_disabled_without_token(self, server):
+        assert get(server, "/debug/profile?seconds=0.1")[0] == 404
+
+    def test_requires_token(self, admin_server):
+        assert get(admin_server, "/debug/profile?seconds=0.1")[0] == 401
+        status, _ = get(admin_server, "/debug/profile?seconds=0.1",
+                        {"Authorization": "Bearer wrong"})
+        assert status == 401
+
+    def test_rejects_bad_duration(self, admin_server):
+        auth = {"Authorization": "Bearer s3cret"}
+        assert get(admin_server, "/debug/profile?seconds=abc", auth)[0] == 400
+        assert get(admin_server, "/debug/profile?seconds=0", auth)[0] == 400
+        assert get(admin_server, "/debug/profile?seconds=61", auth)[0] == 400
+
+    def test_returns_collapsed_stacks(self, admin_server):
+        status, body = get(admin_server, "/debug/profile?seconds=0.2",
+                           {"Authorization": "Bearer s3cret"})
+        assert status == 200
+        lines = body.decode().splitlines()
+        # The status server's accept loop is always there to be sampled
+        assert any(line.startswith("status-server;") for line in lines)
+        counts = [int(line.rpartition(" ")[2]) for line in lines]
+        assert counts == sorted(counts, reverse=True)
+
+    def test_one_capture_at_a_time(self, admin_server):
+        auth = {"Authorization": "Bearer s3cret"}
+        first = threading.Thread(target=get, args=(admin_server, "/debug/profile?seconds=1", auth))
+        first.start()
+        time.sleep(0.2)
+        assert get(admin_server, "/debug/profile?seconds=0.1", auth)[0] == 409
+        first.join()
+
+
+class TestSampleStacks:
+    def test_samples_other_threads(self):
+        stop = threading.Event()
+
+        def waiting():
+            stop.wait(5)
+
+        thread = threading.Thread(target=waiting, name="sampled")
+        thread.start()
+        try:
+            stacks, samples = sample_stacks(0.1, interval=0.01)
+        finally:
+            stop.set()
+            thread.join()
+        assert samples > 1
+        sampled = [stack for stack in stacks if stack.startswith("sampled;")]
+        assert sampled and all("test_status_server.py:waiting" in s for s in sampled)
+        # The sampling thread itself is left out
+        assert not any("sample_stacks" in stack for stack in stacks)
+
+
+class TestErrorsEndpoint:
+    @pytest.fixture(autouse=True)
+    def errors(self, mock_dropbox):
+        mock_dropbox.query_status.return_value = (
+            'Can\'t sync "a.txt" (access denied)\nCan\'t sync "b.txt" (disk full)\n'
+        )
+
+    def test_errors(self, server, monitor):
+        monitor.refresh()
+        monitor.refresh()
+        status, body = get(server, "/status/errors?limit=1")
+        assert status == 200
+        page = json.loads(body)
+        assert page["total"] == 2
+        assert [(e["path"], e["reason"], e["count"]) for e in page["errors"]] == [
+            ("b.txt", "disk full", 2)
+        ]
+
+    def test_reason_filter(self, server, monitor):
+        monitor.refresh()
+        page = json.loads(get(server, "/status/errors?reason=access+denied")[1])
+        assert [e["path"] for e in page["errors"]] == ["a.txt"]
+
+    @pytest.mark.parametrize("query", ["limit=0", "limit=5000", "offset=-1", "offset=x"])
+    def test_bad_parameters(self, server, query):
+        assert get(server, "/status/errors?" + query)[0] == 400
+
+
+class TestStatusCaching:
+    def test_compact_json(self, server, monitor):
+        monitor.refresh()
+        _, body = get(server, "/status")
+        assert b"\n" not in body and b", " not in body
+
+    def test_etag_and_if_none_match(self, server, monitor, mock_dropbox):
+        monitor.refresh()
+        conn = connect(server)
+        conn.request("GET", "/status")
+        response = conn.getresponse()
+        response.read()
+        etag = response.getheader("ETag")
+        assert etag.startswith('W/"')
+
+        # Only the snapshot age moved: still the same status
+        time.sleep(0.01)
+        conn.request("GET", "/status", headers={"If-None-Match": etag})
+        response = conn.getresponse()
+        assert response.status == 304
+        assert response.read() == b""
+
+        mock_dropbox.query_status.return_value = "Syncing 3 files\n"
+        monitor.refresh()
+        conn.request("GET", "/status", headers={"If-None-Match": etag})
+        response = conn.getresponse()
+        response.read()
+        assert response.status == 200
+        assert response.getheader("ETag") != etag
+        conn.close()
+
+    def test_gzip(self, server, monitor, mock_dropbox):
+        mock_dropbox.query_exclude_list.return_value = ["/folder-%d" % i for i in range(100)]
+        monitor.refresh()
+        conn = connect(server)
+        conn.request("GET", "/status", headers={"Accept-Encoding": "gzip"})
+        response = conn.getresponse()
+        body = response.read()
+        assert response.getheader("Content-Encoding") == "gzip"
+        assert len(json.loads(gzip.decompress(body))["excluded_folders"]) == 100
+        conn.close()
+
+        _, plain = get(server, "/status")
+        assert len(json.loads(plain)["excluded_folders"]) == 100
+
+    def test_small_responses_are_not_gzipped(self, server):
+        conn = connect(server)
+        conn.request("GET", "/health", headers={"Accept-Encoding": "gzip"})
+        response = conn.getresponse()
+        assert json.loads(response.read())["healthy"] is True
+        assert response.getheader("Content-Encoding") is None
+        conn.close()
+
+    @pytest.mark.parametrize("header,expected", [
+        ("gzip, deflate", True),
+        ("deflate, gzip;q=0.5", True),
+        ("gzip;q=0", False),
+        ("*", True),
+        ("identity", False),
+        (None, False),
+    ])
+    def test_accepts_gzip(self, header, expected):
+        assert accepts_gzip(header) is expected
+
+
+class TestStatusEventBus:
+    def test_since(self):
+        bus = StatusEventBus(capacity=3)
+        start = bus.last_id
+        for i in range(5):
+            bus.publish("counts", {"syncing": i})
+        assert [e.data["syncing"] for e in bus.since(start + 3)] == [3, 4]
+        assert bus.since(bus.last_id) == []
+        # Dropped from the buffer, or from another process: needs a snapshot
+        assert bus.since(start + 1) is None
+        assert bus.since(bus.last_id + 1) is None
+
+    def test_wait_wakes_up_on_publish(self):
+        bus = StatusEventBus()
+        last_id = bus.last_id
+        threading.Timer(0.05, lambda: bus.publish("state", {})).start()
+        started = time.monotonic()
+        assert [e.event for e in bus.wait(last_id, 5)] == ["state"]
+        assert time.monotonic() - started < 1
+
+    def test_wait_times_out(self):
+        bus = StatusEventBus()
+        assert bus.wait(bus.last_id, 0.01) == []
+
+
+@pytest.fixture
+def stream_server(monitor, logger):
+    server = start_status_server(
+        monitor, 0, logger, host="127.0.0.1", heartbeat_interval=0.1
+    )
+    yield server
+    monitor.events.close()
+    server.shutdown()
+    server.server_close()
+
+
+def open_stream(server, headers=None):
+    conn = connect(server)
+    conn.request("GET", "/status/stream", headers=headers or {})
+    response = conn.getresponse()
+    assert response.status == 200
+    assert response.getheader("Content-Type") == "text/event-stream"
+    return conn, response
+
+
+class TestStatusStream:
+    def test_snapshot_then_changes(self, stream_server, monitor, mock_dropbox):
+        monitor.refresh()
+        conn, response = open_stream(stream_server)
+        snapshot = read_event(response)
+        assert snapshot["event"] == "snapshot"
+        assert snapshot["data"]["state"] == "up to date"
+
+        mock_dropbox.query_status.return_value = "Syncing 3 files\n"
+        monitor.refresh()
+        state = read_event(response)
+        assert state["event"] == "state"
+        assert state["data"]["state"] == "syncing"
+        assert state["data"]["previous"] == "up to date"
+        counts = read_event(response)
+        assert counts["event"] == "counts"
+        assert counts["data"]["syncing"] == 3
+        assert int(counts["id"]) > int(state["id"]) > int(snapshot["id"])
+
+        # Nothing changed: no event
+        monitor.refresh()
+        assert read_event(response) == {"comment": "heartbeat"}
+        conn.close()
+
+    def test_resume_from_last_event_id(self, stream_server, monitor, mock_dropbox):
+        monitor.refresh()
+        last_id = monitor.events.last_id
+        mock_dropbox.query_status.return_value = "Syncing 3 files\n"
+        monitor.refresh()
+
+        conn, response = open_stream(stream_server, {"Last-Event-ID": str(last_id)})
+        assert [read_event(response)["event"] for _ in range(2)] == ["state", "counts"]
+        conn.close()
+
+        conn, response = open_stream(stream_server, {"Last-Event-ID": "12"})
+        assert read_event(response)["event"] == "snapshot"
+        conn.close()
+
+    def test_many_subscribers(self, stream_server, monitor, mock_dropbox):
+        streams = [open_stream(stream_server) for _ in range(20)]
+        for _, response in streams:
+            assert read_event(response)["event"] == "snapshot"
+        assert monitor.events.subscribers == 20
+
+        mock_dropbox.query_status.return_value = "Syncing 3 files\n"
+        monitor.refresh()
+        for conn, response in streams:
+            assert read_event(response)["data"]["state"] == "syncing"
+            conn.close()
+
+    def test_heartbeat(self, stream_server):
+        conn, response = open_stream(stream_server)
+        read_event(response)
+        assert read_event(response) == {"comment": "heartbeat"}
+        conn.close()
@@ -0,0 +1,227 @@
+import http.client
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
+
+import pytest
+from prometheus_client import REGISTRY
+
+from monitoring import (
+    CommandSocketClient,
+    DropboxMonitor,
+    SocketDropboxInterface,
+    State,
+    StatusTree,
+    start_status_server,
+)
+from .fake_dropbox import FakeCommandSocket
+
+
+@pytest.fixture
+def logger():
+    return logging.getLogger("test")
+
+
+@pytest.fixture
+def root(tmp_path):
+    root = tmp_path / "Dropbox"
+    (root / "Photos" / "2024").mkdir(parents=True)
+    (root / "Photos" / "a.jpg").write_text("a")
+    (root / "Photos" / "b.jpg").write_text("b")
+    (root / "Docs").mkdir()
+    (root / "notes.txt").write_text("n")
+    (root / ".dropbox").write_text("")
+    return root
+
+
+@pytest.fixture
+def fake_daemon():
+    # Unix socket paths are limited to ~100 bytes, so avoid pytest's long tmp_path
+    directory = tempfile.mkdtemp(prefix="dbx")
+    with FakeCommandSocket(os.path.join(directory, "command_socket")) as fake:
+        yield fake
+    shutil.rmtree(directory, ignore_errors=True)
+
+
+@pytest.fixture
+def dropbox(fake_daemon, root, logger):
+    dropbox = SocketDropboxInterface(
+        logger, CommandSocketClient(fake_daemon.path, timeout=1.0), sync_root=str(root)
+    )
+    yield dropbox
+    dropbox.client.close()
+
+
+@pytest.fixture
+def tree(dropbox, root, logger):
+    tree = StatusTree(dropbox, str(root), logger)
+    yield tree
+    tree.close()
+
+
+def file_status_requests(fake):
+    return sum(1 for name, _ in fake.requests if name == "icon_overlay_file_status")
+
+
+class TestStatusTree:
+    def test_rollup(self, tree, fake_daemon, root):
+        fake_daemon.file_status[str(root)] = "syncing"
+        fake_daemon.file_status[str(root / "Photos")] = "syncing"
+        fake_daemon.file_status[str(root / "Docs")] = "unsyncable"
+        fake_daemon.ignore_set = [str(root / "Archive")]
+
+        page = tree.get("/").as_dict()
+        assert page["status"] == "syncing"
+        assert page["counts"] == {
+            "synced": 1, "syncing": 1, "error": 1, "excluded": 1, "unknown": 0
+        }
+        # Dropbox's own files are left out; excluded folders aren't on disk
+        assert page["entries"] == [
+            {"name": "Archive", "type": "dir", "status": "excluded"},
+            {"name": "Docs", "type": "dir", "status": "error"},
+            {"name": "Photos", "type": "dir", "status": "syncing"},
+            {"name": "notes.txt", "type": "file", "status": "synced"},
+        ]
+
+        photos = tree.get("Photos").as_dict(status="synced")
+        assert photos["path"] == "Photos"
+        assert [entry["name"] for entry in photos["entries"]] == ["2024", "a.jpg", "b.jpg"]
+
+    def test_cached_until_changed_on_disk(self, tree, fake_daemon, root):
+        tree.get("")
+        tree.get("Photos")
+        queried = file_status_requests(fake_daemon)
+        tree.get("")
+        tree.get("Photos")
+        assert file_status_requests(fake_daemon) == queried
+
+        (root / "Photos" / "2024" / "c.jpg").write_text("c")
+        tree.get("Photos/2024")
+        queried = file_status_requests(fake_daemon)
+        (root / "Photos" / "2024" / "d.jpg").write_text("d")
+        # The change drops the directory and everything above it
+        assert tree.get("Photos/2024").total == 2
+        assert tree.get("Photos").total == 3
+        assert tree.get("").total == 3
+        assert file_status_requests(fake_daemon) == queried + 3 + 4 + 4
+
+    def test_ttl_while_not_settled(self, tree, fake_daemon):
+        tree.ttl = 0.05
+        tree.get("Docs", settled=False)
+        queried = file_status_requests(fake_daemon)
+        tree.get("Docs", settled=False)
+        assert file_status_requests(fake_daemon) == queried
+        time.sleep(0.1)
+        tree.get("Docs", settled=False)
+        assert file_status_requests(fake_daemon) == queried + 1
+
+    def test_invalidate_all(self, tree, fake_daemon, root):
+        tree.get("Photos")
+        fake_daemon.file_status[str(root / "Photos" / "a.jpg")] = "syncing"
+        tree.invalidate_all()
+        assert tree.get("Photos").counts()["syncing"] == 1
+
+    def test_bounded(self, dropbox, root, logger):
+        for i in range(20):
+            (root / "Docs" / ("%02d" % i)).mkdir()
+        tree = StatusTree(dropbox, str(root), logger, max_dirs=3, max_entries=25, max_children=5)
+        docs = tree.get("Docs")
+        assert len(docs.names) == 5
+        assert docs.as_dict()["truncated"] and docs.total == 20
+
+        for i in range(6):
+            tree.get("Docs/%02d" % i)
+        assert len(tree) == 3
+        assert tree.evictions == 4
+        # Evicted directories stop being watched
+        assert len(tree._watched) == 3
+        tree.close()
+
+    @pytest.mark.parametrize("path", ["..", "Photos/../../etc", "../Dropbox"])
+    def test_rejects_paths_outside_the_sync_folder(self, tree, path):
+        with pytest.raises(ValueError):
+            tree.get(path)
+
+    def test_rejects_symlinks_out_of_the_sync_folder(self, tree, root, tmp_path):
+        (root / "escape").symlink_to(tmp_path)
+        with pytest.raises(ValueError):
+            tree.get("escape")
+
+    def test_missing_directory(self, tree):
+        with pytest.raises(FileNotFoundError):
+            tree.get("nope")
+        with pytest.raises(NotADirectoryError):
+            tree.get("notes.txt")
+        assert len(tree._watched) == 0
+
+
+@pytest.fixture
+def monitor(dropbox, root, logger):
+    monitor = DropboxMonitor(
+        dropbox=dropbox, min_poll_interval_sec=5, logger=logger, prom_port=9999,
+        status_tree=StatusTree(dropbox, str(root), logger),
+    )
+    yield monitor
+    monitor.stop()
+
+
+class TestMonitorTree:
+    def test_state_transition_invalidates(self, monitor, fake_daemon):
+        monitor.refresh()
+        monitor.get_tree("Photos")
+        assert len(monitor.status_tree) == 1
+        fake_daemon.status = ["Syncing 2 files"]
+        monitor.refresh()
+        assert monitor.snapshot.state == State.SYNCING
+        assert len(monitor.status_tree) == 0
+
+    def test_exported(self, monitor):
+        monitor.get_tree("")
+        assert REGISTRY.get_sample_value("dropbox_status_tree_directories") == 1
+        assert REGISTRY.get_sample_value("dropbox_status_tree_entries") == 3
+        assert REGISTRY.get_sample_value("dropbox_status_tree_path_queries_total") == 4
+
+
+def get(server, path):
+    conn = http.client.HTTPConnection("127.0.0.1", server.server_address[1], timeout=5)
+    conn.request("GET", path)
+    response = conn.getresponse()
+    body = response.read()
+    conn.close()
+    return response.status, body
+
+
+@pytest.fixture
+def server(monitor, logger):
+    server = start_status_server(monitor, 0, logger, request_timeout=2, host="127.0.0.1")
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+class TestTreeEndpoint:
+    def test_tree(self, server, fake_daemon, root):
+        fake_daemon.file_status[str(root / "Photos" / "b.jpg")] = "syncing"
+        status, body = get(server, "/status/tree?path=Photos&status=syncing")
+        assert status == 200
+        data = json.loads(body)
+        assert data["counts"]["syncing"] == 1
+        assert data["entries"] == [{"name": "b.jpg", "type": "file", "status": "syncing"}]
+
+    def test_paging(self, server):
+        data = json.loads(get(server, "/status/tree?offset=1&limit=1")[1])
+        assert data["total"] == 3
+        assert [entry["name"] for entry in data["entries"]] == ["Photos"]
+
+    @pytest.mark.parametrize("query", [
+        "path=../etc", "status=stuck", "limit=0", "offset=-1", "limit=x",
+    ])
+    def test_bad_request(self, server, query):
+        assert get(server, "/status/tree?" + query)[0] == 400
+
+    def test_not_a_directory(self, server):
+        assert get(server, "/status/tree?path=nope")[0] == 404
+        assert get(server, "/status/tree?path=notes.txt")[0] == 404
@@ -0,0 +1,193 @@
+import logging
+import os
+import subprocess
+import sys
+import threading
+import time
+from unittest.mock import MagicMock
+
+import pytest
+from prometheus_client import REGISTRY
+
+from monitoring import (
+    DROPBOX_HOME,
+    DaemonSupervisor,
+    DropboxInterface,
+    DropboxMonitor,
+    clean_stale_files,
+    clean_tmp_dirs,
+    lock_analytics,
+)
+
+
+@pytest.fixture
+def logger():
+    return logging.getLogger("test")
+
+
+@pytest.fixture
+def monitor(logger):
+    dropbox = MagicMock(spec=DropboxInterface)
+    dropbox.query_status.return_value = "Up to date\n"
+    return DropboxMonitor(dropbox=dropbox, min_poll_interval_sec=5, logger=logger, prom_port=9999)
+
+
+@pytest.fixture
+def home(tmp_path, monkeypatch):
+    """A fake /opt/dropbox; chown to root is recorded instead of performed."""
+    monkeypatch.setattr(os, "chown", lambda path, uid, gid: None)
+    (tmp_path / ".dropbox").mkdir()
+    return tmp_path
+
+
+def python_command(code):
+    return [sys.executable, "-c", code]
+
+
+def supervisor_for(command, monitor, logger, home, **kwargs):
+    kwargs.setdefault("restart_delay_sec", 0.01)
+    return DaemonSupervisor(command, monitor, logger, home=str(home), tmp_dir=str(home), **kwargs)
+
+
+class TestRestartHelpers:
+    def test_clean_stale_files(self, home):
+        for name in ("command_socket", "dropbox.pid", "info.json"):
+            (home / ".dropbox" / name).write_text("")
+        clean_stale_files(str(home))
+        assert os.listdir(home / ".dropbox") == ["info.json"]
+
+    def test_lock_analytics(self, home):
+        events = home / ".dropbox" / "events"
+        (events / "nested").mkdir(parents=True)
+        (events / "queue.bin").write_text("x")
+        (home / ".dropbox" / "metrics").mkdir()
+        (home / ".dropbox" / "metrics" / "store.bin").write_text("x")
+
+        lock_analytics(str(home))
+
+        for root in (home / ".dropbox", home / ".dropbox" / ".dropbox"):
+            for name in ("events", "ssa_events", "sentry_exceptions"):
+                assert os.listdir(root / name) == []
+                assert oct((root / name).stat().st_mode & 0o777) == oct(0o555)
+        assert not (home / ".dropbox" / "metrics" / "store.bin").exists()
+
+    def test_clean_tmp_dirs(self, tmp_path):
+        old, new, other = tmp_path / "dropbox-old", tmp_path / "dropbox-new", tmp_path / "other"
+        for path in (old, new, other):
+            path.mkdir()
+        os.utime(old, (0, 0))
+        os.utime(other, (0, 0))
+        clean_tmp_dirs(str(tmp_path))
+        assert sorted(os.listdir(tmp_path)) == ["dropbox-new", "other"]
+
+
+class TestDaemonSupervisor:
+    def test_restarts_with_backoff_and_gives_up(self, monitor, logger, home):
+        supervisor = supervisor_for(python_command("raise SystemExit(3)"), monitor, logger, home,
+                                    max_restarts=2)
+        assert supervisor.run(threading.Event()) == 1
+        assert monitor.restart_count == 2
+        assert REGISTRY.get_sample_value("dropbox_daemon_restarts_total") == 2
+        assert REGISTRY.get_sample_value("dropbox_daemon_exits_total", {"code": "3"}) == 3
+        assert REGISTRY.get_sample_value("dropbox_daemon_last_exit_code") == 3
+        assert REGISTRY.get_sample_value("dropbox_daemon_last_crash_timestamp_seconds") > 0
+
+    def test_restart_delay_doubles_up_to_cap(self, monitor, logger, home):
+        supervisor = supervisor_for(["true"], monitor, logger, home, restart_delay_sec=10,
+                                    max_restart_delay_sec=60)
+        assert [supervisor.restart_delay(n) for n in range(1, 6)] == [10, 20, 40, 60, 60]
+
+    def test_stable_run_resets_backoff(self, monitor, logger, home):
+        supervisor = supervisor_for(python_command("raise SystemExit(1)"), monitor, logger, home,
+                                    max_restarts=1, stable_after_sec=0)
+        stop = threading.Event()
+        thread = threading.Thread(target=lambda: supervisor.run(stop))
+        thread.start()
+        try:
+            deadline = time.monotonic() + 5
+            while monitor.restart_count < 3 and time.monotonic() < deadline:
+                time.sleep(0.01)
+        finally:
+            stop.set()
+            thread.join()
+        # Never more than one crash in a row, so it never gave up
+        assert monitor.restart_count >= 3
+        assert supervisor.consecutive_crashes == 1
+
+    def test_stop_terminates_daemon(self, monitor, logger, home):
+        supervisor = supervisor_for(python_command("import time; time.sleep(30)"), monitor,
+                                    logger, home)
+        stop = threading.Event()
+        result = {}
+        thread = threading.Thread(target=lambda: result.update(code=supervisor.run(stop)))
+        thread.start()
+        time.sleep(0.2)
+        stop.set()
+        thread.join(timeout=10)
+        assert result["code"] == 0
+        assert supervisor.process.returncode is not None
+        assert monitor.restart_count == 0
+
+    def test_requested_restart_is_not_a_crash(self, monitor, logger, home):
+        supervisor = supervisor_for(python_command("import time; time.sleep(30)"), monitor,
+                                    logger, home)
+        stop = threading.Event()
+        thread = threading.Thread(target=lambda: supervisor.run(stop))
+        thread.start()
+        try:
+            time.sleep(0.2)
+            first = supervisor.process
+            (home / ".dropbox" / "events" / "queue.bin").write_text("x")
+            supervisor.request_restart()
+            deadline = time.monotonic() + 5
+            while supervisor.process is first and time.monotonic() < deadline:
+                time.sleep(0.05)
+        finally:
+            stop.set()
+            thread.join(timeout=10)
+        assert first.returncode is not None
+        assert supervisor.process is not first
+        assert not (home / ".dropbox" / "events" / "queue.bin").exists()
+        assert REGISTRY.get_sample_value("dropbox_daemon_planned_restarts_total") == 1
+        assert supervisor.consecutive_crashes == 0
+        assert monitor.restart_count == 0
+
+    def test_start_cleans_up_and_wakes_monitor(self, monitor, logger, home):
+        (home / ".dropbox" / "command_socket").write_text("")
+        monitor.notify_change = MagicMock()
+        supervisor = supervisor_for(python_command("pass"), monitor, logger, home)
+        supervisor.start_daemon()
+        supervisor.process.wait()
+        assert not (home / ".dropbox" / "command_socket").exists()
+        assert (home / ".dropbox" / "events").is_dir()
+        monitor.notify_change.assert_called_once()
+
+    def test_logs_status_changes_from_snapshot(self, monitor, logger, home, caplog):
+        supervisor = supervisor_for(["true"], monitor, logger, home)
+        caplog.set_level(logging.INFO)
+        monitor.refresh()
+        supervisor.log_status_change()
+        supervisor.log_status_change()
+        assert [r.message for r in caplog.records if "Dropbox status" in r.message] == [
+            "Dropbox status: Up to date"
+        ]
+
+
+class TestSupervisedCli:
+    def test_runs_as_the_daemon_user(self, logger, monkeypatch):
+        run = MagicMock(return_value=subprocess.CompletedProcess([], 0, "Up to date\n", ""))
+        monkeypatch.setattr(subprocess, "run", run)
+        monkeypatch.setenv("HOME", "/root")
+        dropbox = DropboxInterface(logger, owner=(1000, 1001))
+        assert dropbox.query_status() == "Up to date\n"
+        kwargs = run.call_args.kwargs
+        assert (kwargs["user"], kwargs["group"], kwargs["extra_groups"]) == (1000, 1001, [])
+        # dropbox.py finds the daemon through $HOME
+        assert kwargs["env"]["HOME"] == DROPBOX_HOME
+
+    def test_unchanged_without_owner(self, logger, monkeypatch):
+        run = MagicMock(return_value=subprocess.CompletedProcess([], 0, "Up to date\n", ""))
+        monkeypatch.setattr(subprocess, "run", run)
+        DropboxInterface(logger).query_status()
+        assert "user" not in run.call_args.kwargs
+        assert run.call_args.kwargs["env"] is None
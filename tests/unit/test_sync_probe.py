@@ -0,0 +1,122 @@
+import logging
+import os
+import shutil
+import tempfile
+import threading
+
+import pytest
+from prometheus_client import REGISTRY
+
+from monitoring import (
+    CommandSocketClient,
+    DropboxMonitor,
+    PollScheduler,
+    SocketDropboxInterface,
+    SyncProbe,
+)
+from .fake_dropbox import FakeCommandSocket
+
+
+@pytest.fixture
+def fake_daemon():
+    # Unix socket paths are limited to ~100 bytes, so avoid pytest's long tmp_path
+    directory = tempfile.mkdtemp(prefix="dbx")
+    with FakeCommandSocket(os.path.join(directory, "command_socket")) as fake:
+        yield fake
+    shutil.rmtree(directory, ignore_errors=True)
+
+
+@pytest.fixture
+def monitor(fake_daemon):
+    logger = logging.getLogger("test")
+    client = CommandSocketClient(fake_daemon.path, timeout=1.0)
+    monitor = DropboxMonitor(
+        dropbox=SocketDropboxInterface(logger, client),
+        min_poll_interval_sec=0,
+        logger=logger,
+        prom_port=9999,
+    )
+    monitor.scheduler = PollScheduler(0.02)
+    monitor.start_sampler()
+    yield monitor
+    monitor.stop()
+    client.close()
+
+
+@pytest.fixture
+def probe(monitor, tmp_path):
+    return SyncProbe(
+        monitor, str(tmp_path / "monitoring"), logging.getLogger("test"),
+        timeout=5, check_interval=0.02,
+    )
+
+
+def syncing_until(fake_daemon, path, delay):
+    """Make the fake daemon sync ``path`` for ``delay`` seconds."""
+    fake_daemon.status = ["Syncing 1 file"]
+    fake_daemon.file_status[path] = "syncing"
+
+    def done():
+        fake_daemon.status = ["Up to date"]
+        fake_daemon.file_status[path] = "up to date"
+
+    threading.Timer(delay, done).start()
+
+
+class TestSyncProbe:
+    def test_times_canary_sync(self, probe, fake_daemon):
+        syncing_until(fake_daemon, probe.path, 0.3)
+        latency = probe.probe()
+        assert 0.3 <= latency < 2
+        assert os.path.exists(probe.path)
+        assert ("icon_overlay_file_status", {"path": [probe.path]}) in fake_daemon.requests
+        assert REGISTRY.get_sample_value("dropbox_sync_probes_total", {"result": "ok"}) == 1
+        assert REGISTRY.get_sample_value("dropbox_sync_probe_latency_seconds_count") == 1
+        assert REGISTRY.get_sample_value("dropbox_sync_probe_last_latency_seconds") == latency
+
+    def test_waits_for_file_status(self, probe, fake_daemon):
+        # The overall status is already up to date, but the canary isn't synced yet
+        fake_daemon.file_status[probe.path] = "syncing"
+        threading.Timer(0.3, lambda: fake_daemon.file_status.pop(probe.path)).start()
+        assert probe.probe() >= 0.3
+
+    def test_without_file_status(self, probe, fake_daemon):
+        del fake_daemon.handlers["icon_overlay_file_status"]
+        fake_daemon.status = ["Syncing 1 file"]
+        threading.Timer(0.3, lambda: setattr(fake_daemon, "status", ["Up to date"])).start()
+        assert 0.3 <= probe.probe() < 2
+
+    def test_waits_for_dropbox_to_notice(self, probe, fake_daemon):
+        # Dropbox keeps saying "Up to date" for a while after the write
+        threading.Timer(0.3, syncing_until, (fake_daemon, probe.path, 0.3)).start()
+        assert 0.6 <= probe.probe() < 2
+        assert REGISTRY.get_sample_value("dropbox_sync_probes_total", {"result": "ok"}) == 1
+
+    def test_change_never_seen(self, probe, fake_daemon):
+        probe.timeout = 0.3
+        assert probe.probe() is None
+        assert REGISTRY.get_sample_value("dropbox_sync_probes_total", {"result": "error"}) == 1
+        assert REGISTRY.get_sample_value("dropbox_sync_probe_latency_seconds_count") == 0
+
+    def test_timeout(self, probe, fake_daemon):
+        probe.timeout = 0.2
+        fake_daemon.file_status[probe.path] = "syncing"
+        assert probe.probe() is None
+        assert REGISTRY.get_sample_value("dropbox_sync_probes_total", {"result": "timeout"}) == 1
+
+    def test_canary_owned_by_the_daemon_user(self, monitor, fake_daemon, tmp_path, monkeypatch):
+        chowned = []
+        monkeypatch.setattr(os, "chown", lambda path, uid, gid: chowned.append((path, uid, gid)))
+        probe = SyncProbe(
+            monitor, str(tmp_path / "monitoring"), logging.getLogger("test"),
+            timeout=5, check_interval=0.02, owner=(1000, 1001),
+        )
+        syncing_until(fake_daemon, probe.path, 0.1)
+        probe.probe()
+        assert chowned == [(probe.directory, 1000, 1001), (probe.path, 1000, 1001)]
+
+    def test_unwritable_directory(self, monitor, tmp_path):
+        (tmp_path / "file").write_text("")
+        probe = SyncProbe(monitor, str(tmp_path / "file" / "sub"), logging.getLogger("test"))
+        assert probe.probe() is None
+        assert REGISTRY.get_sample_value("dropbox_sync_probes_total", {"result": "error"}) == 1